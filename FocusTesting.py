@@ -9,6 +9,7 @@ import numpy as np
 import pandas as pd
 import Detection
 from matplotlib import animation
+from skimage import io
 
 
 class ZStackData:
@@ -104,14 +105,26 @@ class ZStackData:
         :param direction: int, scalar to indicate up or down (+1 = up, -1 = down)
         :return:
         """
+        offsets = []
         move_x = 0
         while 100 > move_x > -100:
-            self._move_hardware(move_x + start_pos)
-            time.sleep(0.25)
-            self.apparatus.get_image()
-            filename = save_dir + "\\z_stack_{:+04.0f}.tiff".format(move_x)
-            self.apparatus.save_raw_image(filename)
+            offsets.append(move_x)
             move_x += direction * self._move_function(np.abs(move_x))
+        camera = getattr(self.apparatus, 'camera', None)
+        if hasattr(camera, 'acquire_stack'):
+            # The whole stack is acquired into one array, then saved
+            stack, _ = camera.acquire_stack(np.asarray(offsets) + start_pos, move=self._move_hardware, settle=0.25)
+            for move_x, img in zip(offsets, stack):
+                filename = save_dir + "\\z_stack_{:+04.0f}.tiff".format(move_x)
+                io.imsave(filename, img, check_contrast=False)
+        else:
+            # Apparatus without a camera utility, snap and save each image
+            for move_x in offsets:
+                self._move_hardware(move_x + start_pos)
+                time.sleep(0.25)
+                self.apparatus.get_image()
+                filename = save_dir + "\\z_stack_{:+04.0f}.tiff".format(move_x)
+                self.apparatus.save_raw_image(filename)
         self._move_hardware(start_pos)
         return
 
@@ -1,6 +1,7 @@
 import os
 import threading
 from abc import ABC, abstractmethod
+from collections import deque
 from threading import Lock
 from serial import Serial
 import pycromanager
@@ -22,6 +23,7 @@ class ControllerAbstraction(ABC):
     def __init__(self, port):
         self.port = port
         self.lock = threading.RLock()
+        self.resets = 0  # Incremented by reset, utilities forget the device states they shadowed
 
     def __str__(self):
         return repr(self) + " using port: " + self.port
@@ -76,6 +78,7 @@ class SimulatedController(ControllerAbstraction):
             self._status = False
 
     def reset(self):
+        self.resets += 1
         self.close()
         self.open()
 
@@ -94,6 +97,10 @@ class ArduinoController(ControllerAbstraction):
     controller,name1,arduino,COM#
 
     Where COM# corresponds to the serial/USB port the arduino/microcontroller is connected to.
+
+    Firmware can push lines without being asked (ie position streaming). Utilities register a line listener for the
+    prefix of the pushed lines, and a reader thread then owns the serial input: pushed lines go to the listener and
+    all other lines are kept as responses for send_command.
     """
     id = 'arduino'
 
@@ -103,6 +110,10 @@ class ArduinoController(ControllerAbstraction):
         self._serial.baudrate = 1000000
         self._serial.timeout = 0.5
         self._delay = 0.2
+        self._listeners = {}
+        self._responses = deque()
+        self._reader_flag = threading.Event()
+        self._reader_thread = threading.Thread()
 
     def open(self):
         """
@@ -119,22 +130,83 @@ class ArduinoController(ControllerAbstraction):
             time.sleep(1.5)
             self._serial.timeout = old_to
             self._serial.read_until('\r\n'.encode())
+            if len(self._listeners) > 0:
+                self._start_reader()
 
     def close(self):
         """
         Close the serial port and free it for use
         :return:
         """
+        self._stop_reader()
         if self._serial.is_open:
             self._serial.close()
 
+    def add_line_listener(self, prefix, func):
+        """
+        Calls func with every line (decoded, without the line ending) the firmware sends that starts with prefix.
+        The reader thread is started if the port is open.
+        :param prefix: str
+        :param func: function object
+        :return:
+        """
+        self._listeners[prefix] = func
+        if self._serial.is_open:
+            self._start_reader()
+
+    def _start_reader(self):
+        if self._reader_thread.is_alive():
+            return
+        self._reader_flag.set()
+        self._reader_thread = threading.Thread(target=self._read_lines, name=f'ArduinoReader {self.port}',
+                                               daemon=True)
+        self._reader_thread.start()
+
+    def _stop_reader(self):
+        self._reader_flag.clear()
+        if self._reader_thread.is_alive():
+            self._reader_thread.join(2 * self._serial.timeout + 0.5)
+
+    def _read_lines(self):
+        """
+        Reader thread, sends pushed lines to their listener and keeps the other lines for send_command
+        :return:
+        """
+        while self._reader_flag.is_set():
+            try:
+                line = self._serial.readline()
+            except Exception as e:
+                logging.error(f"{self.port} reader stopped: {e}")
+                return
+            if len(line) == 0:
+                continue
+            text = line.decode(errors='replace').strip('\r\n')
+            for prefix, func in list(self._listeners.items()):
+                if text.startswith(prefix):
+                    try:
+                        func(text)
+                    except Exception as e:
+                        logging.error(f"{self.port} listener for {prefix} failed on {text}: {e}")
+                    break
+            else:
+                self._responses.append(line)
+
+    def _pop_responses(self):
+        lines = []
+        while len(self._responses) > 0:
+            lines.append(self._responses.popleft())
+        return lines
+
     def reset(self):
         """
         Resets the serial port
         :return:
         """
 
+        self.resets += 1
+
         self.close()
+
         self.open()
 
     def read_buffer(self):
@@ -142,9 +214,34 @@ class ArduinoController(ControllerAbstraction):
         Reads the Serial buffer and returns the entire list of commands or phases sent
         :return: list of stringn commands from serial buffer
         """
+        if self._reader_thread.is_alive():
+            return self._pop_responses()
         resp = self._serial.readlines()
         return resp
 
+    def read_bytes(self, size=None):
+        """
+        Reads raw bytes from the serial port, used when the firmware is streaming binary data. Waits (up to the
+        serial timeout) for at least one byte.
+        :param size: int, number of bytes to read (None reads whatever is waiting)
+        :return: bytes
+        """
+        if size is None:
+            size = max(1, self._serial.in_waiting)
+        return self._serial.read(size)
+
+    def write(self, command):
+        """
+        Writes a command without waiting for or reading a response. Use this while the firmware is streaming data,
+        send_command would consume the streamed bytes.
+        :param command: string or bytes
+        :return:
+        """
+        with self.lock:
+            if type(command) == str:
+                command = command.encode()
+            self._serial.write(command)
+
     def send_command(self, command):
         """
         Send a command to the arduino microcontroller. See Arduino code or L2 arduino utility class for
@@ -154,6 +251,8 @@ class ArduinoController(ControllerAbstraction):
         :return: 'Ok' or String containing data
         """
         with self.lock:
+            if self._reader_thread.is_alive():
+                self._pop_responses()
             if type(command)==bytes:
                 self._serial.write(command)
             elif type(command)==str:
@@ -205,6 +304,7 @@ class PycromanagerController(ControllerAbstraction):
         self.core.unload_all_devices()
 
     def reset(self):
+        self.resets += 1
         self.close()
         self.open()
 
@@ -290,6 +390,7 @@ class MicroManagerController(ControllerAbstraction):
         self._mmc.close()
 
     def reset(self):
+        self.resets += 1
         self.close()
         self.open()
 
@@ -342,6 +443,7 @@ class PriorController(ControllerAbstraction):
         Resets the serial port
         :return:
         """
+        self.resets += 1
         self.close()
         self.open()
 
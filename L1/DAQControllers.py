@@ -45,6 +45,8 @@ class DaqAbstraction(ABC):
         self._send_funcs = []
         self._lock = threading.RLock()
         self._callbacks = []
+        self._chunk_hooks = []
+        self._interlock_channels = []
         self._set_ai_channels = []
         self._set_ao_channels = []
         self._rate = 1000
@@ -133,6 +135,56 @@ class DaqAbstraction(ABC):
         """
         self._callbacks.append([func, chnls, mode, *args])
 
+    def add_chunk_hook(self, func, chnls):
+        """
+        Adds a function that is called with every chunk of samples in the acquisition thread, before the callbacks
+        are started. Hooks are for fast checks that must respond within one chunk (like the high voltage trip
+        monitor), they should not block.
+        func is called as func(samples, total_samples) where samples is a list with an array for each channel
+        :param func: function object
+        :param chnls: list of analog input channels
+        :return:
+        """
+        self._chunk_hooks.append([func, chnls])
+
+    def _run_chunk_hooks(self, data, total_samples):
+        """
+        Calls the chunk hooks with the waveform of each of their channels
+        :param data: array of samples, each row is a channel
+        :param total_samples:
+        :return:
+        """
+        data = np.atleast_2d(data)
+        for func, channels in self._chunk_hooks:
+            out_data = [data[self._set_ai_channels.index(chan)] for chan in channels]
+            try:
+                func(out_data, total_samples)
+            except Exception as e:
+                logging.error(f"Chunk hook {func} failed: {e}")
+
+    def add_interlock_channel(self, channel):
+        """
+        Adds a digital output that enables the high voltage (an enable or interlock line). emergency_stop drives
+        these lines low, the other digital outputs (ie illumination or valves) are left as they are.
+        :param channel: digital output channel identifier (see add_do_channel)
+        :return:
+        """
+        if channel not in self._interlock_channels:
+            self.add_do_channel(channel)
+            self._interlock_channels.append(channel)
+
+    def emergency_stop(self):
+        """
+        Sets every analog output to zero and the interlock digital outputs low. This is called from the acquisition
+        thread by protection hooks, so it writes directly to the outputs without waiting on the other utilities.
+        :return:
+        """
+        self.stop_voltage()
+        for channel in self._interlock_channels:
+            self.set_do_channel(channel, False)
+        if len(self._interlock_channels) > 0:
+            self.update_do_channels()
+
     def _send_data(self, data, total_samples):
         """
         Copies and sends data to the corresponding callback functions.
@@ -143,6 +195,10 @@ class DaqAbstraction(ABC):
         :return:
         """
 
+        # Protection hooks see the chunk first, in the acquisition thread
+        if len(self._chunk_hooks) > 0:
+            self._run_chunk_hooks(data, total_samples)
+
         # Get the total time_data elapsed since the start_measurment was last called
         time_elapsed = total_samples/self._rate
         for callback_info in self._callbacks:
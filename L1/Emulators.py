@@ -0,0 +1,342 @@
+"""
+Firmware emulators for testing the serial protocols without hardware.
+
+Each emulator opens a pseudo terminal (pty). The emulator answers on the master side the way the firmware would,
+and the slave side (emulator.port) can be opened by the normal controller classes like a USB serial port.
+Pseudo terminals are only available on posix systems (linux, mac).
+"""
+import os
+import select
+import threading
+import time
+import tty
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from L1.SerialFrames import PMOD_ENABLED, PMOD_FRAME, PMOD_TRIPPED, encode_frames
+
+
+class PtyEmulator(ABC):
+    """
+    Base class for a firmware running on the other end of a pseudo terminal.
+
+    handle_bytes : called with any bytes the computer wrote to the port
+    update : called periodically (every tick seconds) to let the firmware do work, like streaming data
+    """
+
+    init_message = None  # Message repeated until the computer sends its first command (ie b'INIT\r\n')
+    # The arduino resets when the port is opened and prints its init message, a pty can't tell when the port is
+    # opened so the message is repeated instead
+    init_period = 0.25
+
+    def __init__(self, tick=0.001):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        self.port = os.ttyname(self._slave)
+        self.tick = tick
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._received = False
+        self._last_init = 0
+        self.rx_log = bytearray()
+
+    def start(self):
+        """
+        Starts the firmware thread
+        :return: self
+        """
+        self._thread.start()
+        return self
+
+    def close(self):
+        """
+        Stops the firmware thread and closes the pseudo terminal
+        :return:
+        """
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(1)
+        for fd in [self._master, self._slave]:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def write(self, data):
+        """
+        Writes bytes to the computer
+        :param data: bytes
+        :return:
+        """
+        try:
+            os.write(self._master, data)
+        except OSError:
+            pass
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            ready, _, _ = select.select([self._master], [], [], self.tick)
+            if ready:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    return
+                self._received = True
+                self.rx_log.extend(data)
+                self.handle_bytes(data)
+            elif self.init_message is not None and not self._received:
+                if time.time() - self._last_init > self.init_period:
+                    self._last_init = time.time()
+                    self.write(self.init_message)
+            self.update()
+
+    @abstractmethod
+    def handle_bytes(self, data):
+        """
+        Interprets the bytes sent by the computer
+        :param data: bytes
+        :return:
+        """
+        pass
+
+    def update(self):
+        """
+        Periodic work for the firmware. By default nothing is done.
+        :return:
+        """
+        pass
+
+
+class PMODEmulator(PtyEmulator):
+    """
+    Emulates the PMOD_DAC.ino firmware. Messages are at least 4 bytes long followed by a newline.
+    The ADC readback returns the DAC code of each channel (scaled to the 10 bit ADC) for both voltage and current.
+    fault_current (ADC counts per channel) is added to the current readback while enabled to simulate an arc.
+    """
+    init_message = b'INIT\r\n'
+
+    def __init__(self, tick=0.001):
+        super().__init__(tick)
+        self._msg = bytearray()
+        self.dac_codes = np.zeros(8)
+        self.enabled = False
+        self.streaming = False
+        self.stream_period = 0
+        self.sequence = 0
+        self.frames_sent = 0
+        self.drop_every = 0  # Drop every n-th frame to test the frame accounting (0 drops no frames)
+        self.trip_limit = np.zeros(8)
+        self.tripped = False
+        self.fault_current = np.zeros(8)
+        self._start = time.time()
+        self._last_frame = time.time()
+
+    def handle_bytes(self, data):
+        # Same rule as Oracle::serialCheck, newlines are only a terminator after the 4th byte
+        for byte in data:
+            if byte == ord('\n') and len(self._msg) > 3:
+                self.interpret(bytes(self._msg))
+                self._msg = bytearray()
+            else:
+                self._msg.append(byte)
+
+    def interpret(self, msg):
+        command = chr(msg[0])
+        if command == 'S':
+            self.dac_codes[msg[1] - ord('0')] = (msg[2] << 8) + msg[3]
+        elif command in 'UE':
+            # 'U' falls through to 'E' in the firmware
+            self.enabled = True
+            self.tripped = False
+        elif command == 'X':
+            self.enabled = False
+            self.dac_codes[:] = 0
+        elif command == 'B':
+            self.stream_period = ((msg[2] << 8) + msg[3]) / 1e6
+            self.sequence = 0
+            self._last_frame = time.time()
+            self.streaming = True
+        elif command == 'H':
+            self.streaming = False
+        elif command == 'K':
+            self.trip_limit[msg[1] - ord('0')] = (msg[2] << 8) + msg[3]
+
+    def update(self):
+        if not self.streaming:
+            return
+        now = time.time()
+        period = max(self.stream_period, 1e-4)
+        n_frames = int((now - self._last_frame) / period)
+        if n_frames < 1:
+            return
+        self._last_frame += n_frames * period
+        frames = np.zeros(n_frames, dtype=PMOD_FRAME)
+        frames['sequence'] = (self.sequence + np.arange(n_frames)) % 65536
+        frames['micros'] = ((now - self._start) * 1e6 - period * 1e6 * np.arange(n_frames)[::-1]).astype(np.int64)\
+            % 2 ** 32
+        readback = self.dac_codes * 1023 / 4096 * self.enabled
+        frames['voltage'] = readback
+        frames['current'] = readback + self.fault_current * self.enabled
+        frames['flags'] = PMOD_ENABLED * self.enabled
+        # Oracle::trip_check, the frame with the over-current reading already carries the trip flag
+        if self.enabled and np.any((self.trip_limit > 0) & (frames['current'][0] > self.trip_limit)):
+            self.enabled = False
+            self.tripped = True
+            self.dac_codes[:] = 0
+            frames['voltage'][1:] = 0
+            frames['current'][1:] = 0
+            frames['flags'] = PMOD_TRIPPED
+        elif self.tripped:
+            frames['flags'] |= PMOD_TRIPPED
+        self.sequence += n_frames
+        if self.drop_every > 0:
+            keep = (frames['sequence'] % self.drop_every) != 0
+            frames = frames[keep]
+        self.frames_sent += len(frames)
+        self.write(encode_frames(frames))
+
+
+class OutletEmulator(PtyEmulator):
+    """
+    Emulates the motor commands of the OutletControl.ino firmware. Every command is echoed back and positions are in
+    mm. Moves follow a trapezoidal velocity profile (velocity mm/s, acceleration mm/s/s).
+    While streaming the firmware pushes 'Z:<pos>,<busy>,<target>' every stream period and 'Z!<pos>' once a commanded
+    move is finished.
+    """
+    init_message = b'INIT\r\n'
+
+    def __init__(self, tick=0.001, velocity=20, acceleration=50):
+        super().__init__(tick)
+        self._msg = bytearray()
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.stream_period = 0
+        self.lines_pushed = 0
+        self._start_pos = 0
+        self._target = 0
+        self._move_start = time.time()
+        self._move_pending = False
+        self._last_stream = time.time()
+
+    def handle_bytes(self, data):
+        # Same as serialCheck, newlines always terminate the command
+        for byte in data:
+            if byte == ord('\n'):
+                self.interpret(self._msg.decode(errors='replace'))
+                self._msg = bytearray()
+            else:
+                self._msg.append(byte)
+
+    def write_line(self, text):
+        self.write(f"{text}\r\n".encode())
+
+    def get_position(self):
+        """
+        Returns the emulated motor position and whether it is still moving
+        :return: (float, bool)
+        """
+        distance = self._target - self._start_pos
+        elapsed = time.time() - self._move_start
+        travel = abs(distance)
+        # Distance covered after elapsed seconds of a trapezoidal (or triangular) move
+        peak = min(self.velocity, np.sqrt(travel * self.acceleration))
+        ramp = peak / self.acceleration
+        duration = ramp * 2 + (travel - peak * ramp) / peak if travel > 0 else 0
+        if elapsed >= duration:
+            return self._target, False
+        if elapsed < ramp:
+            covered = self.acceleration * elapsed ** 2 / 2
+        elif elapsed < duration - ramp:
+            covered = peak * ramp / 2 + peak * (elapsed - ramp)
+        else:
+            covered = travel - self.acceleration * (duration - elapsed) ** 2 / 2
+        return self._start_pos + np.sign(distance) * covered, True
+
+    def interpret(self, msg):
+        self.write_line(msg)
+        if len(msg) < 3 or msg[0] != 'M':
+            if msg[:1] == 'S':
+                self.write_line('Run')
+            return
+        command = msg[2]
+        if command == 'L' and msg[3:4] == '?':
+            self.write_line(f"L?{self.get_position()[0]:.3f}")
+        elif command == 'L':
+            # moveMotor, hardStop then goTo
+            self._start_pos = self.get_position()[0]
+            self._target = float(msg[3:13])
+            self._move_start = time.time()
+            self._move_pending = True
+            self.write_line('OK')
+        elif command == 'G':
+            self._start_pos = self._target = 0
+        elif command == 'T':
+            self.stream_period = int(msg[3:9]) / 1000
+            self._last_stream = time.time()
+            self.write_line('OK')
+
+    def update(self):
+        # OutletControl.ino streamCheck
+        if self.stream_period == 0:
+            return
+        pos, busy = self.get_position()
+        if self._move_pending and not busy:
+            self._move_pending = False
+            self.write_line(f"Z!{pos:.3f}")
+            self.lines_pushed += 1
+        if time.time() - self._last_stream >= self.stream_period:
+            self._last_stream = time.time()
+            self.write_line(f"Z:{pos:.3f},{int(busy)},{self._target:.3f}")
+            self.lines_pushed += 1
+
+
+class SpectraEmulator(PtyEmulator):
+    """
+    Emulates the byte protocol of a Lumencor Spectra light engine. Commands are binary frames ending with 0x50 and
+    have no response. The enabled channels and the 8 bit DAC level of each channel (0 is off, 255 is full on, the
+    inverse of the value on the wire) are kept for checking.
+    """
+    frame_sizes = {0x57: 4, 0x4F: 3, 0x53: 7}
+    enable_bits = {'red': 0, 'green': 1, 'cyan': 2, 'uv': 3, 'blue': 5, 'teal': 6}
+    dac_bits = {0x18: {'red': 3, 'green': 2, 'cyan': 1, 'uv': 0}, 0x1A: {'teal': 1, 'blue': 0}}
+
+    def __init__(self, tick=0.001):
+        super().__init__(tick)
+        self._msg = bytearray()
+        self.initialized = []
+        self.enabled = set()
+        self.levels = {label: 0 for label in self.enable_bits}
+        self.writes = 0
+        self.bad_frames = 0
+
+    def handle_bytes(self, data):
+        self.writes += 1
+        self._msg.extend(data)
+        while len(self._msg) > 0:
+            size = self.frame_sizes.get(self._msg[0])
+            if size is None:
+                # Unknown command byte, skip it
+                self.bad_frames += 1
+                del self._msg[0]
+                continue
+            if len(self._msg) < size:
+                return
+            frame = bytes(self._msg[:size])
+            del self._msg[:size]
+            if frame[-1] != 0x50:
+                self.bad_frames += 1
+                continue
+            self.interpret(frame)
+
+    def interpret(self, frame):
+        if frame[0] == 0x57:
+            self.initialized.append(frame[1:3])
+        elif frame[0] == 0x4F:
+            self.enabled = {label for label, bit in self.enable_bits.items() if not frame[1] & (1 << bit)}
+        elif frame[0] == 0x53:
+            # Byte 4 holds the high nibble (low bits), byte 5 the low nibble (high bits)
+            dac = ((frame[4] & 0x0F) << 4) | (frame[5] >> 4)
+            for label, bit in self.dac_bits.get(frame[1], {}).items():
+                if frame[3] & (1 << bit):
+                    self.levels[label] = 255 - dac
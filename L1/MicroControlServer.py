@@ -132,6 +132,10 @@ class MicroControl:
                                 'get_last': self.get_last,
                                 'set_exposure': self.set_exposure,
                                 'get_exposure': self.get_exposure,
+                                'set_binning': self.set_binning,
+                                'set_roi': self.set_roi,
+                                'clear_roi': self.clear_roi,
+                                'get_size': self.get_image_size,
                                 'get_name': self.get_camera_name}
 
         self.stage_commands = {'get_position': self.get_xy_position,
@@ -252,6 +256,27 @@ class MicroControl:
         """ Returns a float of the cameras exposure in milliseconds"""
         return self.mmc.getExposure()
 
+    def set_binning(self, args):
+        """ Sets the camera binning. Example: camera,set_binning,2 for 2x2 bins"""
+        bin_size = int(args[2])
+        self.mmc.setProperty(self.mmc.getCameraDevice(), 'Binning', '{}x{}'.format(bin_size, bin_size))
+        return 'Ok'
+
+    def set_roi(self, args):
+        """ Sets the camera ROI. Example: camera,set_roi,x,y,width,height in binned pixels"""
+        x, y, w, h = [int(float(v)) for v in args[2:6]]
+        self.mmc.setROI(x, y, w, h)
+        return 'Ok'
+
+    def clear_roi(self, args):
+        """ Sets the camera to read the full frame. Example: camera,clear_roi"""
+        self.mmc.clearROI()
+        return 'Ok'
+
+    def get_image_size(self, args):
+        """ Returns the image (height, width) in binned pixels. Example: camera,get_size"""
+        return self.mmc.getImageHeight(), self.mmc.getImageWidth()
+
     def start_continuous(self, args):
         """ Starts continuous camera acquisition, camera,start_continuous"""
         print("Starting Continuous Acquisition")
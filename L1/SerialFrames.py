@@ -0,0 +1,145 @@
+"""
+Binary frame formats for data streamed from the microcontroller firmware.
+
+Frames are fixed size, start with a two byte sync word and end with a 16 bit checksum (the sum of the bytes between
+the sync word and the checksum). Decoding is done with numpy so a whole serial read is converted in a single
+np.frombuffer pass instead of unpacking one value at a time.
+"""
+import numpy as np
+
+# PMOD_DAC.ino frame: ADC readback of the 8 voltage and 8 current monitor channels
+PMOD_SYNC = 0x5AA5
+PMOD_FRAME = np.dtype([('sync', '<u2'), ('sequence', '<u2'), ('micros', '<u4'),
+                       ('voltage', '<f4', (8,)), ('current', '<f4', (8,)), ('flags', '<u2'), ('checksum', '<u2')])
+PMOD_ENABLED = 0x01  # flags bit, the Bertan enable pin is high
+PMOD_TRIPPED = 0x02  # flags bit, the firmware over-current trip powered down the supply
+
+
+def frame_checksum(raw):
+    """
+    Returns the checksum for each row of raw frame bytes
+    :param raw: uint8 array (n_frames, frame_size)
+    :return: uint16 array (n_frames)
+    """
+    return (raw[:, 2:-2].sum(axis=1, dtype=np.uint32) & 0xFFFF).astype(np.uint16)
+
+
+def encode_frames(frames, frame_dtype=PMOD_FRAME, sync=PMOD_SYNC):
+    """
+    Fills in the sync and checksum fields and returns the frames as bytes (used by the firmware emulators)
+    :param frames: structured array of frame_dtype
+    :param frame_dtype: numpy dtype of the frame
+    :param sync: int, sync word
+    :return: bytes
+    """
+    frames = np.array(frames, dtype=frame_dtype)
+    frames['sync'] = sync
+    raw = frames.view(np.uint8).reshape(len(frames), frame_dtype.itemsize)
+    frames['checksum'] = frame_checksum(raw)
+    return frames.tobytes()
+
+
+class FrameDecoder:
+    """
+    Decodes a stream of fixed size binary frames. Bytes that don't form a complete frame are kept until the next
+    call. Corrupted or misaligned frames are skipped by searching for the next sync word.
+
+    bad_frames : number of frames (or garbage segments) that failed the sync or checksum test
+    dropped_frames : number of frames missing according to the frame sequence numbers
+    """
+
+    def __init__(self, frame_dtype=PMOD_FRAME, sync=PMOD_SYNC):
+        self.frame_dtype = frame_dtype
+        self.frame_size = frame_dtype.itemsize
+        self.sync = sync
+        self._sync_bytes = int(sync).to_bytes(2, 'little')
+        self._buffer = b''
+        self._last_sequence = None
+        self._last_micros = None
+        self._micros_offset = 0
+        self._first_micros = None
+        self.bad_frames = 0
+        self.dropped_frames = 0
+
+    def reset(self):
+        """
+        Clears the buffered bytes and the stream statistics
+        :return:
+        """
+        self.__init__(self.frame_dtype, self.sync)
+
+    def decode(self, byte_data):
+        """
+        Decodes all the complete frames in the buffered bytes and the incoming bytes
+        :param byte_data: bytes read from the serial port
+        :return: structured array of valid frames
+        """
+        buffer = self._buffer + bytes(byte_data)
+        decoded = []
+        position = 0
+        while True:
+            start = buffer.find(self._sync_bytes, position)
+            if start < 0:
+                # Keep the last byte in case it is the first half of a sync word
+                position = len(buffer) - 1 if buffer.endswith(self._sync_bytes[:1]) else len(buffer)
+                break
+            if start > position:
+                self.bad_frames += 1
+            n_frames = (len(buffer) - start) // self.frame_size
+            if n_frames == 0:
+                position = start
+                break
+            raw = np.frombuffer(buffer, dtype=np.uint8, count=n_frames * self.frame_size, offset=start)
+            raw = raw.reshape(n_frames, self.frame_size)
+            frames = raw.view(self.frame_dtype).reshape(n_frames)
+            valid = (frames['sync'] == self.sync) & (frames['checksum'] == frame_checksum(raw))
+            if valid.all():
+                decoded.append(frames)
+                position = start + n_frames * self.frame_size
+                continue
+            # Keep the good frames up to the first bad one and search for the next sync word after it
+            bad = int(np.argmin(valid))
+            decoded.append(frames[:bad])
+            self.bad_frames += 1
+            position = start + bad * self.frame_size + 1
+        self._buffer = buffer[position:]
+
+        if len(decoded) == 0:
+            return np.zeros(0, dtype=self.frame_dtype)
+        frames = np.concatenate(decoded)
+        self._count_dropped(frames)
+        return frames
+
+    def _count_dropped(self, frames):
+        """
+        Uses the 16 bit sequence numbers to count the frames that never arrived
+        :param frames: structured array
+        :return:
+        """
+        if len(frames) == 0:
+            return
+        sequence = frames['sequence'].astype(np.int64)
+        if self._last_sequence is not None:
+            sequence = np.concatenate([[self._last_sequence], sequence])
+        gaps = (np.diff(sequence) - 1) % 65536
+        self.dropped_frames += int(gaps.sum())
+        self._last_sequence = int(sequence[-1])
+
+    def get_time(self, frames):
+        """
+        Converts the firmware microsecond counter (which wraps every ~71 minutes) to seconds since the first frame
+        :param frames: structured array
+        :return: float array
+        """
+        micros = frames['micros'].astype(np.int64)
+        if len(micros) == 0:
+            return micros.astype(np.float64)
+        if self._first_micros is None:
+            self._first_micros = int(micros[0])
+            self._last_micros = int(micros[0])
+        previous = np.concatenate([[self._last_micros], micros[:-1]])
+        wraps = np.cumsum(micros < previous) * 2 ** 32
+        micros = micros + wraps + self._micros_offset
+        self._micros_offset += int(wraps[-1])
+        self._last_micros = int(frames['micros'][-1])
+        return (micros - self._first_micros) / 1e6
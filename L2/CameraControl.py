@@ -1,13 +1,39 @@
+import logging
+import multiprocessing as mp
 import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from L2.Utility import UtilityControl, UtilityFactory
+from L2.FramePool import Frame, FrameDispatcher, LATEST, LOSSLESS, SYNC
+from L2.FrameRing import FrameRing
+from L2.Preview import PreviewStream
 from L1.Controllers import ControllerAbstraction
 import time
 import numpy as np
 
+# Per-frame metadata of an acquired stack: frame index, stage position (NaN without positions) and time.time()
+STACK_METADATA = np.dtype([('index', np.int32), ('z', np.float64), ('time', np.float64)])
+
 class CameraAbstraction(ABC):
     """
     Utility class for controlling camera hardware
+
+    Acquired images are published as read-only frames (see L2.FramePool). Each callback gets its own delivery queue
+    and thread, so callbacks that save or display images don't slow down the acquisition.
+
+    Acquisition profiles are named readout settings (ROI, binning, exposure). Routines that only need part of the
+    image or a coarse image use a profile for their duration (with camera.use_profile('focus'): ...) so the camera
+    reads out and transfers fewer pixels.
+
+    Stacks (z-stacks, focus sweeps, bursts) are acquired with acquire_stack into one preallocated (N, H, W) array
+    instead of a snap() per image.
+
+    Live views use the preview stream (add_preview_callback, get_preview): small rate limited 8 bit images made from
+    the frames here, so full resolution frames only go to the recorders.
+
+    The presnap and postsnap functions switch the light sources with serial commands around every snap. An
+    illumination gate (see L2.Illumination, set_illumination) replaces them: the light channels are selected once and
+    a TTL line from the camera or a DAQ turns the light on for the exposure only.
     """
 
     def __init__(self, controller, role):
@@ -15,12 +41,22 @@ class CameraAbstraction(ABC):
         self.role = role
         self.exposure = 50
         self.bin_size = 1
-        self._callbacks = []
-        self._callback_tags = {}
+        self.frames = FrameDispatcher()
+        self._sequence = 0
+        self._last_frame = None
+        self.preview = PreviewStream(self)
         self._presnap_callbacks=[]
         self._postsnap_callbacks=[]
+        self.illumination = None  # L2.Illumination gate, replaces the presnap and postsnap functions when set
         self._last_image = []
         self.dimensions = [1,1] # Width and height of the image in pixels
+        self.sensor_dimensions = None  # Full frame size without binning [height, width], None until it is read
+        self.roi = None  # (x, y, width, height) of the readout in binned pixels, None is the full frame
+        # roi or center (fraction of the frame kept around the center), bin_size and exposure (None keeps the current)
+        self.profiles = {'full': {'roi': None, 'center': None, 'bin_size': 1, 'exposure': None},
+                         'focus': {'roi': None, 'center': 0.5, 'bin_size': 1, 'exposure': None},
+                         'detect': {'roi': None, 'center': None, 'bin_size': 2, 'exposure': None}}
+        self.active_profile = None
         self.update_frequency = 20  # How many times per second to check the camera
         self._last_image_lock = threading.RLock()
         # Continuous properties
@@ -49,28 +85,85 @@ class CameraAbstraction(ABC):
         """
         pass
 
-    def add_callback(self, function, tag="default"):
+    def add_callback(self, function, tag="default", policy=LOSSLESS):
         """
-        Add function to call during continuous acquisition
+        Add function to call with every new image (read-only np.ndarray). The function runs on its own thread.
         :param function:
+        :param tag: string identifier used to remove the callback
+        :param policy: 'lossless' delivers every image (saving), 'latest' only the newest image waiting for the
+        function (displays), 'sync' calls the function on the acquisition thread
         :return:
         """
-        self._callbacks.append(function)
-        if tag not in self._callback_tags.keys():
-            self._callback_tags[tag]=[]
-        self._callback_tags[tag].append(function)
-
+        self.frames.subscribe(function, policy, tag)
 
     def remove_callback(self, tag:str):
         """
-        Removes all callbacks with a given tag
+        Removes all callbacks with a given tag. Lossless callbacks finish the images already queued for them.
         :param tag: string identifier
         :return:
         """
-        if tag in self._callback_tags:
-            for fnc in self._callback_tags[tag]:
-                self._callbacks.pop(self._callbacks.index(fnc))
-        self._callback_tags[tag]=[]
+        self.frames.unsubscribe(tag)
+
+    def add_preview_callback(self, function, tag="default", policy=LATEST):
+        """
+        Add function to call with every preview image (read-only 8 bit np.ndarray at the display size). Previews
+        are rate limited, see set_preview.
+        :param function:
+        :param tag: string identifier used to remove the callback
+        :param policy: 'latest', 'lossless' or 'sync' (see add_callback)
+        :return:
+        """
+        self.preview.add_callback(function, tag, policy)
+
+    def remove_preview_callback(self, tag: str):
+        """
+        Removes all preview callbacks with a given tag
+        :param tag: string identifier
+        :return:
+        """
+        self.preview.remove_callback(tag)
+
+    def get_preview(self):
+        """
+        Returns the newest preview image, used by displays in other processes instead of the full image
+        :return: 8 bit np.ndarray or None
+        """
+        return self.preview.get_preview()
+
+    def set_preview(self, max_size=None, rate=None, percentiles=None, method=None):
+        """
+        Changes the preview settings, None keeps a setting
+        :param max_size: int, largest preview side in pixels
+        :param rate: float, maximum previews per second
+        :param percentiles: (low, high) percentiles of the pixels shown as black and white
+        :param method: 'bin' averages blocks of pixels, 'decimate' keeps every n-th pixel
+        :return:
+        """
+        self.preview.configure(max_size, rate, percentiles, method)
+
+    def _publish(self, img, timestamp=None, **metadata):
+        """
+        Sends a new image to the callbacks and keeps it as the last image. The image is not copied, the camera
+        must not write to it afterwards.
+        :param img: np.ndarray or a Frame from the frame pool
+        :param timestamp: float, time.time() of the image (None for now)
+        :param metadata: stored with the frame
+        :return: Frame
+        """
+        if isinstance(img, Frame):
+            frame = img
+        else:
+            frame = Frame(img, sequence=self._sequence, timestamp=timestamp, metadata=metadata)
+        self._sequence = frame.sequence + 1
+        with self._last_image_lock:
+            previous = self._last_frame
+            self._last_frame = frame.acquire()
+            self._last_image = frame.image
+        if previous is not None:
+            previous.release()
+        self.frames.publish(frame)
+        frame.release()
+        return frame
 
     def _update_callbacks(self, img):
         """
@@ -78,9 +171,7 @@ class CameraAbstraction(ABC):
         :param img: image (np.ndarray) to send to the callback functions
         :return:
         """
-
-        for fnc in self._callbacks:
-            fnc(img)
+        self._publish(img)
         return True
 
 
@@ -101,6 +192,14 @@ class CameraAbstraction(ABC):
         """
         pass
 
+    def set_roi(self, roi):
+        """
+        Sets the region of the sensor that is read out
+        :param roi: (x, y, width, height) in binned pixels, None reads the full frame
+        :return:
+        """
+        pass
+
     def get_exposure(self):
         """
         Returns the camera's current exposure setting
@@ -108,6 +207,163 @@ class CameraAbstraction(ABC):
         """
         pass
 
+    def add_profile(self, name, roi=None, bin_size=1, exposure=None, center=None):
+        """
+        Adds (or replaces) a named acquisition profile
+        :param name: str
+        :param roi: (x, y, width, height) in binned pixels, None for the full frame
+        :param bin_size: int
+        :param exposure: float, ms (None keeps the exposure that is set when the profile is applied)
+        :param center: float, fraction of the frame width and height to read around the center (instead of roi)
+        :return:
+        """
+        self.profiles[name] = {'roi': roi, 'center': center, 'bin_size': bin_size, 'exposure': exposure}
+
+    def get_center_roi(self, fraction, bin_size=None):
+        """
+        Returns the ROI with a fraction of the frame width and height around the center of the sensor
+        :param fraction: float, 0 to 1
+        :param bin_size: int, binning the ROI is for (None for the current binning)
+        :return: (x, y, width, height) in binned pixels
+        """
+        if self.sensor_dimensions is None:
+            raise ValueError(f"The {self.role} sensor size is unknown, a center ROI can't be calculated")
+        bin_size = self.bin_size if bin_size is None else bin_size
+        height, width = [int(d) // bin_size for d in self.sensor_dimensions]
+        roi_w, roi_h = max(1, int(width * fraction)), max(1, int(height * fraction))
+        return (width - roi_w) // 2, (height - roi_h) // 2, roi_w, roi_h
+
+    def get_settings(self):
+        """
+        Returns the current readout settings as a profile
+        :return: dict
+        """
+        return {'roi': self.roi, 'center': None, 'bin_size': self.bin_size, 'exposure': self.exposure}
+
+    def apply_profile(self, profile):
+        """
+        Applies an acquisition profile. Only the settings that differ from the current ones are sent to the camera,
+        a continuous acquisition is restarted if the readout size changes.
+        :param profile: str (name of a profile) or dict (see get_settings)
+        :return:
+        """
+        name = profile if type(profile) is str else None
+        settings = self.profiles[profile] if name is not None else profile
+        bin_size = settings['bin_size'] if settings['bin_size'] is not None else self.bin_size
+        roi = settings['roi']
+        if settings.get('center') is not None:
+            if self.sensor_dimensions is None:
+                # A center ROI of an unknown sensor would be a guess, read the full frame instead
+                logging.warning(f"{self.role} sensor size is unknown, profile {name} reads the full frame")
+            else:
+                roi = self.get_center_roi(settings['center'], bin_size)
+        roi = tuple(roi) if roi is not None else None
+
+        readout_change = bin_size != self.bin_size or roi != self.roi
+        running = readout_change and self._continuous_running.is_set()
+        if running:
+            self.stop()
+        if bin_size != self.bin_size:
+            self.set_binning(bin_size)
+        if roi != self.roi:
+            self.set_roi(roi)
+        if settings['exposure'] is not None and float(settings['exposure']) != float(self.exposure):
+            self.set_exposure(settings['exposure'])
+        if running:
+            self.continuous_snap()
+        self.active_profile = name
+
+    @contextmanager
+    def use_profile(self, profile):
+        """
+        Applies a profile for the duration of a with block and restores the previous settings afterwards
+        :param profile: str or dict
+        :return:
+        """
+        previous, previous_name = self.get_settings(), self.active_profile
+        self.apply_profile(profile)
+        try:
+            yield self
+        finally:
+            self.apply_profile(previous)
+            self.active_profile = previous_name
+
+    def acquire_stack(self, positions=None, n_frames=None, move=None, settle=0, trigger=None, publish=False):
+        """
+        Acquires a stack of images into one (N, H, W) array. With positions, move(position) is called and the camera
+        waits settle seconds before each image (a z-stack or a focus sweep), otherwise n_frames images are taken as
+        fast as the camera allows.
+
+        This implementation snaps each image, cameras with a sequence acquisition override it.
+        :param positions: list of stage positions, one image per position
+        :param n_frames: int, number of images when there are no positions
+        :param move: function object, moves the stage to a position
+        :param settle: float, seconds to wait after each move
+        :param trigger: function object, exposes one image on a camera in an external trigger mode (ie a DAQ pulse).
+        Only used by cameras that support triggered sequences.
+        :param publish: bool, also send each image to the callbacks
+        :return: (np.ndarray (N, H, W), np.ndarray of STACK_METADATA)
+        """
+        positions, metadata = self._prepare_stack(positions, n_frames)
+        stack = None
+        for index in range(len(metadata)):
+            self._move_stack(positions, index, move, settle)
+            img = self.snap()
+            metadata['time'][index] = time.time()
+            stack = self._store_stack_image(stack, metadata, index, img, publish)
+        return stack, metadata
+
+    @staticmethod
+    def _prepare_stack(positions, n_frames):
+        """
+        Returns the positions and the metadata array of a stack
+        :param positions: list or None
+        :param n_frames: int or None
+        :return: (np.ndarray or None, np.ndarray of STACK_METADATA)
+        """
+        if positions is not None:
+            positions = np.asarray(positions, dtype=float)
+            n_frames = len(positions)
+        assert n_frames is not None and n_frames > 0, "A stack needs positions or a number of frames"
+        metadata = np.zeros(n_frames, dtype=STACK_METADATA)
+        metadata['index'] = np.arange(n_frames)
+        metadata['z'] = positions if positions is not None else np.nan
+        return positions, metadata
+
+    @staticmethod
+    def _move_stack(positions, index, move, settle):
+        """ Moves to the position of an image in the stack """
+        if positions is not None and move is not None:
+            move(positions[index])
+        if settle > 0:
+            time.sleep(settle)
+
+    def _store_stack_image(self, stack, metadata, index, img, publish=False):
+        """
+        Copies an image into the stack, the stack is allocated from the first image's size and dtype
+        :param stack: np.ndarray or None
+        :param metadata: np.ndarray of STACK_METADATA
+        :param index: int, position of the image in the stack
+        :param img: np.ndarray
+        :param publish: bool, send the stack image to the callbacks
+        :return: np.ndarray, the stack
+        """
+        if stack is None:
+            stack = np.empty((len(metadata), *np.shape(img)), dtype=np.asarray(img).dtype)
+        stack[index] = img
+        if publish:
+            # The stack image is not written again, the frame shares it
+            self._publish(stack[index], metadata['time'][index], stack_index=index, z=metadata['z'][index])
+        return stack
+
+    def get_ring_name(self):
+        """
+        Returns the shared memory name of the camera's frame ring, other processes can attach to it with
+        FrameRing.attach. Only cameras that run in their own process have a ring.
+        :return: str or None
+        """
+        return None
+
     def get_last_image(self):
         """
         Returns the last image from the camera
@@ -140,17 +396,23 @@ class CameraAbstraction(ABC):
 
     def presnap(self):
         """
-        Calls presnap functions
+        Calls presnap functions, or opens the illumination gate
         :return:
         """
+        if self.illumination is not None:
+            self.illumination.open()
+            return
         for fnc,args,kwargs in self._presnap_callbacks:
             fnc(*args, **kwargs)
 
     def postsnap(self):
         """
-        Calls postsnap functions
+        Calls postsnap functions, or closes the illumination gate
         :return:
         """
+        if self.illumination is not None:
+            self.illumination.close()
+            return
         for fnc, args, kwargs in self._postsnap_callbacks:
             fnc(*args, **kwargs)
 
@@ -170,6 +432,34 @@ class CameraAbstraction(ABC):
         """
         self._postsnap_callbacks.append([fnc, args, kwargs])
 
+    def set_illumination(self, gate=None, channels=None, intensity=None):
+        """
+        Gates the light with the exposure instead of calling the presnap and postsnap functions
+        :param gate: L2.Illumination.IlluminationGate, None goes back to the presnap and postsnap functions
+        :param channels: list of light channels to arm the gate with
+        :param intensity: float, 0 to 1, level of the armed channels (see IlluminationGate.arm)
+        :return:
+        """
+        if self.illumination is not None and self.illumination is not gate:
+            self.illumination.disarm()
+        self.illumination = gate
+        if gate is not None:
+            gate.arm(channels, intensity)
+
+    def snap_channels(self, channels):
+        """
+        Takes one image per set of light channels. The gate only switches the channel selection between the images,
+        the light itself is gated by the exposure.
+        :param channels: list of channel lists (ie [['cyan'], ['green', 'red']])
+        :return: list of np.ndarray, one image per channel set
+        """
+        assert self.illumination is not None, "Multi-channel snaps need an illumination gate, see set_illumination"
+        images = []
+        for channel in channels:
+            self.illumination.arm(channel)
+            images.append(self.snap())
+        return images
+
 class PycromanagerControl(CameraAbstraction, UtilityControl):
     """
     Utility class for controlling camera hardware using Micromanager via Pycromanager library
@@ -177,6 +467,10 @@ class PycromanagerControl(CameraAbstraction, UtilityControl):
     def __init__(self, controller, role):
         super().__init__(controller, role)
         self._dev_name = "NA"
+        self._sequence_start = 0
+        self._last_image_number = None
+        self._overflowed = False
+        self.sequence_statistics = {'received': 0, 'dropped': 0, 'overflows': 0}
 
     def snap(self):
         """
@@ -188,11 +482,7 @@ class PycromanagerControl(CameraAbstraction, UtilityControl):
         img = self.controller.send_command(self.controller.core.get_image)
         self.postsnap()
         img = self._reshape(img)
-        self._last_image = img.copy()
-        self._update_callbacks(self._last_image)
-        with self._last_image_lock:
-            self._last_image = img[:]
-        return img
+        return self._publish(img).image
 
 
     def _get_running(self):
@@ -207,43 +497,192 @@ class PycromanagerControl(CameraAbstraction, UtilityControl):
 
     def get_last(self):
         """
-        Returns a copy of the most recent image that was acquired
+        Returns the most recent image that was acquired (read-only)
         :return:
         """
         with self._last_image_lock:
-            return self._last_image[:]
+            return self._last_image
 
-    def continuous_snap(self):
+    def continuous_snap(self, interval=1.0):
         """
-        Start continuous acquisition from the camera.
+        Start continuous acquisition from the camera. Every image the camera puts in the Micromanager circular buffer
+        is sent to the callbacks, see get_sequence_statistics for the images that were dropped.
+        :param interval: float, ms between images (the camera runs as fast as the exposure allows if it is shorter)
         :return:
         """
         if not self._get_running():
-            print("HEYYOO")
-            self.controller.send_command(self.controller.core.start_continuous_sequence_acquisition, args=(1.0,))
+            self.sequence_statistics = {'received': 0, 'dropped': 0, 'overflows': 0}
+            self._last_image_number = None
+            self._overflowed = False
+            self._sequence_start = time.time()
+            self.controller.send_command(self.controller.core.start_continuous_sequence_acquisition,
+                                         args=(float(interval),))
             self._continuous_running.set()
-            self._continuous_thread = threading.Thread(target=self._sequence_update)
+            self._continuous_thread = threading.Thread(target=self._sequence_update, name='CameraSequence')
             self._continuous_thread.start()
 
         return True
 
     def _sequence_update(self):
         """
-        Reads the continuous acquisition buffer and sends the images to the functions
+        Drains the continuous acquisition buffer every 1/update_frequency seconds and sends the images to the functions
         listed inside the callback list.
         :return:
         """
-        st = time.time()
+        period = 1 / self.update_frequency
+        deadline = time.time()
         while self._continuous_running.is_set():
-            images_ready = self.controller.send_command(self.controller.core.get_remaining_image_count)
-            if images_ready > 0:
-                img = self.controller.send_command(self.controller.core.get_last_image)
-                img = self._reshape(img)
-                self._update_callbacks(img)
-                with self._last_image_lock:
-                    self._last_image = img[:]
-            # Sleep until the next update time point
-            time.sleep((time.time() - st) % (1 / self.update_frequency))
+            self._drain_buffer()
+            # Sleep until the next update time point, if the drain took longer than a period start again from now
+            deadline += period
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                deadline = time.time()
+        # Images that arrived before the acquisition was stopped
+        self._drain_buffer()
+
+    def _drain_buffer(self):
+        """
+        Pops every image waiting in the circular buffer. The core is called directly under the controller lock,
+        send_command sleeps after every call which would limit the frame rate.
+        :return: int, number of images read
+        """
+        core = self.controller.core
+        count = 0
+        with self.controller.lock:
+            while core.get_remaining_image_count() > 0:
+                tagged = core.pop_next_tagged_image()
+                self._publish_tagged(tagged)
+                count += 1
+            overflowed = core.is_buffer_overflowed()
+            if overflowed and not self._overflowed:
+                # Images were overwritten before they were read, they are counted from the image numbers
+                self.sequence_statistics['overflows'] += 1
+                logging.warning(f"{self.role} circular buffer overflowed, images were dropped")
+            self._overflowed = overflowed
+        return count
+
+    def _publish_tagged(self, tagged):
+        """
+        Publishes an image from the sequence buffer with its sequence number and camera timestamp
+        :param tagged: TaggedImage with pix and tags
+        :return:
+        """
+        img, image_number, elapsed, timestamp = self._read_tagged(tagged)
+        if image_number is not None:
+            if self._last_image_number is not None and image_number > self._last_image_number + 1:
+                self.sequence_statistics['dropped'] += image_number - self._last_image_number - 1
+            self._last_image_number = image_number
+        self.sequence_statistics['received'] += 1
+        self._publish(img, timestamp, image_number=image_number, elapsed_ms=elapsed)
+
+    def _read_tagged(self, tagged):
+        """
+        Returns the image of a TaggedImage with its camera image number and time
+        :param tagged: TaggedImage with pix and tags
+        :return: (np.ndarray, int or None, elapsed ms or None, time.time() of the image or None)
+        """
+        tags = tagged.tags
+        try:
+            img = np.reshape(tagged.pix, [int(tags['Height']), int(tags['Width'])])
+        except (KeyError, TypeError, ValueError):
+            img = self._reshape(tagged.pix)
+        image_number = tags.get('ImageNumber')
+        image_number = int(image_number) if image_number is not None else None
+        elapsed = tags.get('ElapsedTime-ms')
+        timestamp = self._sequence_start + float(elapsed) / 1000 if elapsed is not None else None
+        return img, image_number, elapsed, timestamp
+
+    def acquire_stack(self, positions=None, n_frames=None, move=None, settle=0, trigger=None, publish=False):
+        """
+        Acquires a stack of images into one (N, H, W) array, see CameraAbstraction.acquire_stack.
+
+        Without positions the images are a Micromanager sequence acquisition (a burst limited by the camera readout).
+        With positions and a trigger function the camera runs a sequence as well and trigger() exposes each image
+        after the move, the camera must already be in an external trigger mode. Otherwise each image is snapped after
+        its move. The core is called directly under the controller lock. The presnap/postsnap functions (ie the
+        illumination) run once for a sequence and around each image of a snapped stack, so the light is off while the
+        stage moves and settles.
+        A continuous acquisition is stopped for the stack and started again afterwards.
+        :return: (np.ndarray (N, H, W), np.ndarray of STACK_METADATA)
+        """
+        positions, metadata = self._prepare_stack(positions, n_frames)
+        running = self._continuous_running.is_set()
+        if running:
+            self.stop()
+        try:
+            if positions is None or trigger is not None:
+                self.presnap()
+                try:
+                    stack = self._sequence_stack(positions, metadata, move, settle, trigger, publish)
+                finally:
+                    self.postsnap()
+            else:
+                stack = self._snapped_stack(positions, metadata, move, settle, publish)
+        finally:
+            if running:
+                self.continuous_snap()
+        return stack, metadata
+
+    def _snapped_stack(self, positions, metadata, move, settle, publish):
+        """ Moves and snaps each image of the stack, the presnap/postsnap functions run around each snap """
+        core = self.controller.core
+        stack = None
+        for index in range(len(metadata)):
+            self._move_stack(positions, index, move, settle)
+            self.presnap()
+            try:
+                with self.controller.lock:
+                    core.snap_image()
+                    img = core.get_image()
+            finally:
+                self.postsnap()
+            metadata['time'][index] = time.time()
+            stack = self._store_stack_image(stack, metadata, index, self._reshape(img), publish)
+        return stack
+
+    def _sequence_stack(self, positions, metadata, move, settle, trigger, publish):
+        """ Reads the stack from a sequence acquisition of len(metadata) images """
+        core = self.controller.core
+        n_frames = len(metadata)
+        # An image that isn't in the buffer after 10 exposures (at least 1 s) is not coming
+        timeout = max(1., self.exposure / 100)
+        stack = None
+        self._sequence_start = time.time()
+        with self.controller.lock:
+            core.start_sequence_acquisition(n_frames, 0., True)
+        try:
+            for index in range(n_frames):
+                if trigger is not None:
+                    self._move_stack(positions, index, move, settle)
+                    trigger()
+                deadline = time.time() + timeout
+                while True:
+                    with self.controller.lock:
+                        tagged = core.pop_next_tagged_image() if core.get_remaining_image_count() > 0 else None
+                    if tagged is not None:
+                        break
+                    if time.time() > deadline:
+                        raise TimeoutError(f"{self.role} stack image {index} of {n_frames} was not acquired")
+                    time.sleep(0.001)
+                img, _, _, timestamp = self._read_tagged(tagged)
+                metadata['time'][index] = time.time() if timestamp is None else timestamp
+                stack = self._store_stack_image(stack, metadata, index, img, publish)
+        finally:
+            with self.controller.lock:
+                if core.is_sequence_running():
+                    core.stop_sequence_acquisition()
+        return stack
+
+    def get_sequence_statistics(self):
+        """
+        Returns the number of images received and dropped during the last continuous acquisition
+        :return: dict with 'received', 'dropped' (missing camera image numbers) and 'overflows' (number of times the
+        circular buffer overflowed)
+        """
+        return dict(self.sequence_statistics)
 
     def stop(self):
         """
@@ -269,6 +708,7 @@ class PycromanagerControl(CameraAbstraction, UtilityControl):
         """
         exposure = float(exposure)
         self.controller.send_command(self.controller.core.set_exposure, args=(exposure,))
+        self.exposure = exposure
         return True
 
     def get_exposure(self):
@@ -291,9 +731,31 @@ class PycromanagerControl(CameraAbstraction, UtilityControl):
             self.controller.send_command(self.controller.core.set_property,
                                          args=(self._dev_name, "Binning", bins[bin_size]))
             self.bin_size=bin_size
+            # Micromanager resets the ROI when the binning changes
+            self.roi = None
+            self._update_dimensions()
         else:
             logging.warning("Binning not possible with test configuration")
 
+    def set_roi(self, roi):
+        """
+        Sets the region of the sensor that is read out
+        :param roi: (x, y, width, height) in binned pixels, None reads the full frame
+        :return:
+        """
+        if roi is None:
+            self.controller.send_command(self.controller.core.clear_roi)
+        else:
+            self.controller.send_command(self.controller.core.set_roi, args=tuple(int(v) for v in roi))
+        self.roi = tuple(roi) if roi is not None else None
+        self._update_dimensions()
+
+    def _update_dimensions(self):
+        """ Reads the image size after the readout settings changed """
+        h = self.controller.send_command(self.controller.core.get_image_height)
+        w = self.controller.send_command(self.controller.core.get_image_width)
+        self.dimensions = [h, w]
+
     def startup(self):
         """
         Function to call on startup.
@@ -303,6 +765,7 @@ class PycromanagerControl(CameraAbstraction, UtilityControl):
         w = self.controller.send_command(self.controller.core.get_image_width)
         self._dev_name = self.controller.send_command(self.controller.get_device_name, args=('camera',))
         self.dimensions = [h,w]
+        self.sensor_dimensions = [h * self.bin_size, w * self.bin_size]
         self.get_exposure()
         return True
 
@@ -357,10 +820,13 @@ class MicroManagerCamera(CameraAbstraction, UtilityControl):
         :return:
         """
 
+        period = 1 / self.update_frequency
         while self._continuous_running.is_set():
             image = self.controller.send_command('camera,get_last\n')
-            for func in self._callbacks:
-                func(image)
+            # The circular buffer is empty until the first image of the sequence arrives
+            if image is not None:
+                self._publish(image)
+            time.sleep(period)
 
     def stop(self):
         """
@@ -377,6 +843,29 @@ class MicroManagerCamera(CameraAbstraction, UtilityControl):
         :return:
         """
         self.controller.send_command('camera,set_exposure,{}\n'.format(exposure))
+        self.exposure = float(exposure)
+
+    def set_binning(self, bin_size: int):
+        """
+        Sets the camera bin size (1, 2, 4 or 8)
+        :param bin_size:
+        :return:
+        """
+        self.controller.send_command('camera,set_binning,{}\n'.format(int(bin_size)))
+        self.bin_size = bin_size
+        self.roi = None
+
+    def set_roi(self, roi):
+        """
+        Sets the region of the sensor that is read out
+        :param roi: (x, y, width, height) in binned pixels, None reads the full frame
+        :return:
+        """
+        if roi is None:
+            self.controller.send_command('camera,clear_roi\n')
+        else:
+            self.controller.send_command('camera,set_roi,{},{},{},{}\n'.format(*[int(v) for v in roi]))
+        self.roi = tuple(roi) if roi is not None else None
 
     def get_exposure(self):
         """
@@ -387,10 +876,18 @@ class MicroManagerCamera(CameraAbstraction, UtilityControl):
 
     def startup(self):
         """
-        Set exposure to 100 on start up
+        Set exposure to 100 on start up and read the image size
         :return:
         """
         self.set_exposure(100)
+        size = self.controller.send_command('camera,get_size\n')
+        try:
+            h, w = [int(v) for v in size]
+        except (TypeError, ValueError):
+            logging.warning(f"Could not read the {self.role} image size: {size}")
+            return
+        self.dimensions = [h, w]
+        self.sensor_dimensions = [h * self.bin_size, w * self.bin_size]
 
     def shutdown(self):
         """
@@ -407,13 +904,322 @@ class MicroManagerCamera(CameraAbstraction, UtilityControl):
         return {'camera': self._continuous_running.is_set()}
 
 
+class CameraProcess(CameraAbstraction, UtilityControl):
+    """
+    Camera that runs in its own process. The worker process owns the camera driver (its own Pycromanager bridge to
+    the running Micromanager) and writes every image into a shared memory FrameRing. This process attaches to the
+    ring and publishes the frames without copying them, so image transfer and deserialization don't compete with
+    the rest of the system for the GIL.
+
+    Commands (exposure, binning, acquisition...) are sent to the worker through a pipe. The presnap and postsnap
+    functions run in this process because they use the other utilities.
+    Use the config setting 'process,true' on the camera line to run a Pycromanager camera in a worker process.
+    """
+    ring_slots = 32
+
+    def __init__(self, controller, role, build=None, build_args=None):
+        """
+        :param controller: ControllerAbstraction, the controller the camera is configured on
+        :param role: str
+        :param build: function object run in the worker to create the camera, build(*build_args) (None builds a
+        PycromanagerControl from the controller port and config)
+        :param build_args: tuple
+        """
+        super().__init__(controller, role)
+        if build is None:
+            build, build_args = build_pycromanager_camera, (role, controller.port, controller._config)
+        self._build = build
+        self._build_args = build_args
+        self._process = None
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self.ring = None
+        self._read_sequence = 0
+        self._drain_lock = threading.Lock()  # the reader thread and snap both drain the ring
+        self._reader_running = threading.Event()
+        self._reader_thread = threading.Thread()
+
+    def startup(self):
+        """
+        Starts the worker process and attaches to its frame ring
+        :return:
+        """
+        if self._process is not None and self._process.is_alive():
+            return True
+        self._conn, worker_conn = mp.Pipe()
+        self._process = mp.Process(target=camera_worker, args=(worker_conn, self._build, self._build_args,
+                                                               self.ring_slots),
+                                   name=f'CameraProcess {self.role}', daemon=True)
+        self._process.start()
+        ring_name, state = self._receive()
+        self._update_state(state)
+        self.ring = FrameRing.attach(ring_name, reader=0)
+        self._read_sequence = self.ring.latest() + 1
+        self._reader_running.set()
+        self._reader_thread = threading.Thread(target=self._read_ring, name=f'CameraRing {self.role}', daemon=True)
+        self._reader_thread.start()
+        return True
+
+    def _receive(self):
+        status, response, state = self._conn.recv()
+        if status == 'error':
+            raise response
+        return response, state
+
+    def _call(self, command, *args, **kwargs):
+        """
+        Runs a camera method in the worker process
+        :param command: str, method name
+        :return: the method's return value
+        """
+        with self._conn_lock:
+            self._conn.send((command, args, kwargs))
+            response, state = self._receive()
+        self._update_state(state)
+        return response
+
+    def _update_state(self, state):
+        """ Copies the readout settings of the worker's camera """
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    def _read_ring(self):
+        """
+        Publishes the new frames in the ring every 1/update_frequency seconds
+        :return:
+        """
+        period = 1 / self.update_frequency
+        while self._reader_running.is_set():
+            self._drain_ring()
+            time.sleep(period)
+        self._drain_ring()
+
+    def _drain_ring(self):
+        """
+        Publishes every frame written since the last drain. The frames share the ring memory and hold their slot
+        until the callbacks release them.
+        :return: int, number of frames published
+        """
+        count = 0
+        with self._drain_lock:
+            latest = self.ring.latest()
+            while self._read_sequence <= latest:
+                frame = self.ring.get_frame(self._read_sequence)
+                self._read_sequence += 1
+                if frame is not None:
+                    self._publish(frame)
+                    count += 1
+        return count
+
+    def snap(self):
+        """
+        Take one image from the camera and return the image
+        :return:
+        """
+        self.presnap()
+        try:
+            sequence = self._call('snap')
+        finally:
+            self.postsnap()
+        self._drain_ring()
+        with self._last_image_lock:
+            if self._last_frame is not None and self._last_frame.sequence == sequence:
+                return self._last_image
+        frame = self.ring.get(sequence)
+        return frame[0] if frame is not None else None
+
+    def continuous_snap(self, *args):
+        """
+        Start continuous acquisition in the worker process
+        :return:
+        """
+        self._call('continuous_snap', *args)
+        self._continuous_running.set()
+        return True
+
+    def stop(self):
+        """
+        Stops the continuous acquisition
+        :return:
+        """
+        self._call('stop')
+        self._continuous_running.clear()
+        return True
+
+    def acquire_stack(self, positions=None, n_frames=None, move=None, settle=0, trigger=None, publish=False):
+        """
+        Acquires a stack of images, see CameraAbstraction.acquire_stack. Bursts run in the worker process, stacks
+        that move a stage snap each image from here.
+        :return: (np.ndarray (N, H, W), np.ndarray of STACK_METADATA)
+        """
+        if positions is not None or trigger is not None:
+            return super().acquire_stack(positions, n_frames, move, settle, trigger, publish)
+        self.presnap()
+        try:
+            return self._call('acquire_stack', n_frames=n_frames)
+        finally:
+            self.postsnap()
+
+    def set_exposure(self, exposure: int):
+        """
+        Set the exposure in milliseconds
+        :param exposure:
+        :return:
+        """
+        return self._call('set_exposure', exposure)
+
+    def get_exposure(self):
+        """
+        Returns the camera's current exposure setting
+        :return:
+        """
+        return self._call('get_exposure')
+
+    def set_binning(self, bin_size: int):
+        """
+        Sets the bin size for the camera
+        :param bin_size:
+        :return:
+        """
+        return self._call('set_binning', bin_size)
+
+    def set_roi(self, roi):
+        """
+        Sets the region of the sensor that is read out
+        :param roi: (x, y, width, height) in binned pixels, None reads the full frame
+        :return:
+        """
+        return self._call('set_roi', roi)
+
+    def get_ring_name(self):
+        """
+        Returns the shared memory name of the frame ring
+        :return: str
+        """
+        return self.ring.name if self.ring is not None else None
+
+    def get_ring_statistics(self):
+        """
+        Returns the frames written to the ring by the worker and the frames it dropped because the ring was full
+        :return: dict
+        """
+        return self.ring.get_statistics()
+
+    def get_status(self):
+        """
+        Returns whether the continuous sequence is acquiring
+        :return:
+        """
+        return self._call('get_status')
+
+    def shutdown(self):
+        """
+        Stops the acquisition and the worker process
+        :return:
+        """
+        if self._process is None:
+            return True
+        try:
+            self._call('close')
+        except (EOFError, OSError, BrokenPipeError):
+            pass
+        self._reader_running.clear()
+        if self._reader_thread.is_alive():
+            self._reader_thread.join()
+        self._process.join(5)
+        self._process = None
+        self._continuous_running.clear()
+        with self._last_image_lock:
+            if self._last_frame is not None:
+                self._last_frame.release()
+            self._last_frame = None
+        self.ring.close()
+        return True
+
+
+def build_pycromanager_camera(role, port, config):
+    """
+    Creates a Pycromanager camera in the worker process. Micromanager already has the configuration loaded, so the
+    controller only opens a new bridge to it.
+    :param role: str
+    :param port: controller port
+    :param config: str, Micromanager config file
+    :return: PycromanagerControl
+    """
+    from L1.Controllers import PycromanagerController
+    return PycromanagerControl(PycromanagerController(port, config), role)
+
+
+def camera_worker(conn, build, build_args, slots=32):
+    """
+    Runs a camera in a worker process. Every image the camera publishes is written into a FrameRing, the commands
+    from the pipe are ('method', args, kwargs) and each gets a ('ok' or 'error', response, readout settings) reply.
+    :param conn: multiprocessing Connection
+    :param build: function object that creates the camera
+    :param build_args: tuple
+    :param slots: int, number of images in the ring
+    :return:
+    """
+    camera, ring = None, None
+    # Sequence of the last frame each acquisition thread wrote (None if the ring dropped it)
+    written = threading.local()
+
+    def write(img):
+        written.sequence = ring.write(img)
+
+    def state():
+        return {'exposure': camera.exposure, 'bin_size': camera.bin_size, 'roi': camera.roi,
+                'dimensions': list(camera.dimensions), 'sensor_dimensions': camera.sensor_dimensions}
+
+    try:
+        camera = build(*build_args)
+        camera.startup()
+        dtype = camera.snap().dtype
+        ring = FrameRing(slots=slots, shape=[int(d) for d in camera.sensor_dimensions], dtype=dtype, readers=1)
+        camera.add_callback(write, tag='ring', policy=SYNC)
+        conn.send(('ok', ring.name, state()))
+    except Exception as e:
+        conn.send(('error', e, {}))
+        return
+
+    while True:
+        try:
+            command, args, kwargs = conn.recv()
+        except EOFError:
+            command, args, kwargs = 'close', (), {}
+        if command == 'close':
+            try:
+                camera.shutdown()
+            finally:
+                ring.close()
+            try:
+                conn.send(('ok', None, state()))
+            except (OSError, BrokenPipeError):
+                pass
+            return
+        try:
+            written.sequence = None
+            response = getattr(camera, command)(*args, **kwargs)
+            if command == 'snap':
+                # The image is in the ring, only its sequence number goes back. The ring callback runs on this
+                # thread, frames written by a running acquisition don't count.
+                if written.sequence is None:
+                    raise RuntimeError("Snapped image was dropped, every frame ring slot is held by a reader")
+                response = written.sequence
+            conn.send(('ok', response, state()))
+        except Exception as e:
+            conn.send(('error', e, state()))
+
+
 class CameraFactory(UtilityFactory):
     """ Determines the type of Camera Utility to return based off the controller being used"""
 
-    def build_object(self, controller, role, *args):
+    def build_object(self, controller, role, *args, **kwargs):
         if controller.id == 'micromanager':
             return MicroManagerCamera(controller, role)
         elif controller.id == "pycromanager":
+            if str(kwargs.get('process', False)).lower() == 'true':
+                return CameraProcess(controller, role)
             return PycromanagerControl(controller, role)
         else:
             return None
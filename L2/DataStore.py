@@ -0,0 +1,811 @@
+"""
+Array backed storage for the data streams coming off of the DAQ (detector and high voltage readbacks).
+
+Data is stored as rows, where each column corresponds to a named signal (for example 'time_data' and 'rfu').
+The first column is always the time column and is expected to increase monotonically.
+
+ArrayStore : Preallocated in-memory store that grows by doubling its capacity
+MemoryMappedStore : Keeps a recent window in RAM and spills every sample to a chunked memory-mapped file on disk
+MinMaxPyramid : Multi-resolution min/max summary of a column used to plot long traces with a fixed number of points
+TimebaseAligner : Resamples one stream onto the sample times of another as the data arrives
+"""
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+class DataStoreAbstraction(ABC):
+    """
+    Storage class for timestamped, multi-column data that is appended to during an acquisition.
+
+    append : adds rows (or columns) of incoming data to the store
+    get_data : returns the full record as a dictionary of 1-D arrays
+    get_recent : returns the last n samples as a dictionary of 1-D arrays
+    get_latest : returns the last value of a column
+    get_range : returns the samples between two time points
+    get_envelope : returns at most n display points for a time range using a min/max pyramid
+    add_listener : calls a function with every block of appended data
+    clear : removes all the data from the store
+    """
+    pyramid_min_level = 0  # finest pyramid level kept by the store (see MinMaxPyramid)
+
+    def __init__(self, columns=('time_data', 'rfu'), dtype=np.float64):
+        self.columns = tuple(columns)
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.RLock()
+        self._length = 0
+        self._pyramids = {}
+        self._listeners = []
+
+    def __len__(self):
+        return self._length
+
+    def _as_rows(self, data):
+        """
+        Converts incoming data into a 2-D array with one column per signal.
+        Data can be a dictionary of columns, a list of columns, or a 2-D array of rows
+        :param data: dict, list or ndarray
+        :return: ndarray (n, n_columns)
+        """
+        if isinstance(data, dict):
+            data = [data[key] for key in self.columns]
+        if isinstance(data, (list, tuple)):
+            assert len(data) == len(self.columns), f"Expected {len(self.columns)} columns, got {len(data)}"
+            return np.column_stack([np.atleast_1d(x) for x in data]).astype(self.dtype, copy=False)
+        data = np.asarray(data, dtype=self.dtype)
+        if data.ndim == 1:
+            data = data.reshape(1, -1)
+        assert data.shape[1] == len(self.columns), f"Expected {len(self.columns)} columns, got {data.shape}"
+        return data
+
+    def _to_dict(self, rows, copy=True):
+        """
+        Converts a 2-D array of rows into a dictionary of columns
+        :param rows: ndarray
+        :param copy: bool, return copies instead of views
+        :return: dict
+        """
+        if copy:
+            return {key: rows[:, idx].copy() for idx, key in enumerate(self.columns)}
+        return {key: rows[:, idx] for idx, key in enumerate(self.columns)}
+
+    @abstractmethod
+    def append(self, data):
+        """
+        Adds data to the end of the store
+        :param data: dict of columns, list of columns or 2-D array of rows
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def get_data(self):
+        """
+        Returns the full record as a dictionary of 1-D arrays (keys are the column names)
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def get_recent(self, samples):
+        """
+        Returns the last n samples as a dictionary of 1-D arrays
+        :param samples: int
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def get_latest(self, column):
+        """
+        Returns the most recent value of a column (NaN if the store is empty)
+        :param column: str
+        :return: float
+        """
+        pass
+
+    @abstractmethod
+    def get_range(self, start=None, stop=None):
+        """
+        Returns the samples with start <= time <= stop as a dictionary of 1-D arrays
+        :param start: float, (None to start at the first sample)
+        :param stop: float, (None to stop at the last sample)
+        :return:
+        """
+        pass
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes all data from the store
+        :return:
+        """
+        pass
+
+    def _count_range(self, start=None, stop=None):
+        """
+        Returns the number of samples with start <= time <= stop
+        :param start: float, (None to start at the first sample)
+        :param stop: float, (None to stop at the last sample)
+        :return: int
+        """
+        return len(self.get_range(start, stop)[self.columns[0]])
+
+    def add_pyramid(self, column, base=16, factor=4):
+        """
+        Keeps a min/max pyramid of a column that is updated as data is appended.
+        :param column: str, column name to summarize
+        :param base: int, number of samples in each bucket of the finest level
+        :param factor: int, number of buckets combined for each coarser level
+        :return:
+        """
+        assert column in self.columns[1:], f"{column} is not a data column of {self.columns}"
+        with self._lock:
+            pyramid = MinMaxPyramid(base, factor, self.pyramid_min_level)
+            if self._length > 0:
+                data = self.get_data()
+                pyramid.add(data[self.columns[0]], data[column])
+            self._pyramids[column] = pyramid
+
+    def _update_pyramids(self, rows):
+        """
+        Adds newly appended rows to each of the pyramids
+        :param rows: ndarray (n, n_columns)
+        :return:
+        """
+        for column, pyramid in self._pyramids.items():
+            pyramid.add(rows[:, 0], rows[:, self.columns.index(column)])
+
+    def _clear_pyramids(self):
+        for pyramid in self._pyramids.values():
+            pyramid.clear()
+
+    def add_listener(self, func):
+        """
+        Calls func with a dictionary of columns every time data is appended, and with None when the store is
+        cleared. Listeners are called while the store is locked so they should be quick.
+        :param func: function object
+        :return:
+        """
+        with self._lock:
+            self._listeners.append(func)
+
+    def _notify_listeners(self, rows):
+        """
+        Sends newly appended rows (or None after a clear) to the listeners
+        :param rows: ndarray (n, n_columns) or None
+        :return:
+        """
+        data = None if rows is None else self._to_dict(rows, copy=False)
+        for func in self._listeners:
+            func(data)
+
+    def get_limits(self, column):
+        """
+        Returns the (min, max) of a column over the whole record. Uses the pyramid when available.
+        :param column: str
+        :return: tuple
+        """
+        with self._lock:
+            if column in self._pyramids:
+                return self._pyramids[column].get_limits()
+            values = self.get_data()[column]
+            if len(values) == 0:
+                return np.nan, np.nan
+            return np.min(values), np.max(values)
+
+    def get_envelope(self, column, points=2000, start=None, stop=None):
+        """
+        Returns at most 'points' buckets covering the time range [start, stop]. Each bucket holds the time of its
+        first sample and the minimum and maximum of the column within the bucket. If the range holds fewer samples
+        than requested the raw samples are returned (min and max are then equal). Ranges too short for the pyramid
+        levels the store keeps are reduced from the raw samples.
+
+        The cost depends on the number of points requested and not on the length of the record.
+
+        :param column: str, column name (a pyramid must have been added for the column)
+        :param points: int, maximum number of buckets to return
+        :param start: float, start time (None for the start of the record)
+        :param stop: float, stop time (None for the end of the record)
+        :return: dict with 'time_data', 'min' and 'max' arrays
+        """
+        with self._lock:
+            pyramid = self._pyramids[column]
+            envelope = None
+            if self._count_range(start, stop) > pyramid.get_raw_limit(points):
+                envelope = pyramid.get_envelope(points, start, stop)
+            if envelope is None:
+                data = self.get_range(start, stop)
+                envelope = min_max_buckets(data[self.columns[0]], data[column], points)
+            return envelope
+
+    def flush(self):
+        """
+        Writes any pending data to its backing storage. By default data only lives in memory.
+        :return:
+        """
+        pass
+
+    def close(self):
+        """
+        Frees any resources held by the store. By default nothing needs to be closed.
+        :return:
+        """
+        pass
+
+
+class ArrayStore(DataStoreAbstraction):
+    """
+    In-memory store using a preallocated array. When the array is full its capacity is doubled so
+    appending is amortized constant time (instead of the O(n) np.append).
+    """
+
+    def __init__(self, columns=('time_data', 'rfu'), dtype=np.float64, capacity=4096):
+        super().__init__(columns, dtype)
+        self._initial_capacity = int(capacity)
+        self._buffer = np.zeros((self._initial_capacity, len(self.columns)), dtype=self.dtype)
+
+    def _reserve(self, size):
+        """
+        Makes sure the buffer can hold at least size rows
+        :param size: int
+        :return:
+        """
+        capacity = self._buffer.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        buffer = np.zeros((capacity, len(self.columns)), dtype=self.dtype)
+        buffer[:self._length] = self._buffer[:self._length]
+        self._buffer = buffer
+
+    def append(self, data):
+        rows = self._as_rows(data)
+        with self._lock:
+            end = self._length + rows.shape[0]
+            self._reserve(end)
+            self._buffer[self._length:end] = rows
+            self._length = end
+            self._update_pyramids(rows)
+            self._notify_listeners(rows)
+
+    def _view(self):
+        """
+        Returns a view (not a copy) of the filled part of the buffer
+        :return:
+        """
+        return self._buffer[:self._length]
+
+    def get_data(self):
+        """
+        Returns a copy of the full record
+        :return:
+        """
+        with self._lock:
+            return self._to_dict(self._buffer[:self._length])
+
+    def get_recent(self, samples):
+        with self._lock:
+            start = max(0, self._length - int(samples))
+            return self._to_dict(self._buffer[start:self._length])
+
+    def get_latest(self, column):
+        with self._lock:
+            if self._length == 0:
+                return np.nan
+            return self._buffer[self._length - 1, self.columns.index(column)]
+
+    def get_range(self, start=None, stop=None):
+        with self._lock:
+            rows = self._view()
+            return self._to_dict(rows[_range_slice(rows[:, 0], start, stop)])
+
+    def _count_range(self, start=None, stop=None):
+        with self._lock:
+            window = _range_slice(self._view()[:, 0], start, stop)
+            return window.stop - window.start
+
+    def clear(self):
+        with self._lock:
+            self._buffer = np.zeros((self._initial_capacity, len(self.columns)), dtype=self.dtype)
+            self._length = 0
+            self._clear_pyramids()
+            self._notify_listeners(None)
+
+
+class MemoryMappedStore(DataStoreAbstraction):
+    """
+    Store for very long recordings. Every sample is written to a memory-mapped file on disk while only a recent window
+    is kept in RAM. The file grows one chunk at a time and only the chunk currently being written is mapped by the
+    writer, so memory use does not grow with the length of the recording.
+
+    A JSON header is written next to the file (<filepath>.json) with the column names, dtype and the number of
+    samples that have been committed. The full record can be opened again (zero-copy) with open_record, even after
+    a crash of the acquisition process.
+
+    The min/max pyramids only keep their coarser levels (buckets of 1024 samples and up) in RAM, plots of shorter
+    ranges are reduced from the samples on disk.
+    """
+    pyramid_min_level = 3
+
+    def __init__(self, filepath, columns=('time_data', 'rfu'), dtype=np.float64, window=36000,
+                 chunk_samples=2 ** 16):
+        """
+        :param filepath: str, file to write the samples to. If the file exists a new name is used
+        :param columns: column names, the first column should be the time column
+        :param dtype: numpy dtype for the stored values
+        :param window: int, number of recent samples kept in RAM
+        :param chunk_samples: int, number of samples the file grows by every time a chunk fills
+        """
+        super().__init__(columns, dtype)
+        self.window = int(window)
+        self.chunk_samples = int(chunk_samples)
+        self._row_bytes = self.dtype.itemsize * len(self.columns)
+        self._base_path = filepath
+        self.filepath = None
+        self._chunk = None
+        self._chunk_index = 0
+        self._chunk_fill = 0
+        self._hot = ArrayStore(self.columns, self.dtype, capacity=2 * self.window)
+        self._new_file()
+
+    def _new_file(self):
+        """
+        Creates a new (empty) record file, adding a number to the file name if the file already exists
+        :return:
+        """
+        root, extension = os.path.splitext(self._base_path)
+        filepath = self._base_path
+        copy_number = 0
+        while os.path.exists(filepath):
+            filepath = root + f"_{copy_number:05d}" + extension
+            copy_number += 1
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        open(filepath, 'wb').close()
+        self.filepath = filepath
+        self._chunk = None
+        self._chunk_index = 0
+        self._chunk_fill = 0
+        self._length = 0
+        self._write_header()
+
+    def _write_header(self):
+        """
+        Writes the sidecar header containing the layout and the number of committed samples
+        :return:
+        """
+        header = {'columns': list(self.columns), 'dtype': self.dtype.str, 'samples': self._length}
+        with open(self.filepath + '.json', 'w') as file_out:
+            json.dump(header, file_out)
+
+    def _map_chunk(self, index):
+        """
+        Grows the file to hold the requested chunk and maps it for writing
+        :param index: int, chunk number
+        :return:
+        """
+        chunk_bytes = self.chunk_samples * self._row_bytes
+        with open(self.filepath, 'r+b') as file_out:
+            file_out.truncate((index + 1) * chunk_bytes)
+        self._chunk = np.memmap(self.filepath, dtype=self.dtype, mode='r+', offset=index * chunk_bytes,
+                                shape=(self.chunk_samples, len(self.columns)))
+        self._chunk_index = index
+        self._chunk_fill = 0
+
+    def _commit_chunk(self):
+        """
+        Flushes the current chunk to disk and releases the mapping
+        :return:
+        """
+        if self._chunk is not None:
+            self._chunk.flush()
+            self._chunk = None
+        self._write_header()
+
+    def append(self, data):
+        rows = self._as_rows(data)
+        with self._lock:
+            self._update_pyramids(rows)
+            self._hot.append(rows)
+            if len(self._hot) > 2 * self.window:
+                recent = self._hot.get_recent(self.window)
+                self._hot.clear()
+                self._hot.append(recent)
+
+            written = 0
+            while written < rows.shape[0]:
+                if self._chunk is None:
+                    self._map_chunk(self._length // self.chunk_samples)
+                n = min(self.chunk_samples - self._chunk_fill, rows.shape[0] - written)
+                self._chunk[self._chunk_fill:self._chunk_fill + n] = rows[written:written + n]
+                self._chunk_fill += n
+                self._length += n
+                written += n
+                if self._chunk_fill >= self.chunk_samples:
+                    self._commit_chunk()
+            self._notify_listeners(rows)
+
+    def flush(self):
+        """
+        Flushes any pending samples to disk and updates the header
+        :return:
+        """
+        with self._lock:
+            if self._chunk is not None:
+                self._chunk.flush()
+            self._write_header()
+
+    def get_data(self):
+        """
+        Returns the full record as read-only memory-mapped views (no copy of the data is made)
+        :return:
+        """
+        with self._lock:
+            self.flush()
+            return self.open_record(self.filepath)
+
+    def get_recent(self, samples):
+        """
+        Returns up to the last n samples from the in-memory window
+        :param samples: int
+        :return:
+        """
+        with self._lock:
+            return self._hot.get_recent(min(int(samples), self.window))
+
+    def get_latest(self, column):
+        with self._lock:
+            return self._hot.get_latest(column)
+
+    def get_range(self, start=None, stop=None):
+        """
+        Returns a copy of the samples between start and stop, read from RAM if the range is in the recent window
+        :param start: float
+        :param stop: float
+        :return:
+        """
+        with self._lock:
+            hot = self._hot._view()
+            if len(hot) > 0 and start is not None and start >= hot[0, 0]:
+                return self._to_dict(hot[_range_slice(hot[:, 0], start, stop)])
+            data = self.get_data()
+            window = _range_slice(data[self.columns[0]], start, stop)
+            return {key: np.array(value[window]) for key, value in data.items()}
+
+    def _count_range(self, start=None, stop=None):
+        with self._lock:
+            window = _range_slice(self.get_data()[self.columns[0]], start, stop)
+            return window.stop - window.start
+
+    def clear(self):
+        """
+        Closes the current record and starts a new file. Previously recorded data is kept on disk.
+        :return:
+        """
+        with self._lock:
+            self.close()
+            self._hot.clear()
+            self._clear_pyramids()
+            if self._length > 0 or os.path.getsize(self.filepath) > 0:
+                self._new_file()
+            self._notify_listeners(None)
+
+    def close(self):
+        with self._lock:
+            self._commit_chunk()
+
+    @staticmethod
+    def open_record(filepath):
+        """
+        Opens a record written by a MemoryMappedStore as read-only memory-mapped columns
+        :param filepath: str, path to the record file (not the .json header)
+        :return: dict of 1-D arrays (keys are the column names)
+        """
+        with open(filepath + '.json') as file_in:
+            header = json.load(file_in)
+        columns = header['columns']
+        dtype = np.dtype(header['dtype'])
+        samples = header['samples']
+        if samples == 0:
+            return {key: np.asarray([], dtype=dtype) for key in columns}
+        rows = np.memmap(filepath, dtype=dtype, mode='r', shape=(samples, len(columns)))
+        return {key: rows[:, idx] for idx, key in enumerate(columns)}
+
+
+class MinMaxPyramid:
+    """
+    Multi-resolution min/max summary of a signal. Level 0 holds the min and max of every 'base' samples, and each
+    coarser level combines 'factor' buckets of the level below. Levels are updated as data arrives so that a plot of
+    any time range can be made from a bounded number of buckets, without touching every sample.
+
+    Samples that don't fill a bucket yet are kept as pending rows and are included as a partial bucket in queries.
+    Levels finer than min_level are not kept (None in levels), their buckets only feed the coarser levels. Ranges
+    that would need them are reduced from the raw samples by the store (see get_raw_limit).
+    """
+
+    def __init__(self, base=16, factor=4, min_level=0):
+        assert base >= 2 and factor >= 2, "Pyramid bucket sizes must be at least 2"
+        self.base = int(base)
+        self.factor = int(factor)
+        self.min_level = int(min_level)
+        self.levels = []
+        self._pending = []
+
+    def clear(self):
+        self.levels = []
+        self._pending = []
+
+    def add(self, time_data, values):
+        """
+        Adds new samples to the pyramid
+        :param time_data: 1-D array of sample times
+        :param values: 1-D array of sample values
+        :return:
+        """
+        values = np.asarray(values, dtype=np.float64)
+        rows = np.column_stack([np.asarray(time_data, dtype=np.float64), values, values])
+        self._add_level(0, rows)
+
+    def _add_level(self, level, rows):
+        """
+        Adds rows of (time, min, max) to the given level, combining them into buckets when enough have accumulated
+        :param level: int
+        :param rows: ndarray (n, 3)
+        :return:
+        """
+        if level == len(self.levels):
+            self.levels.append(ArrayStore(('time_data', 'min', 'max'), capacity=256) if level >= self.min_level
+                               else None)
+            self._pending.append(np.zeros((0, 3)))
+        size = self.base if level == 0 else self.factor
+        pending = np.concatenate([self._pending[level], rows])
+        n_buckets = len(pending) // size
+        self._pending[level] = pending[n_buckets * size:]
+        if n_buckets == 0:
+            return
+        groups = pending[:n_buckets * size].reshape(n_buckets, size, 3)
+        buckets = np.column_stack([groups[:, 0, 0], groups[:, :, 1].min(axis=1), groups[:, :, 2].max(axis=1)])
+        if self.levels[level] is not None:
+            self.levels[level].append(buckets)
+        self._add_level(level + 1, buckets)
+
+    def _partial_bucket(self, level):
+        """
+        Returns the bucket (as a 1x3 array) of all the data that has not been combined into the given level yet
+        :param level: int
+        :return: ndarray (0 or 1, 3)
+        """
+        pending = np.concatenate(self._pending[:level + 1])
+        if len(pending) == 0:
+            return pending
+        return np.asarray([[pending[:, 0].min(), pending[:, 1].min(), pending[:, 2].max()]])
+
+    def get_limits(self):
+        """
+        Returns the (min, max) of all the samples added to the pyramid
+        :return:
+        """
+        if len(self.levels) == 0:
+            return np.nan, np.nan
+        # Buckets completed at the top level start a new level, the top level only has pending rows
+        rows = self._partial_bucket(len(self.levels) - 1)
+        if len(rows) == 0:
+            return np.nan, np.nan
+        return rows[:, 1].min(), rows[:, 2].max()
+
+    def get_raw_limit(self, points):
+        """
+        Returns the number of samples up to which a range is plotted from the raw samples instead of the pyramid,
+        ranges up to this length need a level finer than the ones kept to fit in 'points'
+        :param points: int
+        :return: int
+        """
+        if self.min_level == 0:
+            return points
+        return points * self.base * self.factor ** (self.min_level - 1)
+
+    def get_envelope(self, points=2000, start=None, stop=None):
+        """
+        Returns the finest level of buckets that fits within 'points' for the range [start, stop].
+        Returns None if the raw samples in the range would already fit, or if no level kept covers the range.
+        :param points: int
+        :param start: float
+        :param stop: float
+        :return: dict with 'time_data', 'min' and 'max' or None
+        """
+        for level in range(len(self.levels)):
+            if self.levels[level] is None:
+                continue
+            rows = self.levels[level]._view()
+            times = rows[:, 0]
+            first = 0 if start is None else max(0, np.searchsorted(times, start, side='right') - 1)
+            last = len(times) if stop is None else np.searchsorted(times, stop, side='right')
+            count = last - first + 1
+            if level == 0 and count * self.base <= points:
+                return None
+            if count <= points or level == len(self.levels) - 1:
+                rows = rows[first:last]
+                if last == len(times):
+                    partial = self._partial_bucket(level)
+                    if len(partial) > 0 and (stop is None or partial[0, 0] <= stop):
+                        rows = np.concatenate([rows, partial])
+                return {'time_data': rows[:, 0].copy(), 'min': rows[:, 1].copy(), 'max': rows[:, 2].copy()}
+        return None
+
+    @classmethod
+    def from_data(cls, time_data, values, base=16, factor=4):
+        """
+        Builds a pyramid from a complete record (for example one opened with MemoryMappedStore.open_record)
+        :param time_data: 1-D array
+        :param values: 1-D array
+        :param base: int
+        :param factor: int
+        :return: MinMaxPyramid
+        """
+        pyramid = cls(base, factor)
+        pyramid.add(time_data, values)
+        return pyramid
+
+
+class TimebaseAligner:
+    """
+    Resamples source data (ie the high voltage readbacks) onto the sample times of a reference stream (ie the
+    detector) while both are being acquired. add_reference and add_source are store listeners (see
+    DataStoreAbstraction.add_listener).
+
+    Reference times wait until a later source sample has arrived, then they are resampled in one vectorized pass
+    using only the source samples around them. mode 'linear' interpolates between source samples, mode 'hold'
+    (zero-order hold) uses the last source sample at or before the reference time. Reference times before the first
+    source sample take the first value. The aligned data is kept in an ArrayStore, so reading it back is a copy of
+    the columns. Long recordings spill it to a MemoryMappedStore like the detector (see set_spill_file).
+    """
+
+    def __init__(self, columns=('voltage', 'current'), mode='linear'):
+        """
+        :param columns: source columns to resample
+        :param mode: str, 'linear' or 'hold'
+        """
+        assert mode in ['linear', 'hold'], f"Alignment mode {mode} must be 'linear' or 'hold'"
+        self.columns = tuple(columns)
+        self.mode = mode
+        self.store = ArrayStore(('time_data',) + self.columns)
+        self._lock = threading.RLock()
+        self._pending = np.zeros(0)
+        self._source_time = np.zeros(0)
+        self._source_values = np.zeros((0, len(self.columns)))
+
+    def add_reference(self, data):
+        """
+        Adds reference sample times. None starts a new record.
+        :param data: dict with a 'time_data' column, or None
+        :return:
+        """
+        with self._lock:
+            if data is None:
+                self._pending = np.zeros(0)
+                self.store.clear()
+                return
+            self._pending = np.concatenate([self._pending, np.asarray(data['time_data'], dtype=float)])
+            self._resolve()
+
+    def add_source(self, data):
+        """
+        Adds source samples. None starts a new record.
+        :param data: dict with a 'time_data' column and each of the aligned columns, or None
+        :return:
+        """
+        with self._lock:
+            if data is None:
+                self._source_time = np.zeros(0)
+                self._source_values = np.zeros((0, len(self.columns)))
+                return
+            values = np.column_stack([np.asarray(data[column], dtype=float) for column in self.columns])
+            self._source_time = np.concatenate([self._source_time, np.asarray(data['time_data'], dtype=float)])
+            self._source_values = np.concatenate([self._source_values, values])
+            self._resolve()
+
+    def _resolve(self):
+        """
+        Resamples the reference times that are covered by the source samples received so far
+        :return:
+        """
+        if len(self._pending) == 0 or len(self._source_time) == 0:
+            return
+        ready = np.searchsorted(self._pending, self._source_time[-1], side='right')
+        if ready == 0:
+            return
+        times = self._pending[:ready]
+        values = align(times, self._source_time, self._source_values, self.mode)
+        self.store.append(np.column_stack([times, values]))
+        self._pending = self._pending[ready:]
+        # Only the source sample before the next reference time is needed again
+        keep = max(0, np.searchsorted(self._source_time, times[-1], side='right') - 1)
+        self._source_time = self._source_time[keep:]
+        self._source_values = self._source_values[keep:]
+
+    def get_data(self):
+        """
+        Returns the aligned record. Reference times after the last source sample take the last source value.
+        :return: dict of 1-D arrays ('time_data' and the aligned columns)
+        """
+        with self._lock:
+            data = self.store.get_data()
+            if len(self._pending) == 0:
+                return data
+            if len(self._source_time) > 0:
+                values = align(self._pending, self._source_time, self._source_values, self.mode)
+            else:
+                values = np.full((len(self._pending), len(self.columns)), np.nan)
+            data['time_data'] = np.concatenate([data['time_data'], self._pending])
+            for idx, column in enumerate(self.columns):
+                data[column] = np.concatenate([data[column], values[:, idx]])
+            return data
+
+    def set_spill_file(self, filepath=None, window=36000, chunk_samples=2 ** 16):
+        """
+        Records the aligned data to a chunked memory-mapped file, only the last 'window' samples are kept in RAM.
+        Pass None as the filepath to go back to keeping the data in RAM. The current record is closed.
+        :param filepath: str, file to write the data to, (None to store in RAM)
+        :param window: int, number of recent samples to keep in RAM
+        :param chunk_samples: int, number of samples the file is extended by at a time
+        :return:
+        """
+        with self._lock:
+            self.store.close()
+            columns = ('time_data',) + self.columns
+            if filepath is None:
+                self.store = ArrayStore(columns)
+            else:
+                self.store = MemoryMappedStore(filepath, columns, window=window, chunk_samples=chunk_samples)
+
+
+def align(times, source_time, source_values, mode='linear'):
+    """
+    Resamples source values onto new times. Times outside the source are held at the first or last value.
+    :param times: 1-D array of the times to resample to
+    :param source_time: sorted 1-D array of the source sample times (repeated times are allowed)
+    :param source_values: 2-D array (n, columns) of source values
+    :param mode: str, 'linear' interpolates, 'hold' uses the last source value at or before each time
+    :return: 2-D array (len(times), columns)
+    """
+    if mode == 'hold':
+        idx = np.clip(np.searchsorted(source_time, times, side='right') - 1, 0, len(source_time) - 1)
+        return source_values[idx]
+    return np.column_stack([np.interp(times, source_time, source_values[:, idx])
+                            for idx in range(source_values.shape[1])])
+
+
+def min_max_buckets(time_data, values, points):
+    """
+    Reduces samples to at most 'points' buckets of consecutive samples (time of the first sample, minimum and maximum)
+    :param time_data: 1-D array
+    :param values: 1-D array
+    :param points: int
+    :return: dict with 'time_data', 'min' and 'max' arrays
+    """
+    time_data = np.asarray(time_data, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) <= points:
+        return {'time_data': time_data.copy(), 'min': values.copy(), 'max': values.copy()}
+    starts = np.arange(0, len(values), int(np.ceil(len(values) / points)))
+    return {'time_data': time_data[starts], 'min': np.minimum.reduceat(values, starts),
+            'max': np.maximum.reduceat(values, starts)}
+
+
+def _range_slice(times, start=None, stop=None):
+    """
+    Returns the slice of a sorted time array where start <= time <= stop
+    :param times: sorted 1-D array
+    :param start: float or None
+    :param stop: float or None
+    :return: slice
+    """
+    first = 0 if start is None else np.searchsorted(times, start, side='left')
+    last = len(times) if stop is None else np.searchsorted(times, stop, side='right')
+    return slice(first, last)
@@ -2,6 +2,7 @@ import threading
 from abc import ABC, abstractmethod
 from scipy import signal
 from L2.Utility import UtilityControl, UtilityFactory
+from L2.DataStore import ArrayStore, MemoryMappedStore, min_max_buckets
 from L1.DAQControllers import DaqAbstraction
 import numpy as np
 
@@ -66,14 +67,17 @@ class DetectorAbstraction(ABC):
     get_raw_data : get the data without a filter applied to it
     get_data : get the filtered data
     add_data: adds incoming data to the data variable
+    get_display_data: get a fixed number of min/max points for plotting
+    set_spill_file: stream the data to a memory-mapped file instead of keeping it all in RAM
+    add_listener: calls a function with every block of data added to the record
 
     """
 
     def __init__(self, controller, role):
         self.daqcontroller = controller
         self.role = role
-        self.rfu = np.asarray([])
-        self.time = np.asarray([])
+        self.store = ArrayStore(('time_data', 'rfu'))
+        self.store.add_pyramid('rfu')
         self._lock = threading.RLock()
         self._sampling_f = 100000
         self._final_f = 10
@@ -82,6 +86,95 @@ class DetectorAbstraction(ABC):
         settings = {'cutoff': 1.5, 'fs': 10, 'order': 2, 'padlen': 24, 'padtype': 'constant'}
         self._filter_type = [None, settings]
 
+    @property
+    def rfu(self):
+        return self.store.get_data()['rfu']
+
+    @property
+    def time(self):
+        return self.store.get_data()['time_data']
+
+    def set_spill_file(self, filepath=None, window=36000, chunk_samples=2 ** 16):
+        """
+        Records the detector data to a chunked memory-mapped file so long recordings don't grow memory without
+        bound and survive a crash of the acquisition. Only the last 'window' samples are kept in RAM.
+        Pass None as the filepath to go back to keeping the data in RAM.
+
+        :param filepath: str, file to write the data to, (None to store in RAM)
+        :param window: int, number of recent samples to keep in RAM
+        :param chunk_samples: int, number of samples the file is extended by at a time
+        :return:
+        """
+        with self._lock:
+            self.store.close()
+            listeners = self.store._listeners
+            if filepath is None:
+                self.store = ArrayStore(('time_data', 'rfu'))
+            else:
+                self.store = MemoryMappedStore(filepath, ('time_data', 'rfu'), window=window,
+                                               chunk_samples=chunk_samples)
+            self.store.add_pyramid('rfu')
+            for func in listeners:
+                self.store.add_listener(func)
+
+    def add_listener(self, func):
+        """
+        Calls func with a dictionary ('time_data', 'rfu') of every block of raw data added to the record, and with
+        None when the record is cleared (see DataStoreAbstraction.add_listener)
+        :param func: function object
+        :return:
+        """
+        with self._lock:
+            self.store.add_listener(func)
+
+    def get_recent_data(self, samples):
+        """
+        Returns the most recent samples of the raw data
+        :param samples: int, number of samples
+        :return:
+        """
+        with self._lock:
+            return self.store.get_recent(samples)
+
+    def get_display_data(self, points=2000, start=None, stop=None):
+        """
+        Returns at most 'points' data points for plotting the time range [start, stop]. Long records are reduced
+        using the min/max pyramid of the store, with the minimum and maximum of each bucket interleaved so peaks
+        are kept in the plotted line. The cost does not depend on the length of the record.
+
+        If the whole record fits in the requested points the (filtered) data from get_data is returned. The pyramid
+        holds the raw data, so with a filter selected the range is filtered and reduced instead (the cost then grows
+        with the length of the range).
+
+        :param points: int, maximum number of points to return
+        :param start: float, start time in seconds (None for the start of the record)
+        :param stop: float, stop time in seconds (None for the end of the record)
+        :return: dict with 'time_data' and 'rfu'
+        """
+        with self._lock:
+            if start is None and stop is None and len(self.store) <= points:
+                return self.get_data()
+            if self._filter_type[0] is None:
+                envelope = self.store.get_envelope('rfu', points // 2, start, stop)
+            else:
+                data = self.store.get_range(start, stop)
+                envelope = min_max_buckets(data['time_data'], self._apply_filter(data['rfu']), points // 2)
+        return {'time_data': np.repeat(envelope['time_data'], 2),
+                'rfu': np.column_stack([envelope['min'], envelope['max']]).ravel()}
+
+    def _apply_filter(self, rfu):
+        """
+        Applies the selected filter (if any) to the rfu data
+        :param rfu: 1-D array
+        :return: 1-D array
+        """
+        filter_type, kwargs = self._filter_type
+        if filter_type == 'butter':
+            return butter_lowpass_filter(rfu, kwargs)
+        elif filter_type == 'savgol':
+            return savgol_filter(rfu, kwargs)
+        return rfu
+
     @abstractmethod
     def get_data(self):
         """
@@ -205,31 +298,26 @@ class PhotomultiplierDetector(DetectorAbstraction, UtilityControl):
 
     def get_raw_data(self):
         """
-        Returns a copy of the raw data
+        Returns the raw data (a copy, or read-only memory-mapped views when using a spill file)
         :return:
         """
         with self._lock:
-            return {'time_data': self.time.copy(), 'rfu': self.rfu.copy()}
+            return self.store.get_data()
 
     def get_data(self):
         """
         Returns a filtered copy of the data
         :return:
         """
-        filter_type, kwargs = self._filter_type
         locked = self._lock.acquire(timeout=0.2)
         if not locked:
             return None
 
-        if filter_type == 'butter':
-            filtered = butter_lowpass_filter(self.rfu.copy(), kwargs)
-        elif filter_type == 'savgol':
-            filtered = savgol_filter(self.rfu.copy(), kwargs)
-        else:
-            filtered = self.rfu.copy()
+        data = self.store.get_data()
+        data['rfu'] = self._apply_filter(data['rfu'])
         self._lock.release()
 
-        return {'time_data': self.time.copy(), 'rfu': filtered}
+        return data
 
     def add_data(self, incoming_data, time_elapsed, *args):
         """
@@ -243,8 +331,18 @@ class PhotomultiplierDetector(DetectorAbstraction, UtilityControl):
             if self._oversample:
                 self._add_oversampled_data(incoming_data[0], self._sampling_f / self._final_f)
             else:
-                self.rfu = np.append(self.rfu, incoming_data[0])
-                self.time = np.linspace(0, len(self.rfu)/self._sampling_f, num=len(self.rfu), endpoint=False)
+                self._add_samples(np.asarray(incoming_data[0]), self._sampling_f)
+
+    def _add_samples(self, rfu, frequency):
+        """
+        Adds samples to the store, with time points continuing from the last sample recorded
+        :param rfu: 1-d array
+        :param frequency: sampling frequency of the rfu samples
+        :return:
+        """
+        start = len(self.store)
+        time_data = np.arange(start, start + len(rfu)) / frequency
+        self.store.append([time_data, rfu])
 
     def _add_oversampled_data(self, data, sample_n):
         """
@@ -259,10 +357,11 @@ class PhotomultiplierDetector(DetectorAbstraction, UtilityControl):
         """
         self._oversample_buffer = np.append(self._oversample_buffer, data)
         sample_n = int(sample_n)
-        while len(self._oversample_buffer) >= sample_n:
-            self.rfu = np.append(self.rfu, np.mean(self._oversample_buffer[0:sample_n]))
-            self._oversample_buffer = np.delete(self._oversample_buffer, np.s_[0:sample_n])
-        self.time = np.linspace(0,len(self.rfu)/self._final_f, num=len(self.rfu), endpoint=False)
+        n_means = len(self._oversample_buffer) // sample_n
+        if n_means > 0:
+            means = self._oversample_buffer[:n_means * sample_n].reshape(n_means, sample_n).mean(axis=1)
+            self._oversample_buffer = self._oversample_buffer[n_means * sample_n:]
+            self._add_samples(means, self._final_f)
 
     def start(self):
         """
@@ -270,8 +369,7 @@ class PhotomultiplierDetector(DetectorAbstraction, UtilityControl):
         :return:
         """
         with self._lock:
-            self.rfu = np.asarray([])
-            self.time = np.asarray([])
+            self.store.clear()
             self._oversample_buffer = np.asarray([])
         self.daqcontroller.start_measurement()
 
@@ -282,6 +380,8 @@ class PhotomultiplierDetector(DetectorAbstraction, UtilityControl):
         """
         self._copy_data=self.get_data()
         self.daqcontroller.stop_measurement()
+        with self._lock:
+            self.store.flush()
 
     def startup(self):
         """
@@ -296,6 +396,8 @@ class PhotomultiplierDetector(DetectorAbstraction, UtilityControl):
         :return:
         """
         self.daqcontroller.stop_measurement()
+        with self._lock:
+            self.store.close()
 
     def get_status(self):
         """
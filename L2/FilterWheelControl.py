@@ -68,7 +68,8 @@ class MicroManagerFilterWheel(FilterWheelAbstraction, UtilityControl):
 
     def set_channel(self, channel):
         """ Sets the filter wheel to the corresponding channel (starting at zero) """
-        self.controller.send_command('filter,set,{},{}\n'.format(self._get_device(), channel))
+        self._send_state('channel', channel, self.controller.send_command,
+                         'filter,set,{},{}\n'.format(self._get_device(), channel))
         self._state = channel
 
     def get_channel(self):
@@ -96,15 +97,19 @@ class PriorFilter(FilterWheelAbstraction, UtilityControl):
         self._position_map = {4: 1, 5: 2, 6: 3, 7: 4, 8: 5, 9: 6, 10: 7, 1: 8,
                               2: 9, 3: 10}  # Camera Port is at key when access is at value
 
-        settings = {'filter': 1, 'default_channel':1}
+        settings = {'filter': 1, 'default_channel':1, 'state_ttl': None}
         settings.update(kwargs)
 
         self._filter_wheel = settings['filter']  # which filter port on the proscan to use
         self.default_channel = settings['default_channel']
+        if settings['state_ttl'] is not None:
+            self.state_ttl = float(settings['state_ttl'])
 
     def startup(self):
         """ Do  nothing on startup"""
         self.controller.send_command(f"7 {self._filter_wheel},H\r")
+        # Homing moves the wheel
+        self.invalidate_state()
         self.set_channel(self.default_channel)
 
     def stop(self):
@@ -131,7 +136,10 @@ class PriorFilter(FilterWheelAbstraction, UtilityControl):
         if settings['position'].lower() == 'camera':
             channel = self._position_map[channel]
 
-        self.controller.send_command(f'7 {self._filter_wheel},{channel}\r')
+        # Prior error responses start with E
+        self._send_state('channel', channel, self.controller.send_command, f'7 {self._filter_wheel},{channel}\r',
+                         ack=lambda response: not str(response).startswith('E'))
+        self._state = channel
 
     def get_channel(self, **kwargs):
         """
@@ -168,12 +176,14 @@ class PycromanagerFilter(FilterWheelAbstraction, UtilityControl):
     def set_channel(self, channel):
         """ Sets the filter wheel to the corresponding channel (starting at zero) """
         channel = int(channel)
-        self.controller.send_command(self.controller.core.set_state, args=(self._dev_name, channel))
+        self._send_state('channel', channel, self.controller.send_command, self.controller.core.set_state,
+                         args=(self._dev_name, channel))
         self._state = channel
 
     def get_channel(self):
         """ Reads the filter wheel channel"""
         self._state = self.controller.send_command(self.controller.core.get_state, args=(self._dev_name,))
+        self.record_state('channel', self._state)
         return self._state
 
     def define_channels(self, **kwargs):
@@ -186,6 +196,11 @@ class PycromanagerFilter(FilterWheelAbstraction, UtilityControl):
 
 
 class LumencorFilter(FilterWheelAbstraction, UtilityControl):
+    """
+    Lumencor Spectra light engine. The enabled channels and the channel intensities are shadowed, apply_state sends
+    only the settings that changed and writes all their commands at once.
+    """
+    labels = ['red', 'green', 'cyan', 'uv', 'teal', 'blue']
 
     def startup(self):
         """
@@ -196,12 +211,13 @@ class LumencorFilter(FilterWheelAbstraction, UtilityControl):
         cmd_2 = bytearray.fromhex("5703AB50")
         for cmd_i in [cmd_1, cmd_2]:
             self.controller.send_command(cmd_i)
+        self.invalidate_state()
 
     def get_channel(self):
         pass
 
     def shutdown(self):
-        self.set_channel(['red','green','cyan','uv','teal','blue'],0)
+        self.apply_state([], {label: 0 for label in self.labels})
 
     def set_channel(self, channel):
         """
@@ -229,27 +245,10 @@ class LumencorFilter(FilterWheelAbstraction, UtilityControl):
         4F 5B 50- Enables Cyan and Blue, Disables all others.
         4F 3E 50- Enables Red and Teal, Disables all others.
 
-        :param channel:
+        :param channel: label or list of labels to enable, the others are disabled
         :return:
         """
-        if type(channel) is int:
-            channel = [channel]
-        label_to_channel = {'red': 0, 'green': 1, 'cyan': 2, 'uv': 3, 'blue': 5, 'teal': 6}
-
-        byte_channel = ['1'] * 7
-        byte_channel[7-4]='1'
-        #print(byte_channel)
-        for chn in channel:
-            lbl = 6-label_to_channel[chn]
-            byte_channel[lbl] = '0'
-            #print(f'chn {chn}, lbl {lbl}, byte_channel={byte_channel}')
-
-        byte_channel = int("".join(byte_channel), 2)
-        cmd = bytearray.fromhex('4f')
-        cmd.append(byte_channel)
-        cmd = cmd + bytearray.fromhex('50')
-        #print(cmd)
-        self.controller.send_command(cmd)
+        self.apply_state(channel=channel)
 
     def set_intensity(self, channel, level):
         """
@@ -281,46 +280,92 @@ class LumencorFilter(FilterWheelAbstraction, UtilityControl):
         53 18 03 05 F2 20 50- Sets UV and GREEN DACS to 0x22
         53 1A 03 02 F6 60 50- Sets TEAL DACS to 0x66
 
-        :param channel:
-        :param level:
+        :param channel: label or list of labels
+        :param level: 0 (off) to 1 (full on)
         :return:
         """
-        assert level <= 1, "Level must be a vlaue between 0 and 1"
-        level = 255 - int(level * 255)
-        level_lsb, level_msb = get_level_bytes(level)
-
-        label_to_channel_a = {'red': 3, 'green': 2, 'cyan': 1, 'uv': 0}
-        label_to_channel_b = {'teal': 1, 'blue': 0}
-
-        byte_3_a = ['0'] * 8
-        byte_3_b = ['0'] * 8
-        byte_5_a = None
-        byte_5_b = None
-        cmd_prefix = bytearray.fromhex('53')
-
-        if type(channel) is list:
-            for chn in channel:
-                #  get DAC A channels
-                if chn in list(label_to_channel_a.keys()):
-                    byte_5_a = bytearray.fromhex('18')
-                    byte_3_a[7-label_to_channel_a[chn]] = '1'
-                # get DAC B Channels
-                elif chn in list(label_to_channel_b.keys()):
-                    byte_5_b = bytearray.fromhex('1A')
-                    byte_3_b[7-label_to_channel_b[chn]] = '1'
-
-        if byte_5_a is not None:
-            byte_3 = bytes([int("".join(byte_3_a), 2)])
-            #print(f"byte3: {byte_3}, byte_3_a: {byte_3_a}")
-            cmd = cmd_prefix + byte_5_a + bytes.fromhex('03') + byte_3 + level_msb + level_lsb + bytes.fromhex('50')
-            self.controller.send_command(cmd)
-            #print(cmd)
-
-        if byte_5_b is not None:
-            byte_3 = bytes([int("".join(byte_3_b), 2)])
-            cmd = cmd_prefix + byte_5_b + bytes.fromhex('03') + byte_3 + level_msb + level_lsb + bytes.fromhex('50')
-            self.controller.send_command(cmd)
-            #print(cmd)
+        if type(channel) is str:
+            channel = [channel]
+        self.apply_state(intensity={chn: level for chn in channel})
+
+    def apply_state(self, channel=None, intensity=None):
+        """
+        Sets the enabled channels and the channel intensities with a single write to the Lumencor. Settings the
+        Lumencor is already known to have are not sent, if nothing changed nothing is written.
+
+        Intensity commands are sent before the enable command so newly enabled channels turn on at their new level.
+        Channels on the same DAC that change to the same level share one command.
+
+        :param channel: label or list of labels to enable (the others are disabled), None leaves them unchanged
+        :param intensity: dict of label: level (0 to 1), None leaves the intensities unchanged
+        :return: bytes written (empty if nothing changed)
+        """
+        states = {}
+        for chn, level in (intensity or {}).items():
+            assert 0 <= level <= 1, "Level must be a vlaue between 0 and 1"
+            states[('intensity', chn)] = 255 - int(level * 255)
+        if channel is not None:
+            if type(channel) is str:
+                channel = [channel]
+            states['enable'] = get_enable_mask(channel)
+        cmd = self._send_states(states, self._send_lumencor_state)
+        return b'' if cmd is None else cmd
+
+    def _send_lumencor_state(self, changed):
+        """
+        Writes the changed settings (see apply_state) to the Lumencor in one write
+        :param changed: dict of ('intensity', label): inverted DAC level and 'enable': enable mask
+        :return: bytes written
+        """
+        # Group the changed channels by DAC and level
+        groups = {}
+        for key, level in changed.items():
+            if key == 'enable':
+                continue
+            address, select_bit = LUMENCOR_DAC[key[1]]
+            groups[(address, level)] = groups.get((address, level), 0) | (1 << select_bit)
+        commands = [get_intensity_command(address, select, level) for (address, level), select in groups.items()]
+        if 'enable' in changed:
+            commands.append(get_enable_command(changed['enable']))
+        cmd = b''.join(commands)
+        self.controller.send_command(cmd)
+        return cmd
+
+
+# Channel enable bit of each label, the bit is cleared to enable the channel
+LUMENCOR_ENABLE = {'red': 0, 'green': 1, 'cyan': 2, 'uv': 3, 'blue': 5, 'teal': 6}
+# IIC DAC address and DAC select bit of each label
+LUMENCOR_DAC = {'red': (0x18, 3), 'green': (0x18, 2), 'cyan': (0x18, 1), 'uv': (0x18, 0),
+                'teal': (0x1A, 1), 'blue': (0x1A, 0)}
+
+
+def get_enable_mask(channel):
+    """
+    Returns the channel enable byte with the bits of the listed channels cleared
+    :param channel: list of labels
+    :return: int
+    """
+    mask = 0x7F
+    for chn in channel:
+        mask &= ~(1 << LUMENCOR_ENABLE[chn])
+    return mask
+
+
+def get_enable_command(mask):
+    """ Returns the channel enable command for the enable byte """
+    return bytes([0x4F, mask, 0x50])
+
+
+def get_intensity_command(address, select, level):
+    """
+    Returns the DAC intensity command
+    :param address: int, IIC address of the DAC (0x18 or 0x1A)
+    :param select: int, select bits of the DAC channels to set
+    :param level: int, inverted 8 bit DAC level (0xFF is full off)
+    :return: bytes
+    """
+    level_lsb, level_msb = get_level_bytes(level)
+    return bytes([0x53, address, 0x03, select]) + level_msb + level_lsb + bytes([0x50])
 
 
 def get_level_bytes(value):
@@ -330,11 +375,48 @@ def get_level_bytes(value):
     :param value:
     :return:
     """
-    bit_0 = bytes([value & int('00001111', 2) << 4])
+    bit_0 = bytes([(value & int('00001111', 2)) << 4])
     bit_1 = bytes([int('11110000',2)|(value >> 4)])
     return bit_0, bit_1
 
 
+def test_lumencor():
+    """
+    Switches the Lumencor channels and intensities on the Spectra emulator (pseudo terminal). Each state change
+    should be a single write with only the changed settings, and unchanged states should not be written.
+    :return:
+    """
+    from L1 import Controllers
+    from L1.Emulators import SpectraEmulator
+
+    light = SpectraEmulator().start()
+    controller = Controllers.LumencorController(light.port)
+    controller.open()
+    lumencor = LumencorFilter(controller, 'excitation')
+    lumencor.startup()
+    writes = light.writes
+
+    cmd = lumencor.apply_state(['cyan', 'blue'], {'cyan': 0.5, 'blue': 0.5, 'uv': 0.2})
+    assert light.writes == writes + 1, "State was not sent in a single write"
+    assert len(cmd) == 3 + 7 * 3, "Cyan/uv share a DAC but not a level, blue is on the other DAC"
+    assert lumencor.apply_state(['cyan', 'blue'], {'cyan': 0.5, 'blue': 0.5}) == b''
+    cmd = lumencor.apply_state(['cyan'], {'cyan': 0.5, 'blue': 0.5, 'red': 0.5})
+    assert len(cmd) == 7 + 3, "Only the red intensity and the enable mask changed"
+    lumencor.set_intensity(['green', 'uv'], 0.2)
+    lumencor.set_channel(['cyan'])
+    lumencor.shutdown()
+    time.sleep(0.1)
+    assert light.bad_frames == 0
+    assert light.initialized == [b'\x02\xff', b'\x03\xab']
+    assert light.enabled == set() and all(level == 0 for level in light.levels.values())
+    lumencor.apply_state(['green'], {'green': 0x80 / 255})
+    time.sleep(0.1)
+    assert light.enabled == {'green'} and light.levels['green'] == 0x80
+    controller.close()
+    light.close()
+    return lumencor
+
+
 class FilterWheelFactory(UtilityFactory):
     """ Determines the type of xy utility object to return according to the daqcontroller id"""
 
@@ -0,0 +1,207 @@
+"""
+Image statistics computed once per frame and shared by every consumer of the frame.
+
+FrameAnalytics : lazily computed statistics of one image (histograms, percentiles, mean, variance, downsampled
+pyramid and any other derived result a consumer caches with get)
+analytics_of : returns the analytics of an image, the same object for every caller while the analytics are in use
+
+A display, the focus measures and the cell detection often look at the same camera frame. Each asks
+analytics_of(image) for what it needs and only the first request does the full frame pass.
+"""
+import threading
+import weakref
+
+import numpy as np
+
+_registry = {}  # id(image) : weakref to the FrameAnalytics of the image
+_registry_lock = threading.Lock()
+
+
+def analytics_of(image):
+    """
+    Returns the analytics of an image. Frames register their analytics when they are created, other arrays get new
+    analytics that are shared for as long as someone holds them (ie a function holding them while it calls several
+    measures on the same image). The image must not be modified while its analytics are held.
+    :param image: np.ndarray
+    :return: FrameAnalytics
+    """
+    key = id(image)
+    with _registry_lock:
+        ref = _registry.get(key)
+        analytics = ref() if ref is not None else None
+        if analytics is not None and analytics.image is image:
+            return analytics
+    analytics = FrameAnalytics(image)
+    analytics.register()
+    return analytics
+
+
+def _unregister(key, ref):
+    with _registry_lock:
+        if _registry.get(key) is ref:
+            del _registry[key]
+
+
+class FrameAnalytics:
+    """
+    Statistics of one image, each computed on the first request and cached. The cached values are cleared when the
+    frame's buffer goes back to its pool.
+
+    histogram : counts per bin (np.histogram) or per integer value (bins=None on integer images)
+    percentile : exact percentiles (same as np.percentile) from the sorted or counted pixel values
+    mean, variance, std, minimum, maximum : pixel statistics
+    pyramid : image binned 2x2 per level
+    get : caches any other result computed from the image (ie a filtered image)
+    """
+
+    def __init__(self, image):
+        """
+        :param image: np.ndarray
+        """
+        self.image = image
+        self._cache = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._ref = None
+
+    def register(self):
+        """
+        Makes these analytics the ones analytics_of returns for the image
+        :return: self
+        """
+        key = id(self.image)
+        with _registry_lock:
+            self._ref = weakref.ref(self, lambda ref, key=key: _unregister(key, ref))
+            _registry[key] = self._ref
+        return self
+
+    def clear(self):
+        """
+        Forgets the cached values and unregisters the image (called when the frame buffer is reused)
+        :return:
+        """
+        with self._lock:
+            self._cache.clear()
+        if self._ref is not None:
+            _unregister(id(self.image), self._ref)
+            self._ref = None
+
+    def get(self, key, func, *args, **kwargs):
+        """
+        Returns a cached result, func(image, *args, **kwargs) is only called for the first request of a key. Requests
+        for the same key from other threads wait for the first one instead of computing it again.
+        :param key: hashable, identifies the result (include any parameter that changes it)
+        :param func: function object
+        :return: the result of func
+        """
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._cache:
+                    return self._cache[key]
+            value = func(self.image, *args, **kwargs)
+            with self._lock:
+                self._cache[key] = value
+                self._locks.pop(key, None)
+        return value
+
+    def cached(self, key):
+        """
+        Returns whether a result is already cached
+        :param key: hashable
+        :return: bool
+        """
+        with self._lock:
+            return key in self._cache
+
+    def histogram(self, bins=None):
+        """
+        Returns the image histogram
+        :param bins: int or sequence (np.histogram bins, between the image min and max). None on an integer image
+        counts every value from 0 to the image max (one bin per value).
+        :return: (counts, bin_edges) np.ndarray
+        """
+        if bins is None:
+            return self.get(('histogram', None), _value_counts)
+        key = ('histogram', bins if np.isscalar(bins) else tuple(bins))
+        return self.get(key, np.histogram, bins)
+
+    def _sorted(self):
+        """ Pixel values in order """
+        return self.get('sorted', lambda image: np.sort(image, axis=None))
+
+    def percentile(self, q):
+        """
+        Returns percentiles of the pixel values, with the linear interpolation of np.percentile
+        :param q: float or sequence of float (0 to 100)
+        :return: float or np.ndarray
+        """
+        q = np.asarray(q, dtype=float)
+        size = self.image.size
+        rank = q / 100 * (size - 1)
+        low, high = np.floor(rank).astype(np.int64), np.ceil(rank).astype(np.int64)
+        if np.issubdtype(self.image.dtype, np.integer) and self.image.dtype.itemsize <= 2 and \
+                not self.cached('sorted'):
+            counts, edges = self.histogram()
+            cumulative = self.get('cumulative', lambda image: np.cumsum(counts))
+            low_value = edges[np.searchsorted(cumulative, low, side='right')]
+            high_value = edges[np.searchsorted(cumulative, high, side='right')]
+        else:
+            ordered = self._sorted()
+            low_value, high_value = ordered[low], ordered[high]
+        low_value, high_value = np.asarray(low_value, float), np.asarray(high_value, float)
+        result = low_value + (high_value - low_value) * (rank - low)
+        return float(result) if result.ndim == 0 else result
+
+    def mean(self):
+        """ Returns the mean pixel value """
+        return self.get('mean', np.mean)
+
+    def variance(self):
+        """ Returns the variance of the pixel values """
+        mean = self.mean()
+        return self.get('variance', lambda image: float(np.sum(np.power(np.subtract(image, mean), 2)) / image.size))
+
+    def std(self):
+        """ Returns the standard deviation of the pixel values """
+        return float(np.sqrt(self.variance()))
+
+    def minimum(self):
+        """ Returns the smallest pixel value """
+        return self.get('minimum', np.min)
+
+    def maximum(self):
+        """ Returns the largest pixel value """
+        return self.get('maximum', np.max)
+
+    def pyramid(self, level):
+        """
+        Returns the image binned 2x2 level times (mean of each block, rows and columns past the last full block are
+        dropped). Level 0 is the image.
+        :param level: int
+        :return: np.ndarray (float32 for levels above 0)
+        """
+        if level <= 0:
+            return self.image
+        return self.get(('pyramid', level), lambda image: _bin_2x2(self.pyramid(level - 1)))
+
+
+def _value_counts(image):
+    """ Counts of every integer value from 0 to the image max, with the histogram bin edges """
+    values = image.reshape(-1)
+    offset = 0
+    if values.dtype.kind == 'i' and values.size > 0 and values.min() < 0:
+        offset = int(values.min())
+        values = values.astype(np.int64) - offset
+    counts = np.bincount(values)
+    edges = np.arange(len(counts) + 1) + offset
+    return counts, edges
+
+
+def _bin_2x2(image):
+    height, width = image.shape[0] // 2, image.shape[1] // 2
+    blocks = image[:height * 2, :width * 2].reshape(height, 2, width, 2)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
@@ -0,0 +1,227 @@
+"""
+Camera frame buffers shared between the acquisition thread and the image consumers.
+
+Frame : a read-only image with its acquisition metadata, a reference count and its analytics (L2.FrameAnalytics)
+FrameSubscriber : a consumer with its own delivery queue and thread, so a slow consumer never blocks the acquisition
+FrameDispatcher : hands every published frame to the subscribers without copying it
+"""
+import logging
+import queue
+import threading
+import time
+
+from L2.FrameAnalytics import FrameAnalytics
+
+# Delivery policies
+LATEST = 'latest'  # Only the newest frame waits for the consumer, older frames are dropped (displays)
+LOSSLESS = 'lossless'  # Every frame is delivered (recording)
+SYNC = 'sync'  # Called on the acquisition thread (fast consumers that need every frame immediately)
+
+
+class Frame:
+    """
+    An image from the camera. The image is read-only so every consumer can share the same buffer.
+
+    Frames that share a buffer owned by someone else (ie a FrameRing slot) give it back when the last reference is
+    released. Consumers that keep the image after their callback returns should hold a reference (acquire/release)
+    or copy it.
+    """
+
+    def __init__(self, buffer, pool=None, sequence=0, timestamp=None, metadata=None):
+        """
+        :param buffer: np.ndarray, the image data
+        :param pool: owner of the buffer, pool.recycle(buffer) is called when the frame is released (None if the
+        buffer is not recycled)
+        :param sequence: int, frame number in the acquisition
+        :param timestamp: float, time.time() of the frame (None for now)
+        :param metadata: dict, any other information about the frame
+        """
+        self._buffer = buffer
+        self._pool = pool
+        self.image = buffer.view()
+        self.image.flags.writeable = False
+        self.sequence = sequence
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.metadata = {} if metadata is None else metadata
+        self._references = 1
+        self._lock = threading.Lock()
+        # Statistics shared by every consumer of the image, see L2.FrameAnalytics.analytics_of
+        self.analytics = FrameAnalytics(self.image).register()
+
+    def acquire(self):
+        """
+        Adds a reference to the frame
+        :return: self
+        """
+        with self._lock:
+            if self._references <= 0:
+                raise RuntimeError(f"Frame {self.sequence} was already released")
+            self._references += 1
+        return self
+
+    def release(self):
+        """
+        Removes a reference, the buffer goes back to its owner when there are no references left
+        :return:
+        """
+        with self._lock:
+            self._references -= 1
+            references = self._references
+        if references == 0 and self._pool is not None:
+            # The buffer gets a new image, the cached statistics are for the old one
+            self.analytics.clear()
+            self._pool.recycle(self._buffer)
+
+    @property
+    def references(self):
+        return self._references
+
+
+class FrameSubscriber:
+    """
+    Delivers frames to a callback function (func(image) with the read-only image) on its own thread, or on the
+    acquisition thread for the SYNC policy. The frame is released once the callback returns.
+    """
+
+    def __init__(self, func, policy=LOSSLESS, tag='default'):
+        """
+        :param func: function object
+        :param policy: LATEST, LOSSLESS or SYNC
+        :param tag: str, used to remove the subscriber
+        """
+        assert policy in (LATEST, LOSSLESS, SYNC), f"Unknown delivery policy {policy}"
+        self.func = func
+        self.policy = policy
+        self.tag = tag
+        self.delivered = 0
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=1 if policy == LATEST else 0)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+        if policy != SYNC:
+            self._thread = threading.Thread(target=self._run, name=f'FrameSubscriber {tag}', daemon=True)
+            self._thread.start()
+
+    def deliver(self, frame):
+        """
+        Queues a frame for the subscriber, the subscriber takes over one reference to the frame
+        :param frame: Frame
+        :return:
+        """
+        if self.policy == SYNC:
+            self._call(frame)
+            return
+        with self._lock:
+            if self._closed:
+                frame.release()
+                return
+            if self.policy == LATEST:
+                try:
+                    old = self._queue.get_nowait()
+                    if old is not None:
+                        old.release()
+                        self.dropped += 1
+                except queue.Empty:
+                    pass
+            self._queue.put_nowait(frame)
+
+    def _call(self, frame):
+        try:
+            self.func(frame.image)
+            self.delivered += 1
+        except Exception as e:
+            logging.error(f"Frame subscriber {self.tag} failed: {e}")
+        finally:
+            frame.release()
+
+    def _run(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            self._call(frame)
+
+    def pending(self):
+        """ Returns the number of frames waiting for the subscriber """
+        return self._queue.qsize()
+
+    def close(self, timeout=None):
+        """
+        Stops the subscriber after the queued frames are delivered (LATEST drops the queued frame)
+        :param timeout: float, seconds to wait for the queued frames (None waits until they are delivered)
+        :return:
+        """
+        if self._thread is None:
+            return
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self.policy == LATEST:
+                try:
+                    old = self._queue.get_nowait()
+                    if old is not None:
+                        old.release()
+                except queue.Empty:
+                    pass
+            self._queue.put(None)
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+
+class FrameDispatcher:
+    """
+    Fans published frames out to the subscribers. Publishing only adds a reference per subscriber, the image is
+    never copied.
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, func, policy=LOSSLESS, tag='default'):
+        """
+        Adds a subscriber
+        :param func: function object called with each image
+        :param policy: LATEST, LOSSLESS or SYNC
+        :param tag: str
+        :return: FrameSubscriber
+        """
+        subscriber = FrameSubscriber(func, policy, tag)
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, tag, timeout=None):
+        """
+        Removes all the subscribers with a tag, LOSSLESS subscribers finish their queued frames first
+        :param tag: str
+        :param timeout: float, seconds to wait for each subscriber
+        :return:
+        """
+        with self._lock:
+            removed = [sub for sub in self._subscribers if sub.tag == tag]
+            self._subscribers = [sub for sub in self._subscribers if sub.tag != tag]
+        for subscriber in removed:
+            subscriber.close(timeout)
+
+    def publish(self, frame):
+        """
+        Sends the frame to every subscriber. The caller keeps its own reference and releases it when done.
+        :param frame: Frame
+        :return:
+        """
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.deliver(frame.acquire())
+
+    def get_statistics(self):
+        """
+        Returns the delivered, dropped and pending frames of each subscriber
+        :return: list of dict
+        """
+        with self._lock:
+            return [{'tag': sub.tag, 'policy': sub.policy, 'delivered': sub.delivered, 'dropped': sub.dropped,
+                     'pending': sub.pending()} for sub in self._subscribers]
@@ -0,0 +1,264 @@
+"""
+Camera frames in shared memory, so processes can exchange images without pickling or copying them.
+
+FrameRing : a ring of image slots in a multiprocessing.shared_memory block. One process writes the frames, other
+processes attach to the ring by name and read them in place.
+
+The writer never waits for the readers. A reader with a reader index holds the frames it is using and the writer
+drops new frames instead of overwriting a held slot (counted in get_statistics). Readers without an index (ie a
+display that only wants the newest image) don't hold anything, a slot that is overwritten while it is read is
+detected from the slot sequence.
+"""
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from L2.FramePool import Frame
+
+RING_HEADER = np.dtype([('slots', np.int64), ('height', np.int64), ('width', np.int64), ('dtype', 'S8'),
+                        ('readers', np.int64), ('written', np.int64), ('dropped', np.int64)])
+RING_SLOT = np.dtype([('sequence', np.int64), ('writing', np.int64), ('height', np.int64), ('width', np.int64),
+                      ('time', np.float64)])
+
+
+def _attach_memory(name):
+    """
+    Opens existing shared memory without registering it with this process's resource tracker, only the process
+    that created the ring removes it
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 always registers the memory
+        memory = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+class _HeldSlot:
+    """ Releases a held ring slot when the Frame that shares it is released (the owner of the frame buffer) """
+
+    def __init__(self, ring, sequence):
+        self.ring = ring
+        self.sequence = sequence
+
+    def recycle(self, buffer):
+        self.ring.release(self.sequence)
+
+
+class FrameRing:
+    """
+    Ring of image slots in shared memory. Each slot holds one image up to the ring height and width (a smaller
+    image, ie binned or with an ROI, uses the start of the slot).
+
+    write : copies an image into the next slot (writer process)
+    latest : sequence number of the newest complete frame
+    get : returns a read-only view of a frame in the ring
+    get_frame : returns a held frame as a FramePool Frame, the slot is released with the frame
+    """
+
+    def __init__(self, name=None, slots=16, shape=(2048, 2048), dtype=np.uint16, readers=4, create=True):
+        """
+        :param name: str, shared memory name (None picks a unique name when creating)
+        :param slots: int, number of images in the ring
+        :param shape: (height, width) of the largest image
+        :param dtype: numpy dtype of the images
+        :param readers: int, number of reader indexes that can hold frames
+        :param create: bool, create the shared memory (the writer) or attach to an existing ring by name
+        """
+        if create:
+            itemsize = np.dtype(dtype).itemsize
+            size = RING_HEADER.itemsize + RING_SLOT.itemsize * slots + 8 * readers + \
+                slots * shape[0] * shape[1] * itemsize
+            self._memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self._map(slots, readers)
+            self.header['slots'], self.header['height'], self.header['width'] = slots, shape[0], shape[1]
+            self.header['dtype'] = np.dtype(dtype).str.encode()
+            self.header['readers'] = readers
+            self.header['written'] = self.header['dropped'] = 0
+            self.slots['sequence'] = -1
+            self.slots['writing'] = 0
+            self.holds[:] = -1
+        else:
+            self._memory = _attach_memory(name)
+            header = np.ndarray(1, RING_HEADER, buffer=self._memory.buf)[0]
+            self._map(int(header['slots']), int(header['readers']))
+        self.name = self._memory.name
+        self.owner = create
+        self.dtype = np.dtype(self.header['dtype'].decode())
+        self.shape = (int(self.header['height']), int(self.header['width']))
+        self._images = np.ndarray((len(self.slots), self.shape[0] * self.shape[1]), self.dtype,
+                                  buffer=self._memory.buf, offset=self._data_offset)
+        self.reader = None
+        self._held = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def attach(cls, name, reader=None):
+        """
+        Attaches to a ring created by another process
+        :param name: str, shared memory name of the ring
+        :param reader: int, reader index used to hold frames (None reads without holding)
+        :return: FrameRing
+        """
+        ring = cls(name, create=False)
+        if reader is not None:
+            assert 0 <= reader < len(ring.holds), f"Reader index {reader} is not in the ring"
+            ring.reader = reader
+            ring.holds[reader] = -1
+        return ring
+
+    def _map(self, slots, readers):
+        buf = self._memory.buf
+        offset = RING_HEADER.itemsize
+        self._header = np.ndarray(1, RING_HEADER, buffer=buf)
+        self.slots = np.ndarray(slots, RING_SLOT, buffer=buf, offset=offset)
+        offset += RING_SLOT.itemsize * slots
+        self.holds = np.ndarray(readers, np.int64, buffer=buf, offset=offset)
+        self._data_offset = offset + 8 * readers
+
+    @property
+    def header(self):
+        return self._header[0]
+
+    def write(self, img, timestamp=None):
+        """
+        Copies an image into the next slot
+        :param img: np.ndarray (height, width) no larger than the ring shape
+        :param timestamp: float, time.time() of the image (None for now)
+        :return: int, sequence number of the frame or None if it was dropped because a reader holds the slot
+        """
+        img = np.asarray(img)
+        height, width = img.shape[:2]
+        if height > self.shape[0] or width > self.shape[1] or img.size != height * width:
+            raise ValueError(f"Image {img.shape} doesn't fit the frame ring {self.shape}")
+        sequence = int(self.header['written'])
+        index = sequence % len(self.slots)
+        slot = self.slots[index]
+        previous = int(slot['sequence'])
+        # The slot is claimed before the holds are checked: a reader publishes its hold before it validates the
+        # slot, so either the reader sees the claim or the writer sees the hold
+        slot['writing'] = 1
+        slot['sequence'] = sequence
+        held = self.holds[self.holds >= 0]
+        if previous >= 0 and np.any(held <= previous):
+            # Nothing was written, the held frame is still intact
+            slot['sequence'] = previous
+            slot['writing'] = 0
+            self.header['dropped'] += 1
+            return None
+        self._images[index, :height * width].reshape(height, width)[...] = img
+        slot['height'], slot['width'] = height, width
+        slot['time'] = time.time() if timestamp is None else timestamp
+        slot['writing'] = 0
+        self.header['written'] = sequence + 1
+        return sequence
+
+    def latest(self):
+        """
+        Returns the sequence number of the newest frame
+        :return: int, -1 before the first frame
+        """
+        return int(self.header['written']) - 1
+
+    def _valid(self, sequence):
+        slot = self.slots[sequence % len(self.slots)]
+        return slot['sequence'] == sequence and not slot['writing']
+
+    def get(self, sequence):
+        """
+        Returns a read-only view of a frame. A frame that isn't held can be overwritten by the writer, check valid()
+        after using the image or use get_frame.
+        :param sequence: int
+        :return: (np.ndarray, float time.time() of the frame) or None if the frame was overwritten or not written yet
+        """
+        if sequence < 0 or not self._valid(sequence):
+            return None
+        index = sequence % len(self.slots)
+        slot = self.slots[index]
+        height, width, timestamp = int(slot['height']), int(slot['width']), float(slot['time'])
+        img = self._images[index, :height * width].reshape(height, width)
+        img.flags.writeable = False
+        if not self._valid(sequence):
+            return None
+        return img, timestamp
+
+    def valid(self, sequence):
+        """
+        Returns whether a frame is still in the ring
+        :param sequence: int
+        :return: bool
+        """
+        return self._valid(sequence)
+
+    def hold(self, sequence):
+        """
+        Keeps the writer from overwriting a frame (and every newer frame) until it is released. The hold is published
+        before the frame is validated, see write.
+        :param sequence: int
+        :return: bool, False if the frame was already overwritten
+        """
+        assert self.reader is not None, "Attach with a reader index to hold frames"
+        with self._lock:
+            self._held[sequence] = self._held.get(sequence, 0) + 1
+            self.holds[self.reader] = min(self._held)
+        if not self._valid(sequence):
+            self.release(sequence)
+            return False
+        return True
+
+    def release(self, sequence):
+        """
+        Releases a held frame
+        :param sequence: int
+        :return:
+        """
+        with self._lock:
+            count = self._held.get(sequence, 0) - 1
+            if count > 0:
+                self._held[sequence] = count
+            else:
+                self._held.pop(sequence, None)
+            self.holds[self.reader] = min(self._held) if self._held else -1
+
+    def get_frame(self, sequence, **metadata):
+        """
+        Returns a held frame that shares the ring memory, the slot is released when the frame is released
+        :param sequence: int
+        :param metadata: stored with the frame
+        :return: Frame or None if the frame was overwritten
+        """
+        if not self.hold(sequence):
+            return None
+        image = self.get(sequence)
+        if image is None:
+            self.release(sequence)
+            return None
+        img, timestamp = image
+        return Frame(img, _HeldSlot(self, sequence), sequence, timestamp, metadata)
+
+    def get_statistics(self):
+        """
+        Returns the frames written and dropped by the writer
+        :return: dict
+        """
+        return {'written': int(self.header['written']), 'dropped': int(self.header['dropped'])}
+
+    def close(self):
+        """
+        Detaches from the shared memory, the writer also removes it
+        :return:
+        """
+        if self.reader is not None:
+            self.holds[self.reader] = -1
+        # The numpy views have to go before the memory can be closed
+        self._images = self.slots = self.holds = self._header = None
+        try:
+            self._memory.close()
+        except BufferError:
+            # Frames that are still referenced keep the memory mapped until they are garbage collected
+            pass
+        if self.owner:
+            self._memory.unlink()
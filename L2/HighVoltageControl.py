@@ -1,11 +1,101 @@
 # Implement a Factory for the pressure control.
 import logging
-import struct
 import threading
+import time
 from abc import ABC, abstractmethod
 import numpy as np
 from L2.Utility import UtilityControl, UtilityFactory
+from L2.DataStore import ArrayStore
 from L1 import DAQControllers, Controllers
+from L1.SerialFrames import FrameDecoder, PMOD_FRAME, PMOD_SYNC, PMOD_TRIPPED
+
+
+class TripMonitor:
+    """
+    Over-current and arc protection for a high voltage supply.
+
+    check is called with every chunk of readback samples as it is acquired. Each chunk is tested in one vectorized
+    pass for currents above max_current (uA) and for current rising faster than max_slope (uA/s), which is how an arc
+    shows up before the current settles. The last sample of the previous chunk is kept so a jump across the chunk
+    boundary is still caught. Once tripped the monitor stays tripped until reset is called.
+
+    trips : list of dictionaries describing each trip, including the latency from the offending sample to the
+    completed shutdown
+    """
+
+    def __init__(self, max_current=np.inf, max_slope=np.inf):
+        self.max_current = max_current
+        self.max_slope = max_slope
+        self.tripped = False
+        self.trips = []
+        self._last_time = None
+        self._last_current = None
+
+    def reset(self):
+        """
+        Re-arms the monitor after a trip
+        :return:
+        """
+        self.tripped = False
+        self._last_time = None
+        self._last_current = None
+
+    def check(self, time_data, current):
+        """
+        Checks a chunk of current readings
+        :param time_data: array of sample times (s)
+        :param current: array of current readings (uA), or 2-D array with a row for each channel
+        :return: None if the chunk is safe, otherwise (reason, sample index, value)
+        """
+        time_data = np.asarray(time_data, dtype=float)
+        current = np.atleast_2d(np.asarray(current, dtype=float))
+        if time_data.size == 0:
+            return None
+        previous_time, previous_current = self._last_time, self._last_current
+        self._last_time = time_data[-1]
+        self._last_current = current[:, -1]
+
+        over = np.flatnonzero(np.any(current > self.max_current, axis=0))
+        arc = np.asarray([], dtype=int)
+        if np.isfinite(self.max_slope):
+            # A new measurement restarts the time, the previous chunk is only used if it came just before this one
+            if previous_time is not None and previous_time < time_data[0] and len(previous_current) == len(current):
+                times = np.concatenate([[previous_time], time_data])
+                currents = np.column_stack([previous_current, current])
+            else:
+                times = time_data
+                currents = current
+            with np.errstate(divide='ignore', invalid='ignore'):
+                slope = np.diff(currents, axis=1) / np.diff(times)
+            # Index the arc by the sample at the end of the jump
+            arc = np.flatnonzero(np.any(slope > self.max_slope, axis=0)) + 1 - (len(times) - len(time_data))
+
+        trip = None
+        if len(over) > 0:
+            trip = ('over-current', int(over[0]), float(np.nanmax(current[:, over[0]])))
+        if len(arc) > 0 and (trip is None or arc[0] < trip[1]):
+            trip = ('arc', int(arc[0]), float(np.nanmax(current[:, arc[0]])))
+        return trip
+
+    def record(self, trip, sample_time, buffered_time, detected_at):
+        """
+        Marks the monitor as tripped and records the trip latency. Call this after the supply is shut down.
+        :param trip: (reason, sample index, value) returned by check
+        :param sample_time: float, acquisition time of the offending sample (s)
+        :param buffered_time: float, time the offending sample spent in the acquisition buffer before the chunk
+        arrived (s)
+        :param detected_at: float, time.perf_counter() when the chunk arrived
+        :return: dictionary describing the trip
+        """
+        shutdown_time = time.perf_counter() - detected_at
+        self.tripped = True
+        event = {'reason': trip[0], 'value': trip[2], 'sample_time': float(sample_time), 'time': time.time(),
+                 'buffered_time': buffered_time, 'shutdown_time': shutdown_time,
+                 'latency': buffered_time + shutdown_time}
+        self.trips.append(event)
+        logging.error(f"High voltage trip ({trip[0]}, {trip[2]:.2f} uA at {sample_time:.3f} s). "
+                      f"Supply stopped {event['latency'] * 1000:.1f} ms after the sample")
+        return event
 
 
 class HighVoltageAbstraction(ABC):
@@ -18,6 +108,11 @@ class HighVoltageAbstraction(ABC):
     start = Applies a voltage according to the corresponding set value
     get_voltage = Returns the voltage reading
     get_current = returns the current reading
+    get_data = Returns the recorded time, voltage and current readings
+    get_range = Returns the recorded readings between two time points
+    set_protection = Sets the over-current and arc trip limits
+    add_listener = Calls a function with every block of readbacks that is recorded
+    reset_trip = Re-arms the supply after a trip
     """
 
     def __init__(self, controller, role):
@@ -26,8 +121,9 @@ class HighVoltageAbstraction(ABC):
         self._set_voltages = {}
         self._voltages = 0
         self._current = 0
-        self.data = {'voltage': [], 'current': [], 'time_data': []}
+        self.store = ArrayStore(('time_data', 'voltage', 'current'))
         self._data_lock = threading.Lock()
+        self.protection = TripMonitor()
 
     @abstractmethod
     def set_voltage(self, voltage, channel):
@@ -64,7 +160,60 @@ class HighVoltageAbstraction(ABC):
         :return:
         """
         with self._data_lock:
-            return self.data.copy()
+            return self.store.get_data()
+
+    def get_range(self, start=None, stop=None):
+        """
+        Returns the data dictionary for readings with start <= time <= stop
+        :param start: float, seconds (None for the first reading)
+        :param stop: float, seconds (None for the last reading)
+        :return:
+        """
+        with self._data_lock:
+            return self.store.get_range(start, stop)
+
+    def add_listener(self, func):
+        """
+        Calls func with a dictionary ('time_data', 'voltage', 'current') of every block of readbacks that is
+        recorded, and with None when the record is cleared (see DataStoreAbstraction.add_listener)
+        :param func: function object
+        :return:
+        """
+        self.store.add_listener(func)
+
+    def set_protection(self, max_current=np.inf, max_slope=np.inf):
+        """
+        Sets the trip limits checked on every chunk of readback data. The supply is shut down as soon as a chunk
+        has a current above max_current or a current rising faster than max_slope.
+        :param max_current: float, uA (np.inf turns the check off)
+        :param max_slope: float, uA/s (np.inf turns the check off)
+        :return:
+        """
+        self.protection.max_current = max_current
+        self.protection.max_slope = max_slope
+
+    def reset_trip(self):
+        """
+        Re-arms the supply after a trip, start will apply voltages again
+        :return:
+        """
+        self.protection.reset()
+
+    def get_trips(self):
+        """
+        Returns the recorded trips with their latency metrics
+        :return: list of dictionaries
+        """
+        return list(self.protection.trips)
+
+    def _check_tripped(self):
+        """
+        Returns True (and logs it) if the supply is tripped and should not be started
+        :return:
+        """
+        if self.protection.tripped:
+            logging.error(f"{self.role} is tripped, call reset_trip before applying voltage")
+        return self.protection.tripped
 
 
 class PMOD_DAC(HighVoltageAbstraction):
@@ -77,6 +226,8 @@ class PMOD_DAC(HighVoltageAbstraction):
     """
     _max_voltage = 5  # The absolute maximum voltage you can request
     _index = 0
+    _adc_scalar = 5 / 1023  # Arduino 10 bit ADC counts to volts
+    stream_period = 0  # microseconds between streamed frames, 0 streams as fast as the firmware can read the ADC
     lock = threading.RLock()
     run_data = None
 
@@ -100,6 +251,11 @@ class PMOD_DAC(HighVoltageAbstraction):
 
         This is a little trickier than the spellman in that we have two controllers to work with. One to set the analog
         output control voltage and one that reads it in.
+
+        If only the arduino controller is given, the voltage and current readouts are wired to the Arduino analog pins
+        and the firmware streams them back as binary frames (see PMOD_DAC.ino and L1.SerialFrames). The output voltage
+        and current channels are then the Arduino analog pin numbers:
+        utility, ard1, high_voltage, chip_voltage, pmod, [3,4,5], ['0','2','NA'], ['1','3','NA']
         """
         super().__init__(controller, role)
         try:
@@ -112,54 +268,107 @@ class PMOD_DAC(HighVoltageAbstraction):
         print(input_channels, output_voltage, output_current)
         assert len(output_current) == len(input_channels) == len(output_voltage), "All Bertan config channel lengths" \
                                                                                   "must match"
+        # Read the monitor channels with the Arduino ADC if there is no DAQ
+        self._firmware_readback = not isinstance(self.daqcontroller, DAQControllers.DaqAbstraction)
+
         # Set up DAC information
         self.voltages = {}
+        self.stores = {}
+        self._adc_pins = {}
         self._input_channels = []
         self._voltage_scalar = 1
         self._current_scalar = 1
         for in_ch, out_voltage, out_current in zip(input_channels, output_voltage, output_current) :
             self.voltages[in_ch] = [0, 0]
-            if out_voltage.upper() != "NA":
-                self.daqcontroller.add_analog_input(out_voltage, terminal_config='NRSE')
-            if out_current.upper() != "NA":
-                self.daqcontroller.add_analog_input(out_current, terminal_config='NRSE')
+            self.stores[in_ch] = ArrayStore(('time_data', 'voltage', 'current'))
+            self._adc_pins[in_ch] = (out_voltage, out_current)
+            if not self._firmware_readback:
+                if out_voltage.upper() != "NA":
+                    self.daqcontroller.add_analog_input(out_voltage, terminal_config='NRSE')
+                if out_current.upper() != "NA":
+                    self.daqcontroller.add_analog_input(out_current, terminal_config='NRSE')
 
             self._input_channels.append(out_voltage)
             self._input_channels.append(out_current)
 
-        self.daqcontroller.add_callback(self._read_data, self._input_channels, 'wave', ())
+        self._decoder = FrameDecoder(PMOD_FRAME, PMOD_SYNC)
+        self._stream_flag = threading.Event()
+        self._stream_thread = threading.Thread()
+        if not self._firmware_readback:
+            daq_channels = [channel for channel in self._input_channels if channel.upper() != "NA"]
+            self.daqcontroller.add_callback(self._read_data, daq_channels, 'wave', ())
+            self.daqcontroller.add_chunk_hook(self._check_chunk, daq_channels)
+
     def _reset_data(self):
-        v_data = {}
-        c_data = {}
-        for i in self.voltages.keys():
-            v_data[i]=[]
-            c_data[i]=[]
-        with self.lock:
-            self.data['voltage']=v_data
-            self.data['current']=c_data
+        with self._data_lock:
+            for store in self.stores.values():
+                store.clear()
+            self._decoder.reset()
 
+    def get_data(self):
+        """
+        Returns the data dictionary. Voltage and current are dictionaries with an array for each channel.
+        :return:
+        """
+        return self.get_range()
 
-    def get_current(self):
-        with self.lock:
-            data = self.data['current'].copy()
+    def get_range(self, start=None, stop=None):
+        """
+        Returns the data dictionary for readings with start <= time <= stop. Voltage and current are dictionaries
+        with an array for each channel.
+        :param start: float, seconds (None for the first reading)
+        :param stop: float, seconds (None for the last reading)
+        :return:
+        """
+        data = {'voltage': {}, 'current': {}, 'time_data': np.asarray([])}
+        with self._data_lock:
+            for channel, store in self.stores.items():
+                channel_data = store.get_range(start, stop)
+                data['voltage'][channel] = channel_data['voltage']
+                data['current'][channel] = channel_data['current']
+                data['time_data'] = channel_data['time_data']
         return data
 
+    def add_listener(self, func):
+        """
+        Calls func with every block of readbacks recorded for the first channel, and with None when the record is
+        cleared (see DataStoreAbstraction.add_listener)
+        :param func: function object
+        :return:
+        """
+        list(self.stores.values())[0].add_listener(func)
+
+    def get_current(self):
+        with self._data_lock:
+            return {channel: store.get_data()['current'] for channel, store in self.stores.items()}
+
     def get_voltage(self):
-        with self.lock:
-            data = self.data['voltage'].copy()
-        return data
+        with self._data_lock:
+            return {channel: store.get_data()['voltage'] for channel, store in self.stores.items()}
 
     def read_arduino(self):
         with self.lock:
             response = self.controller.read_until('\n'.encode())
         return response.decode()
 
+    def _send(self, command):
+        """
+        Sends a command to the Arduino. While the firmware is streaming, the command is only written so the stream
+        bytes are not consumed looking for a response.
+        :param command: str or bytes
+        :return:
+        """
+        if self._stream_flag.is_set():
+            self.controller.write(command)
+        else:
+            self.controller.send_command(command)
+
     def load_changes(self):
         """
         Loads the changes from every channels input register to the DAC
         :return:
         """
-        self.controller.send_command("U?00\n")
+        self._send("U?00\n")
 
     def _load_channel_changes(self, chnl):
         """
@@ -168,21 +377,172 @@ class PMOD_DAC(HighVoltageAbstraction):
         :return:
         """
 
-        self.controller.send_command("U{}00\n".format(chnl))
+        self._send("U{}00\n".format(chnl))
 
     def _power_down(self):
         """
         Disables the Bertan Enable pin. Resets all the DAC.
         :return:
         """
-        self.controller.send_command("X000\n")
+        self._send("X000\n")
 
     def _power_on(self):
         """
         Turns on the Bertan Enable Pin.
         :return:
         """
-        self.controller.send_command("E000\n")
+        self._send("E000\n")
+
+    def _set_adc_pins(self):
+        """
+        Tells the firmware which Arduino analog pins read the voltage and current monitor of each channel
+        :return:
+        """
+        for channel, (voltage_pin, current_pin) in self._adc_pins.items():
+            pins = ['N' if pin.upper() == 'NA' else pin for pin in [voltage_pin, current_pin]]
+            self._send("P{}{}{}\n".format(channel, *pins))
+
+    def _set_trip_limits(self):
+        """
+        Sends the over-current limit to the firmware (in ADC counts) so the firmware powers down the supply on the
+        same ADC read that crosses it
+        :return:
+        """
+        limit = 0
+        if np.isfinite(self.protection.max_current):
+            limit = int(np.clip(np.ceil(self.protection.max_current * self._current_scalar / self._adc_scalar), 1,
+                                1023))
+        msb, lsb = divmod(limit, 0x100)
+        for channel, (_, current_pin) in self._adc_pins.items():
+            if current_pin.upper() != "NA":
+                self._send(bytes("K{}".format(channel).encode()) + bytearray([msb, lsb]) + bytes("\n".encode()))
+
+    def set_protection(self, max_current=np.inf, max_slope=np.inf):
+        """
+        Sets the trip limits checked on every frame or chunk of readback data. When the firmware reads the monitor
+        channels, the current limit is also checked in the firmware.
+        :param max_current: float, current readback units (np.inf turns the check off)
+        :param max_slope: float, current readback units per second (np.inf turns the check off)
+        :return:
+        """
+        super().set_protection(max_current, max_slope)
+        if self._firmware_readback:
+            self._set_trip_limits()
+
+    def _trip(self, trip, time_data, currents, detected_at):
+        """
+        Stops the supply in the firmware and records the trip
+        :param trip: (reason, sample index, value) returned by TripMonitor.check
+        :param time_data: array of sample times in the chunk
+        :param currents: array (channels, samples) of the current readings in the chunk
+        :param detected_at: float, time.perf_counter() when the chunk arrived
+        :return:
+        """
+        with self.lock:
+            self.controller.write("X000\n")
+        self.protection.record(trip, time_data[trip[1]], time_data[-1] - time_data[trip[1]], detected_at)
+
+    def _check_chunk(self, samples, total_samples):
+        """
+        Called by the DAQ in the acquisition thread with every chunk of samples, checks the current channels against
+        the trip limits
+        :param samples: list of arrays, one for each recorded channel
+        :param total_samples: samples acquired including this chunk
+        :return:
+        """
+        detected_at = time.perf_counter()
+        if self.protection.tripped:
+            return
+        recorded = [channel for channel in self._input_channels if channel.upper() != "NA"]
+        currents = [np.asarray(samples[recorded.index(channel)]) / self._current_scalar
+                    for channel in self._input_channels[1::2] if channel.upper() != "NA"]
+        if len(currents) == 0:
+            return
+        currents = np.asarray(currents)
+        rate = self.daqcontroller.get_sampling_frequency()
+        time_data = (total_samples - currents.shape[1] + np.arange(currents.shape[1])) / rate
+        trip = self.protection.check(time_data, currents)
+        if trip is not None:
+            self._trip(trip, time_data, currents, detected_at)
+
+    def _check_frames(self, frames, time_data, currents, detected_at):
+        """
+        Checks decoded frames for a firmware trip or a reading over the trip limits
+        :param frames: structured array of PMOD_FRAME
+        :param time_data: array of frame times
+        :param currents: array (channels, frames) of the current readings
+        :param detected_at: float, time.perf_counter() when the frames arrived
+        :return:
+        """
+        if self.protection.tripped:
+            return
+        trip = self.protection.check(time_data, currents)
+        firmware_trip = np.flatnonzero(frames['flags'] & PMOD_TRIPPED)
+        if len(firmware_trip) > 0 and (trip is None or firmware_trip[0] <= trip[1]):
+            # The firmware powered down on the same ADC read, there is no added latency to record
+            idx = int(firmware_trip[0])
+            trip = ('firmware over-current', idx, float(np.nanmax(currents[:, idx])))
+            self.protection.record(trip, time_data[idx], 0, time.perf_counter())
+        elif trip is not None:
+            self._trip(trip, time_data, currents, detected_at)
+
+    def _start_stream(self):
+        """
+        Starts the firmware binary stream and the thread that decodes it
+        :return:
+        """
+        msb, lsb = divmod(int(self.stream_period), 0x100)
+        self._stream_flag.set()
+        self.controller.write(bytes("B0".encode()) + bytearray([msb, lsb]) + bytes("\n".encode()))
+        if not self._stream_thread.is_alive():
+            self._stream_thread = threading.Thread(target=self._read_stream, name='PMODStream', daemon=True)
+            self._stream_thread.start()
+
+    def _stop_stream(self):
+        """
+        Halts the firmware stream and waits for the decoding thread to finish
+        :return:
+        """
+        self.controller.write("H000\n")
+        self._stream_flag.clear()
+        if self._stream_thread.is_alive():
+            self._stream_thread.join(2)
+
+    def _read_stream(self):
+        """
+        Reads the binary stream from the Arduino until the stream is stopped and the last frames have arrived
+        :return:
+        """
+        byte_data = b''
+        while self._stream_flag.is_set() or len(byte_data) > 0:
+            byte_data = self.controller.read_bytes()
+            if len(byte_data) > 0:
+                self._add_frames(self._decoder.decode(byte_data))
+
+    def _add_frames(self, frames):
+        """
+        Adds decoded frames to the channel stores
+        :param frames: structured array of PMOD_FRAME
+        :return:
+        """
+        if len(frames) == 0:
+            return
+        detected_at = time.perf_counter()
+        time_data = self._decoder.get_time(frames)
+        currents = []
+        with self._data_lock:
+            for channel, store in self.stores.items():
+                idx = int(channel)
+                voltage_pin, current_pin = self._adc_pins[channel]
+                voltage = frames['voltage'][:, idx] * self._adc_scalar / self._voltage_scalar
+                current = frames['current'][:, idx] * self._adc_scalar / self._current_scalar
+                if voltage_pin.upper() == "NA":
+                    voltage = np.full(len(frames), np.nan)
+                if current_pin.upper() == "NA":
+                    current = np.full(len(frames), np.nan)
+                store.append([time_data, voltage, current])
+                currents.append(current)
+        self._check_frames(frames, time_data, np.asarray(currents), detected_at)
 
     def startup(self):
         """
@@ -191,19 +551,30 @@ class PMOD_DAC(HighVoltageAbstraction):
         """
         self._power_down()
         self._power_on()
+        if self._firmware_readback:
+            self._set_adc_pins()
+            self._set_trip_limits()
 
     def start(self):
         with self.lock:
             self._reset_data()
-        self.load_changes()
-        self.daqcontroller.start_measurement()
+        # Loading the changes also enables the supply in the firmware
+        if not self._check_tripped():
+            self.load_changes()
+        if self._firmware_readback:
+            self._start_stream()
+        else:
+            self.daqcontroller.start_measurement()
 
     def stop(self):
         """
         Resets the daq and disables the daq enable pin
         :return:
         """
-        self.daqcontroller.stop_measurement()
+        if self._firmware_readback:
+            self._stop_stream()
+        else:
+            self.daqcontroller.stop_measurement()
         self._power_down()
 
     def shutdown(self):
@@ -211,6 +582,8 @@ class PMOD_DAC(HighVoltageAbstraction):
         Rests the dac and powers down the enable pin
         :return:
         """
+        if self._stream_flag.is_set():
+            self._stop_stream()
         self._power_down()
 
     def set_voltage(self, voltage, channel):  # Channel refers to channel number on Bertan, from 1 to 6
@@ -243,7 +616,7 @@ class PMOD_DAC(HighVoltageAbstraction):
             cmd = cmd + bytearray([msb, lsb])
             cmd = cmd + bytes("\n".encode())
         with self.lock:
-            self.controller.send_command(cmd)
+            self._send(cmd)
 
     @staticmethod
     def _interpret_bytes(byte_data):
@@ -252,21 +625,17 @@ class PMOD_DAC(HighVoltageAbstraction):
         :return: numpy array of floats corresponding to the voltage [index 0-7] and current [index 8-15] values for channels 0-8
          of the PMOD DAC
         """
-        idx = None
-        for i in range(len(byte_data)):
-            if byte_data[i] == 83:
-                idx = i + 1
-                break
+        byte_data = bytes(byte_data)
+        idx = byte_data.find(b'S')
 
         in_data = np.zeros((1, 16))  # Numpy creates array with 1 row and 16 columns of all zeroes
-        # If we don't have a start index you will have to return a zeros array
-        if idx is None:
+        # If we don't have a start index and all 16 floats you will have to return a zeros array
+        if idx < 0 or len(byte_data) < idx + 1 + 16 * 4:
             logging.warning("Did Not Find Start Character for Read Data")
             return in_data
 
-        # Move through the bytes array and convert 4 bytes into a float for each of the 16 values in the numpy array
-        for i in range(16):
-            in_data[0][1] = struct.unpack('f', byte_data[idx + i * 4:idx + (i * 4 + 4)])[0]
+        # Convert the 16 little endian floats following the start character in one pass
+        in_data[0] = np.frombuffer(byte_data, dtype='<f4', count=16, offset=idx + 1)
         return in_data
 
 
@@ -274,38 +643,26 @@ class PMOD_DAC(HighVoltageAbstraction):
         """
         This function is called during a continuous acquisition of data from the ADC every time_data enough samples are acquired.
         Samples are two lists of data, the first index being for voltage and the second for voltage
-        The samples are added to a thread-safe queue which is checked before returning get_current or get_voltage
+        The samples are added to the array store of each channel
         :param samples:
         :param args:
         :return:
         """
-        # Empty queue
         scalars = [self._voltage_scalar, self._current_scalar]
-        output_channels = list(self.voltages.keys())
+        idx = 0
+        values = []
+        for odd_even, channel in enumerate(self._input_channels):
+            # Only add data if we are getting data from our channels, channels that aren't recorded have the NA name
+            scalar = scalars[odd_even%2]
+            if channel.upper() != "NA":
+                values.append(np.mean(np.asarray(samples[idx]) / scalar))
+                idx += 1
+            else:
+                values.append(np.nan)
+
         with self._data_lock:
-            idx = 0
-            outputs = []
-            for odd_even, channel in enumerate(self._input_channels):
-                # Only add data if we are getting data from our channels, channels that aren't recorded have the NA name
-                scalar = scalars[odd_even%2]
-                if channel.upper() != "NA":
-                    data = np.mean(samples[idx] / scalar)
-                    idx += 1
-                    #print(len(samples))
-                else:
-                    data = np.nan
-                try:
-                    if odd_even%2 > 0:
-                        self.data['current'][output_channels[int((odd_even-1)/2)]].append(data)
-                    elif odd_even%2 == 0:
-                        self.data['voltage'][output_channels[int((odd_even)/2)]].append(data)
-                    else:
-                        print("??")
-                except IndexError:
-                    print("Index Error: ",odd_even, len(output_channels))
-
-
-            self.data['time_data'].append(time_elapsed)
+            for index, store in enumerate(self.stores.values()):
+                store.append([[time_elapsed], [values[2 * index]], [values[2 * index + 1]]])
 
 
 
@@ -315,7 +672,8 @@ class SpellmanPowerSupply(HighVoltageAbstraction, UtilityControl):
     Input Ports should be given in this order:
      Voltage Control - Analog Output,
      Voltage Read - Analog Input*,
-     Current Read - Analog Input *
+     Current Read - Analog Input *,
+     High Voltage Enable - Digital Output * (interlock line, driven low by a trip)
 
      * Inputs are optional and 'na' can be passed in place of a valid channel name.
 
@@ -329,10 +687,13 @@ class SpellmanPowerSupply(HighVoltageAbstraction, UtilityControl):
     """
 
     def __init__(self, controller: DAQControllers.DaqAbstraction, role, hv_ao='ao0',
-                 hv_ai='na', ua_ai='ai1'):
+                 hv_ai='na', ua_ai='ai1', hv_do='na'):
         super().__init__(controller, role)
         self._hv_channel = hv_ao
         self.daqcontroller.add_analog_output(hv_ao)
+        self._enable_channel = None if hv_do.upper() == 'NA' else hv_do
+        if self._enable_channel is not None:
+            self.daqcontroller.add_interlock_channel(self._enable_channel)
 
         inputs = []
         for channel in [hv_ai, ua_ai]:
@@ -342,6 +703,7 @@ class SpellmanPowerSupply(HighVoltageAbstraction, UtilityControl):
 
         self._input_channels = [hv_ai, ua_ai]
         self.daqcontroller.add_callback(self._read_data, inputs, 'wave', ())
+        self.daqcontroller.add_chunk_hook(self._check_chunk, inputs)
         self._voltage_scalar = 1 / 30 * 10  # kV setting / 30 kV * 5 V
         self._current_scalar = 1 / 300 * 10  # uA / 100 uA * 5 V
 
@@ -365,13 +727,26 @@ class SpellmanPowerSupply(HighVoltageAbstraction, UtilityControl):
         :return:
         """
         with self._data_lock:
-            self.data = {'voltage': [], 'current': [], 'time_data': []}
-        self.daqcontroller.start_voltage()
+            self.store.clear()
+        if not self._check_tripped():
+            self._set_enable(True)
+            self.daqcontroller.start_voltage()
         self.daqcontroller.start_measurement()
 
     def stop(self):
         """Stop the voltage only (let the ADC keep acquiring)"""
         self.daqcontroller.stop_voltage()
+        self._set_enable(False)
+
+    def _set_enable(self, value):
+        """
+        Drives the high voltage enable line (if one is configured)
+        :param value: bool
+        :return:
+        """
+        if self._enable_channel is not None:
+            self.daqcontroller.set_do_channel(self._enable_channel, value)
+            self.daqcontroller.update_do_channels()
 
     def set_voltage(self, voltage=0, channel='default'):
         """
@@ -392,7 +767,7 @@ class SpellmanPowerSupply(HighVoltageAbstraction, UtilityControl):
         :return:
         """
         with self._data_lock:
-            return self.data['current'][-1]
+            return self.store.get_latest('current')
 
     def get_voltage(self):
         """
@@ -400,31 +775,51 @@ class SpellmanPowerSupply(HighVoltageAbstraction, UtilityControl):
         :return:
         """
         with self._data_lock:
-            return self.data['voltage'][-1]
+            return self.store.get_latest('voltage')
 
     def _read_data(self, samples, time_elapsed, *args):
         """
         This function is called during a continuous acquisition of data from the ADC every time_data enough samples are acquired.
         Samples are two lists of data, the first index being for voltage and the second for voltage
-        The samples are added to a thread-safe queue which is checked before returning get_current or get_voltage
+        The mean of each chunk is added to the array store which is read by get_current or get_voltage
         :param samples:
         :param args:
         :return:
         """
-        # Empty queue
+        idx = 0
+        outputs = []
+        for channel, scalar in zip(self._input_channels,
+                                   [self._voltage_scalar, self._current_scalar]):
+            # Only add data if we are getting data from our channels, channels that aren't recorded have the NA name
+            if channel.upper() != "NA":
+                outputs.append(np.mean(np.asarray(samples[idx]) / scalar))
+                idx += 1
+            else:
+                outputs.append(np.nan)
+
         with self._data_lock:
-            idx = 0
-            outputs = []
-            for channel, scalar in zip(self._input_channels,
-                                       [self._voltage_scalar, self._current_scalar]):
-                # Only add data if we are getting data from our channels, channels that aren't recorded have the NA name
-                if channel.upper() != "NA":
-                    outputs.append(np.mean(samples[idx] / scalar))
-                    idx += 1
+            self.store.append([[time_elapsed], [outputs[0]], [outputs[1]]])
 
-            self.data['time_data'].append(time_elapsed)
-            self.data['current'].append(outputs[1])
-            self.data['voltage'].append(outputs[0])
+    def _check_chunk(self, samples, total_samples):
+        """
+        Called by the DAQ in the acquisition thread with every chunk of samples. The current waveform is checked
+        against the trip limits and the DAQ outputs are zeroed as soon as a limit is crossed, so the response is
+        bounded by one chunk period.
+        :param samples: list of arrays, one for each input channel
+        :param total_samples: samples acquired including this chunk
+        :return:
+        """
+        detected_at = time.perf_counter()
+        if self.protection.tripped or self._input_channels[1].upper() == "NA":
+            return
+        current = np.asarray(samples[-1]) / self._current_scalar
+        rate = self.daqcontroller.get_sampling_frequency()
+        time_data = (total_samples - len(current) + np.arange(len(current))) / rate
+        trip = self.protection.check(time_data, current)
+        if trip is None:
+            return
+        self.daqcontroller.emergency_stop()
+        self.protection.record(trip, time_data[trip[1]], (len(current) - 1 - trip[1]) / rate, detected_at)
 
 
 class HighVoltageFactory(UtilityFactory):
@@ -440,7 +835,8 @@ class HighVoltageFactory(UtilityFactory):
         """
         settings = args[0]
         if settings[4] == 'spellman':
-            return SpellmanPowerSupply(controller, role, settings[5], settings[6], settings[7])
+            hv_do = settings[8] if len(settings) > 8 else 'na'
+            return SpellmanPowerSupply(controller, role, settings[5], settings[6], settings[7], hv_do)
         elif settings[4] == 'pmod':
             print(settings[5],settings[6],settings[7])
 
@@ -462,8 +858,95 @@ def test_spellman():
 
 
 def test_pmod():
+    """
+    Streams binary frames from the PMOD_DAC firmware emulator (pseudo terminal) through the Arduino controller and
+    checks every frame is decoded into the channel stores.
+    :return:
+    """
+    from L1.Emulators import PMODEmulator
 
-    return
+    firmware = PMODEmulator().start()
+    controller = Controllers.ArduinoController(firmware.port)
+    controller.open()
+    power = PMOD_DAC(controller, 'testing', ('0', '1'), ('0', '2'), ('1', 'NA'))
+    power.startup()
+    power.set_voltage(1000, '0')
+    power.stream_period = 1000
+    power.start()
+    time.sleep(1)
+    power.stop()
+    data = power.get_data()
+    controller.close()
+    firmware.close()
+
+    assert len(data['time_data']) > 100, "Frames were not streamed"
+    assert len(data['time_data']) == firmware.frames_sent, "Not every frame was decoded"
+    assert power._decoder.bad_frames == 0 and power._decoder.dropped_frames == 0
+    assert np.allclose(data['voltage']['0'], 1, atol=0.01)
+    assert np.all(np.isnan(data['current']['1']))
+    assert np.all(np.diff(data['time_data']) > 0)
+    return power
+
+
+def test_spellman_trip():
+    """
+    The simulated DAQ current readback swings to 30 uA, so a 20 uA limit trips on the first chunk. The trip should
+    zero the outputs from the acquisition thread within one chunk period.
+    :return:
+    """
+    controller = DAQControllers.SimulatedDaq()
+    power = SpellmanPowerSupply(controller, role='testing', hv_ao='0', hv_ai='0', ua_ai='1', hv_do='do0')
+    controller.add_do_channel('do1')
+    controller.set_do_channel('do1', True)
+    power.set_protection(max_current=20)
+    power.set_voltage(10)
+    power.start()
+    time.sleep(1.5)
+    controller.stop_measurement()
+
+    trips = power.get_trips()
+    assert len(trips) == 1 and trips[0]['reason'] == 'over-current'
+    assert trips[0]['latency'] <= controller._samples / controller.get_sampling_frequency()
+    assert not controller._voltage, "The DAQ output was not stopped"
+    assert not controller._set_do_values['do0'], "The enable line was not driven low"
+    assert controller._set_do_values['do1'], "Only the enable line should be driven by a trip"
+    power.start()
+    assert not controller._voltage, "A tripped supply should not apply voltage"
+    controller.stop_measurement()
+    return power
+
+
+def test_pmod_trip():
+    """
+    Simulates an arc on channel 0 of the PMOD_DAC firmware emulator. The firmware trip powers down the supply on the
+    same ADC read and flags the frame.
+    :return:
+    """
+    from L1.Emulators import PMODEmulator
+
+    firmware = PMODEmulator().start()
+    controller = Controllers.ArduinoController(firmware.port)
+    controller.open()
+    power = PMOD_DAC(controller, 'testing', ('0',), ('0',), ('1',))
+    power.startup()
+    power.set_protection(max_current=2)
+    power.set_voltage(1000, '0')
+    power.stream_period = 1000
+    power.start()
+    time.sleep(0.3)
+    assert not power.protection.tripped
+    firmware.fault_current[0] = 300
+    time.sleep(0.3)
+    power.stop()
+    data = power.get_data()
+    controller.close()
+    firmware.close()
+
+    trips = power.get_trips()
+    assert firmware.tripped and not firmware.enabled
+    assert len(trips) == 1 and trips[0]['reason'] == 'firmware over-current'
+    assert np.all(data['voltage']['0'][data['time_data'] > trips[0]['sample_time']] == 0)
+    return power
 
 if __name__ == "__main__":
     import time
@@ -0,0 +1,198 @@
+"""
+Illumination gated by the camera exposure.
+
+Without a gate the camera's presnap and postsnap functions turn the light sources on and off with serial commands
+around every snap. A gate selects the light channels once (arm) and switches the light with a TTL line instead:
+
+CameraTriggerGate : the camera's exposure output drives the light source TTL input, the light is only on while the
+sensor is exposing (no software timing at all)
+DaqGate : a DAQ digital output drives the TTL input, it is switched right before and after each exposure without a
+serial round trip
+SimulatedGate : records when the light would be on, for testing without hardware
+
+The light source must be in its TTL (external) mode, ie a Lumencor Spectra only emits from an enabled channel while
+its TTL input is high.
+"""
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+
+
+class IlluminationGate(ABC):
+    """
+    Switches the light on for camera exposures.
+
+    arm : selects the light channels (and their intensity), they are only lit while the gate is open
+    open, close : called by the camera right before and after a software timed exposure
+    disarm : turns the channels off and returns the hardware to its normal mode
+    """
+    synchronized = False  # True if the hardware opens the gate for each exposure, open and close do nothing
+
+    def __init__(self, light=None):
+        """
+        :param light: light source utility with set_channel(list of channels) and apply_state(channels, intensities)
+        (ie L2.FilterWheelControl.LumencorFilter) or None if the channels are selected elsewhere
+        """
+        self.light = light
+        self.channels = None
+        self.intensity = None
+        self.armed = False
+        self.is_open = False
+
+    def arm(self, channels=None, intensity=None):
+        """
+        Selects the light channels used for the next exposures. Channels that are already selected are not sent again.
+        An intensity is needed when something else (ie a postsnap function) may have turned the channels down, it is
+        kept for the channels armed later.
+        :param channels: list of channel labels (None keeps the current channels)
+        :param intensity: float, 0 to 1, level of the armed channels (None keeps the armed intensity)
+        :return:
+        """
+        if intensity is not None:
+            self.intensity = intensity
+        if self.light is not None and self.intensity is not None:
+            # The light only writes the settings that changed
+            levels = {chn: self.intensity for chn in (channels if channels is not None else self.channels or [])}
+            self.light.apply_state(None if channels is None else list(channels), levels)
+        elif channels is not None and self.light is not None and channels != self.channels:
+            self.light.set_channel(list(channels))
+        if channels is not None:
+            self.channels = list(channels)
+        self.armed = True
+
+    def disarm(self):
+        """
+        Closes the gate and turns the light channels off
+        :return:
+        """
+        if self.is_open:
+            self.close()
+        if self.light is not None and self.channels:
+            self.light.set_channel([])
+        self.channels = None
+        self.intensity = None
+        self.armed = False
+
+    @abstractmethod
+    def open(self):
+        """
+        Turns the light on (software timed gates)
+        :return:
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Turns the light off (software timed gates)
+        :return:
+        """
+
+
+class CameraTriggerGate(IlluminationGate):
+    """
+    The camera exposure output is wired to the light source TTL input. Arming sets the camera properties that route
+    the exposure signal to the output (they depend on the camera, ie ('Andor', 'AuxOutSource (TTL)', 'FireAll')),
+    disarming restores them. Only Pycromanager cameras can set properties.
+    """
+    synchronized = True
+
+    def __init__(self, camera, light=None, properties=()):
+        """
+        :param camera: L2.CameraControl camera
+        :param light: light source utility, see IlluminationGate
+        :param properties: list of (device, property, value) to set on the camera while armed
+        """
+        super().__init__(light)
+        self.camera = camera
+        self.properties = list(properties)
+        self._previous = []
+
+    def arm(self, channels=None, intensity=None):
+        if not self.armed and self.properties:
+            controller = self.camera.controller
+            self._previous = []
+            for device, prop, value in self.properties:
+                self._previous.append((device, prop, controller.send_command(controller.core.get_property,
+                                                                             args=(device, prop))))
+                controller.send_command(controller.core.set_property, args=(device, prop, value))
+        super().arm(channels, intensity)
+
+    def disarm(self):
+        super().disarm()
+        controller = self.camera.controller
+        for device, prop, value in self._previous:
+            controller.send_command(controller.core.set_property, args=(device, prop, value))
+        self._previous = []
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DaqGate(IlluminationGate):
+    """
+    DAQ digital output lines wired to the light source TTL inputs. The lines are written around each exposure, which
+    is a local write to the DAQ instead of serial commands to each light source.
+    """
+
+    def __init__(self, daq, lines, light=None):
+        """
+        :param daq: L1.DAQControllers DAQ controller
+        :param lines: str or list of digital output lines (ie 'port0/line5')
+        :param light: light source utility, see IlluminationGate
+        """
+        super().__init__(light)
+        self.daq = daq
+        self.lines = [lines] if type(lines) is str else list(lines)
+        for line in self.lines:
+            self.daq.add_do_channel(line)
+
+    def _write(self, value):
+        for line in self.lines:
+            self.daq.set_do_channel(line, value)
+        self.daq.update_do_channels()
+
+    def open(self):
+        self._write(True)
+        self.is_open = True
+
+    def close(self):
+        self._write(False)
+        self.is_open = False
+
+
+class SimulatedGate(IlluminationGate):
+    """
+    Stand-in gate that records the intervals the light would be on (time.time() pairs) with the armed channels
+    """
+
+    def __init__(self, light=None):
+        super().__init__(light)
+        self.intervals = []  # (start, stop, channels)
+        self._start = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if not self.armed:
+            logging.warning("Opening an illumination gate that isn't armed")
+        with self._lock:
+            self._start = time.time()
+            self.is_open = True
+
+    def close(self):
+        with self._lock:
+            if self._start is not None:
+                self.intervals.append((self._start, time.time(), self.channels))
+            self._start = None
+            self.is_open = False
+
+    def get_light_time(self):
+        """
+        Returns the total time the light was on
+        :return: float, (s)
+        """
+        with self._lock:
+            return sum(stop - start for start, stop, _ in self.intervals)
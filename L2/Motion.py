@@ -0,0 +1,206 @@
+"""
+Motion models shared by the stage utilities.
+
+MotionPredictor : Predicts how long a move takes from its distance and calibrates itself from the measured arrivals
+PositionCache : Last known position of each stage axis, so readers that accept slightly old data skip the hardware
+"""
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class MotionPredictor:
+    """
+    Predicts the duration of a stage move using a trapezoidal velocity profile (constant acceleration up to the
+    maximum velocity, cruise, then constant deceleration). Short moves never reach the maximum velocity and follow a
+    triangular profile instead.
+
+    The kinematic time is corrected with a scale and an offset (command latency and settling) that are fit to the
+    recorded arrivals, so the prediction improves as the stage is used. An arrival that was already over when it was
+first checked only bounds the duration from above, it can shrink the correction but never grow it.
+
+    predict : returns the predicted duration of a move (s)
+    record : adds a measured arrival and re-fits the correction
+    get_records : returns the recorded predicted and actual durations
+    """
+
+    def __init__(self, settle=0.05, history=50, min_fit=5):
+        """
+        :param settle: float, initial guess of the time added to every move by the command and settling (s)
+        :param history: int, number of recent moves used for the calibration
+        :param min_fit: int, number of moves needed before the scale is fit (the offset is fit from the first move)
+        """
+        self.scale = 1
+        self.settle = settle
+        self.min_fit = min_fit
+        self._records = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def kinematic_time(distance, velocity, acceleration):
+        """
+        Returns the time to travel a distance from rest to rest
+        :param distance: float, (mm)
+        :param velocity: float, maximum velocity (mm/s)
+        :param acceleration: float, acceleration (mm/s/s)
+        :return: float, (s)
+        """
+        distance = abs(distance)
+        if distance == 0:
+            return 0
+        if velocity is None or acceleration is None or velocity <= 0 or acceleration <= 0:
+            return np.nan
+        if distance < velocity ** 2 / acceleration:
+            # Triangular profile, the stage starts decelerating before it reaches the max velocity
+            return 2 * np.sqrt(distance / acceleration)
+        return distance / velocity + velocity / acceleration
+
+    def predict(self, distance, velocity, acceleration):
+        """
+        Returns the predicted duration of a move, including the calibrated correction
+        :param distance: float, (mm)
+        :param velocity: float, maximum velocity (mm/s)
+        :param acceleration: float, acceleration (mm/s/s)
+        :return: float, (s) NaN if the velocity or acceleration are unknown
+        """
+        with self._lock:
+            return self.scale * self.kinematic_time(distance, velocity, acceleration) + self.settle
+
+    def record(self, distance, velocity, acceleration, predicted, actual, upper_bound=False):
+        """
+        Records the measured duration of a move and re-fits the correction
+        :param distance: float, (mm)
+        :param velocity: float, maximum velocity used for the prediction (mm/s)
+        :param acceleration: float, acceleration used for the prediction (mm/s/s)
+        :param predicted: float, predicted duration (s)
+        :param actual: float, measured duration (s)
+        :param upper_bound: bool, True if the stage had already arrived when it was first checked, the move took at
+        most 'actual'
+        :return:
+        """
+        kinematic = self.kinematic_time(distance, velocity, acceleration)
+        if not np.isfinite(kinematic) or not np.isfinite(actual):
+            return
+        with self._lock:
+            self._records.append((abs(distance), kinematic, predicted, actual, bool(upper_bound)))
+            self._calibrate()
+
+    def _calibrate(self):
+        """
+        Fits actual = scale * kinematic + settle. The scale is only fit once there are enough moves of different
+        lengths, before that only the offset is updated.
+        :return:
+        """
+        records = np.asarray(self._records, dtype=float)
+        kinematic, actual = records[:, 1], records[:, 3].copy()
+        # Bounds only count where the current correction predicts longer than the bound
+        bound = records[:, 4] > 0
+        actual[bound] = np.minimum(actual[bound], self.scale * kinematic[bound] + self.settle)
+        if len(records) >= self.min_fit and np.std(kinematic) > 0.01:
+            scale, settle = np.polyfit(kinematic, actual, 1)
+            self.scale = float(np.clip(scale, 0.25, 4))
+            settle = np.median(actual - self.scale * kinematic)
+            if settle < 0:
+                # Moves are shorter than the scaled kinematic time alone (ie early arrivals only bounded from above),
+                # fit the scale without an offset so it shrinks as well
+                self.scale = float(np.clip(np.sum(kinematic * actual) / np.sum(kinematic ** 2), 0.25, 4))
+                settle = np.median(actual - self.scale * kinematic)
+            self.settle = float(max(0, settle))
+        else:
+            self.settle = float(max(0, np.median(actual - self.scale * kinematic)))
+
+    def get_records(self):
+        """
+        Returns the recorded moves
+        :return: list of dict with the 'distance', 'predicted' and 'actual' duration of each move ('upper_bound' if
+        the actual duration is an upper bound)
+        """
+        with self._lock:
+            return [{'distance': distance, 'predicted': predicted, 'actual': actual, 'upper_bound': upper_bound}
+                    for distance, _, predicted, actual, upper_bound in self._records]
+
+
+class PositionCache:
+    """
+    Last known position of each axis of a stage, with the time it was known.
+
+    Positions come from completed reads (update) and confirmed arrivals (confirm_arrival). A motion command
+    (start_move) uncaches the axis until the stage is confirmed at its target, reads taken while the axis is moving are
+    kept but not served. Callers that can use a position up to max_age seconds old read it from here and leave the
+    hardware (and the controller lock) to the code that needs a fresh reading.
+    """
+
+    def __init__(self, max_age=0.5):
+        """
+        :param max_age: float, default maximum age (s) of a cached position
+        """
+        self.max_age = max_age
+        self._entries = {}
+        self._moving = set()
+        self._lock = threading.Lock()
+
+    def update(self, axis, value, timestamp=None):
+        """
+        Records a position read from the hardware
+        :param axis: str
+        :param value: float
+        :param timestamp: float, time.time() of the reading (None for now)
+        :return:
+        """
+        with self._lock:
+            self._entries[axis] = (value, time.time() if timestamp is None else timestamp)
+
+    def start_move(self, axis):
+        """
+        Records a motion command, the axis has no cached position until its arrival is confirmed
+        :param axis: str
+        :return:
+        """
+        with self._lock:
+            self._entries.pop(axis, None)
+            self._moving.add(axis)
+
+    def confirm_arrival(self, axis, value, timestamp=None):
+        """
+        Records a position read once the stage was confirmed at its target (ie by a wait function)
+        :param axis: str
+        :param value: float
+        :param timestamp: float, time.time() of the reading (None for now)
+        :return:
+        """
+        with self._lock:
+            self._moving.discard(axis)
+            self._entries[axis] = (value, time.time() if timestamp is None else timestamp)
+
+    def invalidate(self, axis=None):
+        """
+        Removes the cached position of an axis (or of every axis)
+        :param axis: str or None
+        :return:
+        """
+        with self._lock:
+            if axis is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(axis, None)
+
+    def get(self, axis, max_age=None):
+        """
+        Returns the cached position, or None if it is older than max_age or the axis has not been confirmed at the
+        target of its last move
+        :param axis: str
+        :param max_age: float, (s) None uses the cache default
+        :return: float or None
+        """
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            entry = None if axis in self._moving else self._entries.get(axis)
+        if entry is None:
+            return None
+        value, timestamp = entry
+        age = time.time() - timestamp
+        if age < 0 or age > max_age:
+            return None
+        return value
@@ -0,0 +1,228 @@
+"""
+Live view images made at the camera, so displays get a small 8 bit image instead of every full resolution frame.
+
+PreviewStream : turns the camera frames into rate limited previews, binned (or decimated) to the display size and
+scaled to 8 bit with running percentile estimates
+"""
+import threading
+import time
+
+import numpy as np
+
+from L2.FrameAnalytics import analytics_of
+from L2.FramePool import Frame, FrameDispatcher, LATEST
+
+BIN = 'bin'  # Mean of each block of pixels (less noise)
+DECIMATE = 'decimate'  # Every n-th pixel (fastest)
+
+
+def get_preview_factor(shape, max_size):
+    """
+    Returns the integer downsampling factor that fits an image in the display size
+    :param shape: (height, width) of the image
+    :param max_size: int, largest preview side in pixels
+    :return: int
+    """
+    return max(1, int(np.ceil(max(shape[:2]) / max_size)))
+
+
+def downsample(img, factor, method=BIN):
+    """
+    Shrinks an image by an integer factor. Binning drops the rows and columns past the last full block.
+    :param img: np.ndarray (height, width)
+    :param factor: int
+    :param method: BIN or DECIMATE
+    :return: np.ndarray, float32 for binning, the image dtype for decimation
+    """
+    if factor <= 1:
+        return img
+    if method == DECIMATE:
+        return img[::factor, ::factor]
+    height, width = img.shape[0] // factor, img.shape[1] // factor
+    blocks = img[:height * factor, :width * factor].reshape(height, factor, width, factor)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def scale_to_8bit(img, low, high, out=None):
+    """
+    Scales an image to 0-255 between low and high
+    :param img: np.ndarray
+    :param low: float, value shown as 0
+    :param high: float, value shown as 255
+    :param out: np.ndarray of uint8 with the image shape to write the result into
+    :return: np.ndarray of uint8
+    """
+    span = max(float(high) - float(low), 1e-6)
+    scaled = (np.asarray(img, dtype=np.float32) - np.float32(low)) * np.float32(255 / span)
+    np.clip(scaled, 0, 255, out=scaled)
+    if out is None:
+        return scaled.astype(np.uint8)
+    out[...] = scaled
+    return out
+
+
+class PreviewStream:
+    """
+    Preview images of a camera. The stream subscribes to the camera frames (newest frame only) once the first
+    preview is requested, so cameras without a live view don't pay for it.
+
+    The display range follows the low and high percentiles of the previews. The percentiles are taken from a sample
+    of the downsampled pixels and smoothed between frames so the brightness doesn't flicker.
+
+    add_callback : function called with each preview (read-only uint8 np.ndarray)
+    get_preview : returns the newest preview
+    configure : changes the size, rate, percentiles or downsampling method
+    """
+
+    def __init__(self, camera, max_size=512, rate=10, percentiles=(0.5, 99.5), method=BIN, smoothing=0.3,
+                 samples=4096):
+        """
+        :param camera: CameraAbstraction
+        :param max_size: int, largest preview side in pixels
+        :param rate: float, maximum previews per second
+        :param percentiles: (low, high) percentiles shown as 0 and 255
+        :param method: BIN or DECIMATE
+        :param smoothing: float (0, 1], weight of the newest frame in the running percentiles (1 doesn't smooth)
+        :param samples: int, number of pixels used to estimate the percentiles
+        """
+        self.camera = camera
+        self.max_size = max_size
+        self.rate = rate
+        self.percentiles = percentiles
+        self.method = method
+        self.smoothing = smoothing
+        self.samples = samples
+        self.frames = FrameDispatcher()
+        self.range = None  # (low, high) running estimate of the display range
+        self.previews = 0
+        self._last_time = 0
+        self._last_preview = None
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self):
+        """
+        Subscribes to the camera frames
+        :return:
+        """
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        self.camera.add_callback(self._update, tag='preview', policy=LATEST)
+
+    def stop(self):
+        """
+        Stops making previews
+        :return:
+        """
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        self.camera.remove_callback('preview')
+
+    def configure(self, max_size=None, rate=None, percentiles=None, method=None):
+        """
+        Changes the preview settings, None keeps a setting
+        :param max_size: int, largest preview side in pixels
+        :param rate: float, maximum previews per second
+        :param percentiles: (low, high)
+        :param method: BIN or DECIMATE
+        :return:
+        """
+        with self._lock:
+            if max_size is not None:
+                self.max_size = int(max_size)
+            if rate is not None:
+                self.rate = float(rate)
+            if percentiles is not None and tuple(percentiles) != tuple(self.percentiles):
+                self.percentiles = tuple(percentiles)
+                self.range = None
+            if method is not None:
+                assert method in (BIN, DECIMATE), f"Unknown preview method {method}"
+                self.method = method
+
+    def add_callback(self, function, tag='default', policy=LATEST):
+        """
+        Adds a function called with every preview, see CameraAbstraction.add_callback
+        :return:
+        """
+        self.start()
+        self.frames.subscribe(function, policy, tag)
+
+    def remove_callback(self, tag):
+        """
+        Removes the preview functions with a tag
+        :param tag: str
+        :return:
+        """
+        self.frames.unsubscribe(tag)
+
+    def get_preview(self):
+        """
+        Returns the newest preview. The first call starts the stream and makes a preview from the last camera image.
+        :return: uint8 np.ndarray or None if the camera has no image yet
+        """
+        self.start()
+        with self._lock:
+            if self._last_preview is not None:
+                return self._last_preview.image
+        img = self.camera.get_last_image()
+        if img is None or len(img) == 0:
+            return None
+        return self.render(img)
+
+    def _update(self, img):
+        """ Camera frame callback, makes a preview unless the last one is too recent """
+        now = time.time()
+        if self.rate > 0 and now - self._last_time < 1 / self.rate:
+            return
+        self._last_time = now
+        self.render(img)
+
+    def _update_range(self, small):
+        """ Updates the running display range with the percentiles of a sample of the preview pixels """
+        flat = small.reshape(-1)
+        step = max(1, flat.size // self.samples)
+        low, high = np.percentile(flat[::step], self.percentiles)
+        if self.range is None:
+            self.range = (float(low), float(high))
+        else:
+            a = self.smoothing
+            self.range = ((1 - a) * self.range[0] + a * low, (1 - a) * self.range[1] + a * high)
+        return self.range
+
+    def render(self, img):
+        """
+        Downsamples and scales a camera image and publishes it to the preview callbacks (not rate limited)
+        :param img: np.ndarray
+        :return: uint8 np.ndarray (read-only) or None for images that aren't 2D
+        """
+        if img.ndim != 2:
+            return None
+        factor = get_preview_factor(img.shape, self.max_size)
+        # Other consumers of the frame can reuse the downsampled image
+        small = analytics_of(img).get(('downsample', factor, self.method), downsample, factor, self.method)
+        with self._lock:
+            low, high = self._update_range(small)
+        # Previews are small and displays keep them, so each gets its own buffer instead of a pooled one
+        frame = Frame(scale_to_8bit(small, low, high), sequence=self.previews, metadata={'range': (low, high)})
+        self.previews += 1
+        with self._lock:
+            previous = self._last_preview
+            self._last_preview = frame.acquire()
+        if previous is not None:
+            previous.release()
+        self.frames.publish(frame)
+        frame.release()
+        return frame.image
+
+    def close(self):
+        """
+        Stops the stream and the preview callbacks
+        :return:
+        """
+        self.stop()
+        for subscriber in self.frames.get_statistics():
+            self.frames.unsubscribe(subscriber['tag'])
@@ -100,12 +100,14 @@ class MicroManagerShutter(ShutterAbstraction, UtilityControl):
 
     def open_shutter(self):
         """ Opens the shutter"""
-        self.controller.send_command('shutter,open,{}\n'.format(self._get_device()))
+        self._send_state('shutter', True, self.controller.send_command,
+                         'shutter,open,{}\n'.format(self._get_device()))
         self._state = True
 
     def close_shutter(self):
         """closes the shutter"""
-        self.controller.send_command('shutter,close,{}\n'.format(self._get_device()))
+        self._send_state('shutter', False, self.controller.send_command,
+                         'shutter,close,{}\n'.format(self._get_device()))
         self._state = False
 
     def get_shutter(self):
@@ -120,6 +122,7 @@ class PycromanagerShutter(ShutterAbstraction, UtilityControl):
     def __init__(self, controller, role):
         super().__init__(controller, role)
         self._dev_name = "N/A"
+        self._auto_shutter = False
 
     def startup(self):
         """
@@ -134,17 +137,31 @@ class PycromanagerShutter(ShutterAbstraction, UtilityControl):
 
     def open_shutter(self):
         """ Opens the shutter"""
-        self.controller.send_command(self.controller.core.set_shutter_open, args=(self._dev_name, True))
-        self._state = True
+        self._set_shutter(True)
 
     def close_shutter(self):
         """closes the shutter"""
-        self.controller.send_command(self.controller.core.set_shutter_open, args=(self._dev_name, False))
-        self._state = False
+        self._set_shutter(False)
+
+    def _set_shutter(self, state):
+        """
+        Sends the shutter state, unless the shutter is known to be in it. With auto shutter on Micromanager opens
+        and closes the shutter on its own, so the state is always sent.
+        :param state: bool, True opens the shutter
+        :return:
+        """
+        if self._auto_shutter:
+            self.controller.send_command(self.controller.core.set_shutter_open, args=(self._dev_name, state))
+        else:
+            self._send_state('shutter', state, self.controller.send_command, self.controller.core.set_shutter_open,
+                             args=(self._dev_name, state))
+        self._state = state
 
     def get_shutter(self):
         """ Reads the shutter state"""
         self._state = self.controller.send_command(self.controller.core.get_shutter_open, args=(self._dev_name,))
+        if not self._auto_shutter:
+            self.record_state('shutter', bool(self._state))
         return self._state
 
     def set_auto_on(self):
@@ -153,6 +170,9 @@ class PycromanagerShutter(ShutterAbstraction, UtilityControl):
         :return:
         """
         self.controller.send_command(self.controller.core.set_auto_shutter, args=(True,))
+        # Micromanager opens and closes the shutter on its own, the shutter state isn't shadowed until auto is off
+        self._auto_shutter = True
+        self.invalidate_state('shutter')
 
     def set_auto_off(self):
         """
@@ -160,6 +180,8 @@ class PycromanagerShutter(ShutterAbstraction, UtilityControl):
         :return:
         """
         self.controller.send_command(self.controller.core.set_auto_shutter, args=(False,))
+        self._auto_shutter = False
+        self.invalidate_state('shutter')
 
 
 class ShutterFactory(UtilityFactory):
@@ -1,3 +1,5 @@
+import threading
+import time
 from abc import ABC, abstractmethod
 
 
@@ -10,7 +12,14 @@ class UtilityControl(ABC):
 
     The hardware abstraction class will further specialize each subclass but Utility control should remain generalizable
     for all hardware components.
+
+    State shadowing: utilities that set a device state (filter channel, shutter, light) send it with _send_state, which
+    remembers the last acknowledged state of each key and skips commands that would not change the device. A shadowed
+    state is forgotten when its command fails, when the controller is reset, after state_ttl seconds, or with
+    invalidate_state.
     """
+    state_ttl = None  # s, a shadowed state older than this is sent again (None keeps it until invalidated)
+
     def __init__(self, controller):
         self.controller=controller
 
@@ -30,6 +39,94 @@ class UtilityControl(ABC):
     def stop(self):
         pass
 
+    def _get_shadow(self):
+        # Created on first use, most utility __init__ functions don't call UtilityControl.__init__
+        shadow = self.__dict__.get('_state_shadow')
+        if shadow is None:
+            shadow = self.__dict__.setdefault('_state_shadow', {})
+            self.__dict__.setdefault('_state_lock', threading.RLock())
+        return shadow
+
+    def is_state(self, key, value):
+        """
+        Returns True if the last acknowledged state of key is value and it is still valid
+        :param key: hashable, the device setting (ie 'channel')
+        :param value: state of the setting
+        :return: bool
+        """
+        entry = self._get_shadow().get(key)
+        if entry is None:
+            return False
+        state, timestamp, resets = entry
+        if resets != getattr(self.controller, 'resets', 0):
+            return False
+        if self.state_ttl is not None and time.time() - timestamp > self.state_ttl:
+            return False
+        return state == value
+
+    def record_state(self, key, value):
+        """
+        Records the state of the device (after a command was acknowledged or the state was read back)
+        :param key: hashable
+        :param value: state of the setting
+        :return:
+        """
+        self._get_shadow()[key] = (value, time.time(), getattr(self.controller, 'resets', 0))
+
+    def invalidate_state(self, key=None):
+        """
+        Forgets the shadowed state of key (or every key), the next command is sent to the device
+        :param key: hashable or None
+        :return:
+        """
+        shadow = self._get_shadow()
+        if key is None:
+            shadow.clear()
+        else:
+            shadow.pop(key, None)
+
+    def _send_state(self, key, value, send, *args, ack=None, **kwargs):
+        """
+        Calls send(*args, **kwargs) unless the device is already in the state.
+
+        :param key: hashable, the device setting
+        :param value: the state the command puts the device in
+        :param send: function that sends the command
+        :param ack: function called with the response, returning False if the device rejected the command
+        :return: response of send, or None if the command was skipped
+        """
+        shadow = self._get_shadow()
+        with self._state_lock:
+            if self.is_state(key, value):
+                return None
+            shadow.pop(key, None)
+            response = send(*args, **kwargs)
+            if ack is None or ack(response):
+                self.record_state(key, value)
+        return response
+
+    def _send_states(self, states, send):
+        """
+        Sends the settings the device isn't known to have with a single call, for devices that take several
+        settings in one write.
+
+        :param states: dict of key: value, the states to put the device in
+        :param send: function called with the dict of the changed states, sends them and returns the response
+        :return: response of send, or None if the device already had every state
+        """
+        shadow = self._get_shadow()
+        with self._state_lock:
+            changed = {key: value for key, value in states.items() if not self.is_state(key, value)}
+            if len(changed) == 0:
+                return None
+            for key in changed:
+                shadow.pop(key, None)
+            response = send(changed)
+            for key, value in changed.items():
+                self.record_state(key, value)
+        return response
+
+
 class UtilityFactory(ABC):
 
     """
@@ -43,4 +140,3 @@ class UtilityFactory(ABC):
         appropriate UtilityControl class that matches that daqcontroller and return the object
         """
         pass
-
@@ -1,7 +1,9 @@
 import logging
 import time
+import numpy as np
 from abc import ABC, abstractmethod
 from L2.Utility import UtilityControl, UtilityFactory
+from L2.Motion import MotionPredictor, PositionCache
 
 
 class XYAbstraction(ABC):
@@ -11,6 +13,7 @@ class XYAbstraction(ABC):
     Specialized functions include:
     set_xy = sets the absolute position of the stage
     read_xy = reads the absolute position of the stage
+    get_xy = returns the cached position if it is recent enough, otherwise reads the stage
     set_x = sets the absolute position of x axis
     set_y = sets the absolute position o f they axis
     set_rel_xy = sets the relative position of the xy_stage, similar to jog xy
@@ -20,7 +23,13 @@ class XYAbstraction(ABC):
     go_home = moves to the home position
     stop = stopes xy stage movement
     wait_for_move = waits for the stage to stop moving
+    wait_for_xy_target = waits for the stage to reach a position
+
+    The wait functions sleep until shortly (confirm_lead) before the arrival predicted by the motion model, then
+    confirm the position with reads every confirm_period. Each confirmed arrival is recorded to calibrate the model.
     """
+    confirm_lead = 0.15  # seconds before the predicted arrival to start reading the position
+    confirm_period = 0.01  # seconds between position reads while confirming an arrival
 
     def __init__(self, controller, role):
         self.controller = controller
@@ -28,13 +37,17 @@ class XYAbstraction(ABC):
         self._scale = 1
         self._x_inversion = 1
         self._y_inversion = 1
-        self.pos = [0, 0]
+        self.position_cache = PositionCache()
+        self._pos = [0, 0]
+        self._pos_time = 0  # time.time() of the last read
         self._acceleration = 10  # mm/s2
         self._velocity = 5  # mm/s
         self.velocity_max = 5
         self.acceleration = 20
         self.jerk = 5
         self.home = [0, 0]
+        self.motion = MotionPredictor()
+        self._move = None
 
     def _scale_values(self, xy):
         xy = xy[:]
@@ -50,6 +63,127 @@ class XYAbstraction(ABC):
         xy = [x * self._scale for x in xy]
         return xy
 
+    @property
+    def pos(self):
+        """Last position read from the stage"""
+        return self._pos
+
+    @pos.setter
+    def pos(self, xy):
+        # Every read sets the position, so every read also refreshes the position cache
+        self._pos = xy
+        self._pos_time = time.time()
+        if xy is not None:
+            self.position_cache.update('x', xy[0])
+            self.position_cache.update('y', xy[1])
+
+    def get_xy(self, max_age=None):
+        """
+        Returns the stage position from the position cache if it is newer than max_age and the stage is not moving,
+        otherwise the position is read from the stage. Use read_xy when a fresh reading is required.
+        :param max_age: float, seconds (None uses position_cache.max_age)
+        :return: [x, y] in mm
+        """
+        xy = [self.position_cache.get(axis, max_age) for axis in ['x', 'y']]
+        if None in xy:
+            return self.read_xy()
+        return xy
+
+    def _motion_limits(self):
+        """
+        Returns the velocity (mm/s) and acceleration (mm/s/s) used to predict the move duration
+        :return:
+        """
+        return self.velocity_max, self.acceleration
+
+    def _start_move(self, xy):
+        """
+        Records the start time, start position and target of a move so the wait functions can predict the arrival.
+        Called by set_xy and set_rel_xy.
+        :param xy: target position [x, y] in mm
+        :return:
+        """
+        start = self._get_start_position()
+        distance = max(abs(target - position) for target, position in zip(xy, start))
+        velocity, acceleration = self._motion_limits()
+        self._move = {'time': time.time(), 'start': start, 'target': list(xy), 'distance': distance,
+                      'velocity': velocity, 'acceleration': acceleration,
+                      'predicted': self.motion.predict(distance, velocity, acceleration)}
+        # Nothing is cached for the move until a wait function confirms the stage at the target
+        self.position_cache.start_move('x')
+        self.position_cache.start_move('y')
+
+    def _get_start_position(self):
+        """
+        Returns where the next move starts: the last read position, or the target of the last move if the stage
+        hasn't been read since that move was sent
+        :return: [x, y] in mm
+        """
+        move = self._move
+        if move is not None and self._pos_time < move['time']:
+            return list(move['target'])
+        return list(self.pos)
+
+    def _start_rel_move(self, rel_xy):
+        """
+        Records a relative move (see _start_move)
+        :param rel_xy: relative move [x, y] in mm
+        :return:
+        """
+        self._start_move([position + rel for position, rel in zip(self._get_start_position(), rel_xy)])
+
+    def _sleep_until_arrival(self, deadline=None, xy=None, tol=0.1):
+        """
+        Sleeps until confirm_lead seconds before the predicted end of the last move
+        :param deadline: float, time.time() not to sleep past
+        :param xy: target the caller is waiting for, the prediction is only used if the last move was to this target
+        :param tol: float, tolerance used to compare the targets (mm)
+        :return: the move being waited for (or None if there is no prediction)
+        """
+        move = self._move
+        if move is None or not np.isfinite(move['predicted']):
+            return None
+        if xy is not None and max(abs(a - b) for a, b in zip(move['target'], xy)) > tol:
+            return None
+        wake = move['time'] + move['predicted'] - self.confirm_lead
+        if deadline is not None:
+            wake = min(wake, deadline)
+        if wake > time.time():
+            time.sleep(wake - time.time())
+        return move
+
+    def _confirm_position(self, xy, timestamp):
+        """
+        Caches a position read once the stage was confirmed at rest or at its target
+        :param xy: [x, y] in mm
+        :param timestamp: float, time.time() of the reading
+        :return:
+        """
+        self.position_cache.confirm_arrival('x', xy[0], timestamp)
+        self.position_cache.confirm_arrival('y', xy[1], timestamp)
+
+    def _record_arrival(self, move, arrival, upper_bound=False):
+        """
+        Records the measured duration of a move to calibrate the motion model
+        :param move: dict from _start_move
+        :param arrival: float, time.time() the stage was at the target
+        :param upper_bound: bool, True if the stage was already at the target on the first read, it arrived at
+        some time before 'arrival'
+        :return:
+        """
+        if move is None or move.get('actual') is not None:
+            return
+        move['actual'] = arrival - move['time']
+        self.motion.record(move['distance'], move['velocity'], move['acceleration'], move['predicted'],
+                           move['actual'], upper_bound)
+
+    def get_motion_records(self):
+        """
+        Returns the predicted and actual durations of the recent moves
+        :return: list of dict
+        """
+        return self.motion.get_records()
+
     @abstractmethod
     def get_velocity(self):
         """
@@ -125,35 +259,57 @@ class XYAbstraction(ABC):
         """Get the position of the XY stage, satisfies the utility control get_status command"""
         return {'xy': self.pos}
 
-    def wait_for_move(self, tolerance=10):
+    def wait_for_move(self, tolerance=10, timeout=30):
         """ Waits for the stage to stop moving
         tolerance is the acceptable distance from the target is it okay to consider the stage stopped
         returns the current position
         """
-        time.sleep(0.1)
-        prev_pos = self.read_xy()
-        current_pos = [prev_pos[0] + 1, prev_pos[1]]
-        # Update position while moving
-        st = time.time()
-        while prev_pos == current_pos and time.time() - st < 3:
+        deadline = time.time() + timeout
+        move = self._sleep_until_arrival(deadline)
+        if move is None:
             time.sleep(0.1)
-        while abs(prev_pos[0] - current_pos[0]) > tolerance or abs(prev_pos[1] - current_pos[1]) > tolerance:
-            time.sleep(0.05)
-            prev_pos = current_pos
+        read_start = time.time()
+        prev_pos = self.read_xy()
+        # A stage already at the target on the first read arrived before it, the prediction was too long
+        if prev_pos is not None and move is not None and \
+                max(abs(a - b) for a, b in zip(move['target'], prev_pos)) <= 0.1:
+            self._record_arrival(move, (read_start + time.time()) / 2, upper_bound=True)
+        while time.time() < deadline:
+            time.sleep(self.confirm_period)
+            read_start = time.time()
             current_pos = self.read_xy()
-        return current_pos
+            if current_pos is None or prev_pos is None:
+                prev_pos = current_pos
+                continue
+            if abs(prev_pos[0] - current_pos[0]) <= tolerance and abs(prev_pos[1] - current_pos[1]) <= tolerance:
+                read_time = (read_start + time.time()) / 2
+                if move is not None and max(abs(a - b) for a, b in zip(move['target'], current_pos)) <= 0.1:
+                    self._record_arrival(move, read_time)
+                self._confirm_position(current_pos, read_time)
+                return current_pos
+            prev_pos = current_pos
+        return prev_pos
 
     def wait_for_xy_target(self, xy, tol=0.1, timeout = 30):
         """
         Wait for the XY stage to reach the target allowing for some tolerance (mm)
         """
-        st = time.time()
-        for idx, dim in enumerate(xy):
-            while abs(self.read_xy()[idx] - dim) > 0.1:
-                time.sleep(0.25)
-                if time.time()-st > timeout:
-                    return False
-        return True
+        deadline = time.time() + timeout
+        move = self._sleep_until_arrival(deadline, xy, tol)
+        first = True
+        while True:
+            read_start = time.time()
+            pos = self.read_xy()
+            if pos is not None and max(abs(position - dim) for position, dim in zip(pos, xy)) <= tol:
+                read_time = (read_start + time.time()) / 2
+                # Found on the first read the stage arrived before it, the prediction was too long
+                self._record_arrival(move, read_time, upper_bound=first)
+                self._confirm_position(pos, read_time)
+                return True
+            if time.time() > deadline:
+                return False
+            first = False
+            time.sleep(self.confirm_period)
 
 
 class PycromanagerXY(XYAbstraction, UtilityControl):
@@ -214,6 +370,7 @@ class PycromanagerXY(XYAbstraction, UtilityControl):
     def set_xy(self, xy):
         """Given a set of coordinates in mm, Stage will move to those coordinates"""
         raw_xy = self._invert_scale(xy)
+        self._start_move(xy)
         ans = self.controller.send_command(self.controller.core.set_xy_position,
                                            args=(self._dev_name, round(raw_xy[0]), round(raw_xy[1])))
 
@@ -223,6 +380,7 @@ class PycromanagerXY(XYAbstraction, UtilityControl):
         Given a relative set of coordinates in mm, move the xy stage by that amount.
         """
         raw_xy = self._invert_scale(rel_xy)
+        self._start_rel_move(rel_xy)
         ans = self.controller.send_command(self.controller.core.set_relative_xy_position,
                                            args=(self._dev_name, raw_xy[0], raw_xy[1]))
 
@@ -233,6 +391,7 @@ class PycromanagerXY(XYAbstraction, UtilityControl):
         """
 
         ans = self.controller.send_command(self.controller.core.set_origin_xy, args=(self._dev_name))
+        self.position_cache.invalidate()
 
 
 class MicroManagerXY(XYAbstraction, UtilityControl):
@@ -289,12 +448,14 @@ class MicroManagerXY(XYAbstraction, UtilityControl):
 
     def set_xy(self, xy):
         raw_xy = self._invert_scale(xy)
+        self._start_move(xy)
         rsp = self.controller.send_command(
             'xy,set_position,{},{},{}\n'.format(self._get_xy_device(), raw_xy[0], raw_xy[1]))
         msg = "Did not set XY Stage"
         return self._ok_check(rsp, msg)
 
     def set_rel_xy(self, rel_xy):
+        self._start_rel_move(rel_xy)
         rel_xy = self._invert_scale(rel_xy)
         rsp = self.controller.send_command(
             'xy,rel_position,{},{},{}\n'.format(self._get_xy_device(), rel_xy[0], rel_xy[1]))
@@ -316,6 +477,13 @@ class MicroManagerXY(XYAbstraction, UtilityControl):
         """
         self._velocity = velocity
 
+    def _motion_limits(self):
+        """
+        Returns the best guess of the velocity and acceleration set by the user
+        :return:
+        """
+        return self._velocity, self._acceleration
+
     def get_acceleration(self):
         """
         Return the best guess of the XY stage accerlation
@@ -351,6 +519,7 @@ class PriorXY(XYAbstraction, UtilityControl):
     def set_xy(self, xy):
         """ Set the XY position in mm"""
         raw_xy = self._invert_scale(xy)
+        self._start_move(xy)
         response = self.controller.send_command("G {},{}\r".format(raw_xy[0], raw_xy[1]))
 
     def read_xy(self):
@@ -373,17 +542,20 @@ class PriorXY(XYAbstraction, UtilityControl):
 
     def set_rel_xy(self, rel_xy):
         """ Moves the stage a relative amount in mm"""
+        self._start_rel_move(rel_xy)
         rel_xy = self._invert_scale(rel_xy)
         rsp = self.controller.send_command("GR {},{}\r".format(rel_xy[0], rel_xy[1]))
 
     def stop(self):
         """Stops the stage"""
         self.controller.send_command("K \r")
+        self.position_cache.invalidate()
         return
 
     def set_home(self):
         """ Sets the current position as home position for the stage """
         self.controller.send_command("Z \r")
+        self.position_cache.invalidate()
         self.controller._read_line()
         self.read_xy()
 
@@ -8,6 +8,7 @@ import numpy as np
 
 from L1 import Controllers
 from L2.Utility import UtilityControl, UtilityFactory
+from L2.Motion import PositionCache
 from L1.Util import get_system_var
 
 kinesis_path = get_system_var('kinesis')[0]
@@ -27,6 +28,7 @@ def check_z(func):
 
     def wrapper(self, z):
         if self.min_z < z < self.max_z:
+            self._start_move(z)
             return func(self, z)
         else:
             logging.warning(f"z-set {z} mm is not within bounds for z-stage {self.role}")
@@ -55,6 +57,7 @@ class ZAbstraction(ABC):
     set_z: sets absolute position of the stage
     set_rel_z: jogs the stage up or down
     read_z: reads the current position from the stage
+    get_z: returns the cached position if it is recent enough, otherwise reads the stage
     set_home: sets the current position as 0 or home for the stage
     go_home: sends the stage to home or 0 position
     homing: moves the motor till it locates an endstop or limitswitch
@@ -70,7 +73,8 @@ class ZAbstraction(ABC):
         self._scale = float(settings['scale'])
         self.z_inversion = int(settings['invert'])
         self._offset = float(settings['offset'])
-        self.pos = 0
+        self.position_cache = PositionCache()
+        self._pos = 0
         self._default_pos = float(settings['default'])
         self.min_z = float(settings['min_z'])
         self.max_z = float( settings['max_z'])
@@ -87,6 +91,38 @@ class ZAbstraction(ABC):
         """Returns the position of the Z stage"""
         return {'z': self.pos}
 
+    @property
+    def pos(self):
+        """Last position read from the stage"""
+        return self._pos
+
+    @pos.setter
+    def pos(self, z):
+        # Every read sets the position, so every read also refreshes the position cache
+        self._pos = z
+        if z is not None:
+            self.position_cache.update('z', z)
+
+    def get_z(self, max_age=None):
+        """
+        Returns the stage position from the position cache if it is newer than max_age and the stage is not moving,
+        otherwise the position is read from the stage. Use read_z when a fresh reading is required.
+        :param max_age: float, seconds (None uses position_cache.max_age)
+        :return: float, mm
+        """
+        z = self.position_cache.get('z', max_age)
+        if z is None:
+            return self.read_z()
+        return z
+
+    def _start_move(self, z):
+        """
+        Records a motion command in the position cache, nothing is cached until the arrival is confirmed
+        :param z: target position in mm
+        :return:
+        """
+        self.position_cache.start_move('z')
+
     @abstractmethod
     def set_z(self, z: float):
         pass
@@ -116,7 +152,9 @@ class ZAbstraction(ABC):
         new_pos = pos + 1
         while np.abs(pos - new_pos) > 0.1:
             pos = new_pos
+            time.sleep(0.05)
             new_pos = self.read_z()
+        self.position_cache.confirm_arrival('z', new_pos)
 
     def wait_for_target(self, z, timeout=15):
         """
@@ -130,6 +168,7 @@ class ZAbstraction(ABC):
             time.sleep(0.25)
             if time.time() - st > timeout:
                 return False
+        self.position_cache.confirm_arrival('z', self.pos)
         return True
 
     @abstractmethod
@@ -144,6 +183,9 @@ class ZAbstraction(ABC):
 class ArduinoZ(ZAbstraction, UtilityControl):
     """ Utility class for moving a single axis motor with the PowerStep01 stepper driver and an Arduino.
 
+    With a stream period (config setting 'stream' in ms, 0 disables it) the firmware pushes the position, the busy
+    state and the target at that rate and sends an event when a move is finished. A reader thread keeps the latest
+    position, so read_z and the wait functions don't query the Arduino while the stream is fresh.
     """
     velocity_max = 20  # mm/s
     acceleration = 5
@@ -151,13 +193,61 @@ class ArduinoZ(ZAbstraction, UtilityControl):
 
     def __init__(self, controller, role, **kwargs):
         super().__init__(controller, role, **kwargs)
+        self.stream_period = int(float(kwargs.get('stream', 0)))
+        self.busy = False
+        self._target = None
+        self._command_target = None  # Target of the last set_z in firmware units, as sent
+        self._target_acknowledged = True  # The stream reported the firmware working on the last set_z target
+        self._stream_time = 0
+        self._arrived = threading.Event()
 
     def startup(self):
         """ on startup we need to go to the home position (raise all the way up)"""
 
         resp = self.controller.send_command("TESTING12345\n")
+        if self.stream_period > 0:
+            self.start_stream(self.stream_period)
         self.homing()
 
+    def start_stream(self, period):
+        """
+        Starts the position stream from the firmware
+        :param period: int, ms between position updates (0 stops the stream)
+        :return:
+        """
+        self.stream_period = int(period)
+        if self.stream_period > 0:
+            self.controller.add_line_listener('Z', self._read_stream)
+        self.controller.send_command("M0T{:04d}\n".format(self.stream_period))
+
+    def _read_stream(self, line):
+        """
+        Listener for the pushed lines, 'Z:<pos>,<busy>,<target>' or 'Z!<pos>' when a move is finished
+        :param line: str
+        :return:
+        """
+        if line[:2] == 'Z:':
+            pos, busy, target = line[2:].split(',')
+            self.busy = bool(int(busy))
+            self._target = self._scale_values(float(target))
+            # Lines sent before the firmware parsed the last set_z still report the old target
+            if self._command_target is not None and abs(float(target) - self._command_target) < 0.0015:
+                self._target_acknowledged = True
+        elif line[:2] == 'Z!':
+            pos = line[2:]
+            self.busy = False
+        else:
+            return
+        self.pos = self._scale_values(float(pos))
+        self._stream_time = time.time()
+        if not self.busy and self._target_acknowledged:
+            self.position_cache.confirm_arrival('z', self.pos, self._stream_time)
+            self._arrived.set()
+
+    def _stream_fresh(self):
+        """ Returns True if a streamed position arrived within the last few stream periods """
+        return self.stream_period > 0 and time.time() - self._stream_time < 3 * self.stream_period / 1000
+
     def shutdown(self):
         """ On shutdown don't do anything special"""
         pass
@@ -166,10 +256,17 @@ class ArduinoZ(ZAbstraction, UtilityControl):
     def set_z(self, z):
         """ Sets the absolute z position"""
         z = self._invert_scale(z)
+        self._arrived.clear()
+        self.busy = True
+        # The move is only finished once the stream reports this target and not busy
+        self._command_target = round(z, 3)
+        self._target_acknowledged = False
         self.controller.send_command("M0L{:+.3f}\n".format(z))
 
     def read_z(self):
         """ Reads the z position"""
+        if self._stream_fresh():
+            return self.pos
         z = self.controller.send_command("M0L?\n")
         ct = 0
         while "L?" != z[0:2]:
@@ -189,6 +286,7 @@ class ArduinoZ(ZAbstraction, UtilityControl):
         self._offset = -self.read_z()
         self.min_z += self._offset
         self.max_z += self._offset
+        self.position_cache.invalidate()
 
     def go_home(self):
         self.set_z(0)
@@ -214,6 +312,32 @@ class ArduinoZ(ZAbstraction, UtilityControl):
         self.max_z = 3*self.max_z
         self.set_z(2*old_max)
         self.max_z = old_max
+        # The stage stops at the limit switch, not at the commanded target
+        self.position_cache.invalidate()
+
+    def wait_for_move(self, timeout=30):
+        """
+        Waits for the stage to stop moving. While streaming this waits for the firmware's move finished event.
+        :param timeout: float, seconds
+        :return: bool, False if the move didn't finish in time
+        """
+        if not self._stream_fresh():
+            super().wait_for_move()
+            return True
+        return self._arrived.wait(timeout)
+
+    def wait_for_target(self, z, timeout=15):
+        """
+        :param z: target height in mm to wait for
+        :param timeout: time to wait before returning False
+
+        :return : True or False depending if the target was reached
+        """
+        if not self._stream_fresh():
+            return super().wait_for_target(z, timeout)
+        if not self._arrived.wait(timeout):
+            return False
+        return abs(self.pos - z) <= 0.1
 
 
 class SimulatedZ(ZAbstraction, UtilityControl):
@@ -595,6 +719,38 @@ class ZControlFactory(UtilityFactory):
             return None
 
 
+def test_arduino_stream():
+    """
+    Moves the stage on the OutletControl firmware emulator (pseudo terminal) with the position stream on. The move
+    should finish on the firmware event and read_z should be served from the stream without new commands.
+    :return:
+    """
+    from L1.Emulators import OutletEmulator
+
+    firmware = OutletEmulator().start()
+    controller = Controllers.ArduinoController(firmware.port)
+    controller.open()
+    controller._delay = 0.02
+    z_stage = ArduinoZ(controller, 'outlet_z', scale=1, offset=0, stream=20)
+    z_stage.start_stream(z_stage.stream_period)
+    z_stage.set_z(10)
+    st = time.time()
+    assert z_stage.wait_for_target(10, timeout=5), "Target was not reached"
+    elapsed = time.time() - st
+    sent = len(firmware.rx_log)
+    assert abs(z_stage.read_z() - 10) < 0.01
+    assert len(firmware.rx_log) == sent, "read_z queried the firmware while streaming"
+    assert controller.send_command("S\n").strip() == 'Run', "Command responses are mixed with the stream"
+    z_stage.start_stream(0)
+    time.sleep(0.1)
+    assert abs(z_stage.read_z() - 10) < 0.01
+    controller.close()
+    firmware.close()
+    # 10 mm at 20 mm/s with 50 mm/s/s takes 0.9 s
+    assert elapsed < 0.9 + 0.2, f"Move completion was detected late ({elapsed:.2f} s)"
+    return z_stage
+
+
 if __name__ == "__main__":
     from L1 import Controllers
 
@@ -4,6 +4,7 @@ from abc import ABC, abstractmethod
 from L1 import Controllers, DAQControllers
 from L2 import PressureControl, XYControl, ZControl, HighVoltageControl, DetectorControl, LaserControl, \
     FilterWheelControl, ShutterControl, CameraControl, LightControl
+from L2.DataStore import TimebaseAligner
 
 
 class Director(ABC):
@@ -191,8 +192,21 @@ class UtilityBuilder(Builder):
         self.constructed_object.fields[role] = self._shutter_factory.build_object(controller, role)
 
     def add_camera(self, controller, settings):
+        """
+        Add a camera to the configuration.
+        Settings order: Utility, controller_id, camera, role, *key, *value
+
+        keywords:
+        process: true to run a pycromanager camera in its own process (frames are shared through shared memory) \n
+
+        :param controller:
+        :param settings:
+        :return:
+        """
         role = settings[3]
-        self.constructed_object.fields[role] = self._camera_factory.build_object(controller, role)
+        options = settings[4:]
+        kwargs = {options[key]: options[key + 1] for key in range(0, len(options), 2)}
+        self.constructed_object.fields[role] = self._camera_factory.build_object(controller, role, **kwargs)
 
     def add_rgb(self, controller, settings):
         role = settings[3]
@@ -473,6 +487,46 @@ class CESystem(SystemAbstraction):
         self.detector = DetectorControl.DetectorAbstraction
         self.lysis_laser = LaserControl.LaserAbstraction
         self.inlet_rgb = LightControl.RGBAbstraction
+        self.power_aligner = None
+
+    def load_config(self, config_file="default"):
+        """
+        Load the controllers and utilities, then align the high voltage readbacks to the detector timebase
+        :param config_file:
+        :return:
+        """
+        super().load_config(config_file)
+        self._align_power()
+
+    def _align_power(self):
+        """
+        Streams the high voltage readbacks onto the detector sample times while they are acquired, so saving an
+        electropherogram only copies columns
+        :return:
+        """
+        self.power_aligner = None
+        if isinstance(self.detector, DetectorControl.DetectorAbstraction) and \
+                isinstance(self.high_voltage, HighVoltageControl.HighVoltageAbstraction):
+            self.power_aligner = TimebaseAligner(('voltage', 'current'), mode='linear')
+            self.detector.add_listener(self.power_aligner.add_reference)
+            self.high_voltage.add_listener(self.power_aligner.add_source)
+
+    def set_spill_file(self, filepath=None, window=36000, chunk_samples=2 ** 16):
+        """
+        Records the detector data to a memory-mapped file (see DetectorAbstraction.set_spill_file). The aligned high
+        voltage data is spilled next to it (<filepath>_power), so neither grows in RAM with the length of a run.
+        :param filepath: str, file to write the detector data to, (None to store in RAM)
+        :param window: int, number of recent samples to keep in RAM
+        :param chunk_samples: int, number of samples the files are extended by at a time
+        :return:
+        """
+        self.detector.set_spill_file(filepath, window, chunk_samples)
+        if self.power_aligner is not None:
+            power_path = None
+            if filepath is not None:
+                root, extension = os.path.splitext(filepath)
+                power_path = root + '_power' + extension
+            self.power_aligner.set_spill_file(power_path, window, chunk_samples)
 
     def stop_ce(self):
         """
@@ -12,6 +12,7 @@ from skimage.io import imsave
 
 from L3.SystemsBuilder import CESystem
 from L4 import Util, Trajectory, FileIO, Electropherogram
+from L4.HeightMap import HeightMap
 from L1.Util import get_system_var
 import logging
 import matplotlib.pyplot as plt
@@ -336,16 +337,16 @@ class BasicTemplateShape(object):
             return self._get_box_intersection(xx, yy)
 
     def _get_box_intersection(self, xx, yy):
+        xx, yy = np.asarray(xx), np.asarray(yy)
         minx, maxx = self.xy[0] - self.size[0] / 2, self.xy[0] + self.size[0] / 2
         miny, maxy = self.xy[1] - self.size[1] / 2, self.xy[1] + self.size[1] / 2
-        zz = [self.height if minx < x < maxx and miny < y < maxy else 0 for x, y in zip(xx, yy)]
-        return zz
+        return np.where((minx < xx) & (xx < maxx) & (miny < yy) & (yy < maxy), self.height, 0)
 
     def _get_circle_intersection(self, xx, yy):
+        xx, yy = np.asarray(xx), np.asarray(yy)
         x0, y0 = self.xy
         r = self.size
-        zz = [self.height if (x - x0) ** 2 + (y - y0) ** 2 <= r ** 2 else 0 for x, y in zip(xx, yy)]
-        return zz
+        return np.where((xx - x0) ** 2 + (yy - y0) ** 2 <= r ** 2, self.height, 0)
 
 
 class Well(BasicTemplateShape):
@@ -396,10 +397,13 @@ class Template(object):
     base	rectangle	"100,100"	"100,100"	2.5
     '''
 
+    resolution = 0.5  # Cell size of the ledge height map (mm)
+
     def __init__(self, template_file=r'D:\Scripts\AutomatedCE\config\template-test.txt'):
         self.ledges = {}
         self.wells = {}
         self.template_size = [0, 0, 1, 1]
+        self.height_map = None
         # Keep the template file path for saving purposes
         self._template_file = template_file
         self.open_file(template_file)
@@ -422,6 +426,7 @@ class Template(object):
         self.template_size = self._get_dimensions(size_lines)
         self.wells = self._add_shapes(well_lines, 'well')
         self.ledges = self._add_shapes(ledge_lines, 'ledge')
+        self.height_map = None
 
     @staticmethod
     def _get_dimensions(lines):
@@ -462,19 +467,33 @@ class Template(object):
         plt.show()
         return fig, ax
 
-    def get_intersection(self, xx, yy):
+    def compile(self, resolution=None):
+        """
+        Rasterizes the ledges into the height map used by get_intersection (see L4.HeightMap). Call again after
+        changing the ledges.
+        :param resolution: float, cell size (mm), None uses Template.resolution
+        :return: HeightMap
+        """
+        if resolution is not None:
+            self.resolution = resolution
+        self.height_map = HeightMap(self.ledges.values(), self.resolution)
+        # Planned moves used the old ledges
+        Trajectory.plan_cache.invalidate()
+        return self.height_map
 
-        zz = np.zeros(len(xx))
-        for _, ledge in self.ledges.items():
-            zz += ledge.get_intersection(xx, yy)
-        return zz
+    def get_intersection(self, xx, yy):
+        """
+        Returns the ledge height at every point of a path (overlapping ledges add up)
+        :param xx: list or np.array of x positions (mm)
+        :param yy: list or np.array of y positions (mm)
+        :return: np.array
+        """
+        if self.height_map is None:
+            self.compile()
+        return self.height_map.get_heights(xx, yy)
 
     def get_max_ledge(self):
-        z_max = -1
-        for _, ledge in self.ledges.items():
-            if ledge.height > z_max:
-                z_max = ledge.height
-        return z_max
+        return max([ledge.height for ledge in self.ledges.values()], default=-1)
 
 
 class AutoRun:
@@ -504,6 +523,9 @@ class AutoRun:
         self.traced_thread.name = 'AutoRun'
         self.data_dir = get_system_var('data_dir')[0]
         self.safe_enabled = False
+        self.route_enabled = False  # Safe moves may go around tall ledges (Trajectory.RoutedMove)
+        self.move_timeout = 60  # s, deadline for all the stage moves of a step
+        self._move = None  # Trajectory.Move of the current step, stop_run aborts its unsent commands
         self.template = None
         self.template: Template
         self.path_information = PathTrace()
@@ -517,6 +539,8 @@ class AutoRun:
         offset = [x2-x1 for x2, x1 in zip(xy, well_xy)]
         print(f'Offset is: {offset}')
         self.offset = offset
+        # The planned moves were for the old well positions
+        Trajectory.plan_cache.invalidate()
         return offset
 
 
@@ -551,6 +575,7 @@ class AutoRun:
         if template_file.lower() == "default":
             template_file = os.path.abspath(os.path.join(os.getcwd(), '..', 'config\\template-test.txt'))
         self.template = Template(template_file)
+        Trajectory.plan_cache.invalidate()
 
     def start_run(self, simulated=False):
         """
@@ -612,25 +637,26 @@ class AutoRun:
                 self.path_information.append(f"Performing Step '{step.name}' at rep {rep}")
                 self.path_information.append(f"Preparing for move to well {well_name}")
                 # Move the System Safely
-                if self.safe_enabled:
-                    state = Trajectory.SafeMove(self.system, self.template, xyz0, xyz1, simulated,
-                                                self.path_information).move()
+                if self.safe_enabled and self.route_enabled:
+                    move = Trajectory.RoutedMove(self.system, self.template, xyz0, xyz1, simulated,
+                                                 self.path_information)
+                elif self.safe_enabled:
+                    move = Trajectory.SafeMove(self.system, self.template, xyz0, xyz1, simulated,
+                                               self.path_information)
                 else:
-                    state = Trajectory.StepMove(self.system, self.template, xyz0, xyz1, simulated,
-                                                self.path_information).move()
-                self.error_message(state, "System Move")
-
-                # Move the inlet
+                    move = Trajectory.StepMove(self.system, self.template, xyz0, xyz1, simulated,
+                                               self.path_information)
+                self._move = move
+                # Move the outlet, it doesn't depend on the inlet or XY moves so it moves at the same time
                 self.path_information.append(f"Outlet Height set to {step.outlet_height} mm")
-                if not simulated:
-                    self.system.outlet_z.set_z(step.outlet_height)
-
-                    # Wait for both Z Stages to stop moving
-                    state = self.system.inlet_z.wait_for_target(xyz1[2])
-                    self.error_message(state, "Inlet Move Down")
+                outlet = Trajectory.move_axis(self.system.outlet_z, step.outlet_height, simulated=simulated,
+                                              abort=move.abort)
+                state = move.move()
+                self.error_message(state, "System Move")
 
-                    state = self.system.outlet_z.wait_for_target(step.outlet_height)
-                    self.error_message(state, "Outlet Move Down")
+                # Wait for the inlet, XY and outlet stages to reach their targets
+                state = Trajectory.wait_all(move.futures + [outlet], self.move_timeout, move.abort)
+                self.error_message(state, "System Move")
 
                 # Run the special command for injections here
                 after_special = True  # change this to false if we don't need to run the timed part of the step after
@@ -672,9 +698,9 @@ class AutoRun:
         xy position.
         """
 
-        # Get starting positions
-        x, y = self.system.xy_stage.read_xy()
-        z = self.system.inlet_z.read_z()
+        # Get starting positions (cached positions are only served once the last move was confirmed at its target)
+        x, y = self.system.xy_stage.get_xy()
+        z = self.system.inlet_z.get_z()
         xyz0 = [x, y, z]
 
         # Get Ending Positions, Special command for collection will override this
@@ -757,6 +783,9 @@ class AutoRun:
         :return:
         """
         self.system.stop_ce()
+        # Stage commands still waiting on their dependencies must not be sent after the run stopped
+        if self._move is not None:
+            self._move.abort.set()
         # Kill the thread using the trace and wait till the thread has been killed before continuing
         while not self._queue.empty():
             try:
@@ -18,6 +18,8 @@ from skimage.morphology import watershed
 from L4.image_util import *
 import pandas as pd
 
+from L2.FrameAnalytics import analytics_of
+
 
 def get_blobs(image, algorithm='scikit_threshold', *args, **kwargs):
     """
@@ -157,6 +159,29 @@ def get_avg_score(img_dir, close_size=1, open_size=1):
     return [close_size, open_size, average_score]
 
 
+def get_detection_edges(image, scale=0.5):
+    """
+    Rescales, normalizes and median filters an image and finds its edges, the first steps of ImageDetect.get_regions
+    :param image: np.ndarray
+    :param scale: float, rescaling applied before the filters
+    :return: (normalized image, filtered image, sobel edges)
+    """
+    # Make sure types are the same
+    signal_image = img_as_float(image)
+
+    #Resize for faster analysis
+    if scale != 1:
+        signal_image = transform.rescale(signal_image, scale)
+
+    # Normalize between 0 and 1
+    normalized_image = (signal_image - signal_image.min()) / (signal_image.max() - signal_image.min())
+    # Filter Image
+    filtered_image = filters.median(normalized_image, behavior='ndimage')
+    # Edge Detection
+    edge_sobel = filters.sobel(filtered_image)
+    return normalized_image, filtered_image, edge_sobel
+
+
 class ImageDetect:
     
     """
@@ -195,10 +220,20 @@ class ImageDetect:
     imd.draw_cell()
     lysis_yx, lysis_rad = imd.draw_lysis(move_to_frac, lysis_radius_frac)
     imd.draw_vector(lysis_yx, lysis_rad, mm_per_pix)
+
+    # Or snap the image with the camera's 'detect' profile, the camera bins the image instead of rescaling it
+    imd = ImageDetect.from_camera(system.camera)
     """
     
-    def __init__(self, img):
+    def __init__(self, img, scale=0.5):
+        """
+        :param img: np.ndarray
+        :param scale: float, rescaling applied before the analysis (1 if the image is already binned)
+        """
         self.img = img.copy()
+        # The analytics belong to the copy, the caller may change its own array after the detection is created
+        self.analytics = analytics_of(self.img)
+        self.scale = scale
         self.img_display = None
         self.regions=None
         self.labels=None
@@ -217,23 +252,26 @@ class ImageDetect:
         self.opened2 = None
         
     
+    @classmethod
+    def from_camera(cls, camera, profile='detect'):
+        """
+        Snaps an image with a camera profile and returns the ImageDetect for it. The image is rescaled so the analysis
+        runs at half the full frame resolution, a 2x2 binned profile needs no rescaling.
+        :param camera: L2.CameraControl camera
+        :param profile: str, name of the camera profile
+        :return: ImageDetect
+        """
+        with camera.use_profile(profile):
+            img = camera.snap()
+            bin_size = camera.bin_size
+        # Binned images smaller than half resolution are analysed as they are, never upsampled
+        return cls(img, scale=min(1, 0.5 * bin_size))
+
     def get_regions(self):
-        image = self.img
-        # Make sure types are the same
-        input_image = img_as_float(image)
-        input_image = input_image 
-        # Subtract background
-        signal_image = input_image# - background
-
-        #Resize for faster analysis
-        signal_image = transform.rescale(signal_image, 0.5)
-
-        # Normalize between 0 and 1
-        self.normalized_image = normalized_image = (signal_image - signal_image.min()) / (signal_image.max() - signal_image.min())
-        # Filter Image
-        self.filtered_image = filtered_image = filters.median(normalized_image, behavior='ndimage')
-        # Edge Detection
-        self.edge_sobel = edge_sobel = filters.sobel(filtered_image)
+        # The filtered image and its edges are cached with the frame, detections on the same frame reuse them
+        self.normalized_image, self.filtered_image, self.edge_sobel = \
+            self.analytics.get(('detect_edges', self.scale), get_detection_edges, self.scale)
+        edge_sobel = self.edge_sobel
 
         # Threshold
         thresh = filters.threshold_otsu(edge_sobel)
@@ -288,7 +326,7 @@ class ImageDetect:
     def create_blank_display(self):
         # Normalize the image
         img=self.img.copy()
-        img_display = transform.rescale(img, 0.5)
+        img_display = transform.rescale(img, self.scale) if self.scale != 1 else img_as_float(img)
         im_st = img_display - np.quantile(img_display,0.1)
         #Convert to color
         rggb = gray2rgb(im_st*1/(np.quantile(im_st,0.95)))
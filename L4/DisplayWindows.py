@@ -8,14 +8,12 @@ import tkinter
 from abc import ABC, abstractmethod
 from queue import Queue
 from tkinter import ttk
-import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import animation
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
 from L3.SystemsBuilder import CESystem
-from skimage.exposure import adjust_gamma, exposure
-from skimage.transform import resize
+from skimage.exposure import adjust_gamma
 
 
 class MicroscopeDisplayAbstraction(ABC):
@@ -77,10 +75,13 @@ class PLTMicroscopeDisplay(MicroscopeDisplayAbstraction):
         self.img_ax = None
         self.im = None
         self.queue = Queue(maxsize=1)
-        self.system.camera.add_callback(self._update)
         self._ani_func = None
         self.percentiles = 0.5
         self.scalar = 0.5
+        # The camera makes the downsampled 8 bit images for the display
+        self.system.camera.set_preview(max_size=int(max(self.system.camera.dimensions) * self.scalar),
+                                       percentiles=(self.percentiles, 100 - self.percentiles))
+        self.system.camera.add_preview_callback(self._update, tag='display', policy='latest')
 
     def show(self):
         self.fig = fig = plt.figure()
@@ -91,18 +92,16 @@ class PLTMicroscopeDisplay(MicroscopeDisplayAbstraction):
         self.single_image()
 
     def single_image(self):
-        img = self.system.camera.snap()
+        img = self.system.camera.preview.render(self.system.camera.snap())
         img = self._pre_plot_image(img)
         with self.lock:
-            self.im = self.img_ax.imshow(img)
+            self.im = self.img_ax.imshow(img, vmin=0, vmax=255)
 
     def _pre_plot_image(self, image):
-        resize_shape = [int(x * self.scalar) for x in self.system.camera.dimensions]
-        image = resize(image,resize_shape)
-        image = adjust_gamma(image, gamma=self.gamma, gain=self.gain)
-        low, p98 = np.percentile(image, [self.percentiles, 1-self.percentiles])
-        img_rescale = exposure.rescale_intensity(image, in_range=(low, p98))
-        return image
+        # The preview is already downsampled and scaled to 8 bit
+        if self.gamma == 1 and self.gain == 1:
+            return image
+        return adjust_gamma(image, gamma=self.gamma, gain=self.gain)
 
     def live_image(self):
         self.system.camera.continuous_snap()
@@ -124,9 +123,7 @@ class PLTMicroscopeDisplay(MicroscopeDisplayAbstraction):
             img = self.queue.get_nowait()
             img = self._pre_plot_image(img)
             self.im.set_data(img)
-            vmax = np.max(img)
-            vmin = np.min(img)
-            self.im.set_clim(vmin,vmax)
+            self.im.set_clim(0, 255)
             #print(f"Type: {type(self.im)}, {self.im}")
             return [self.im]
 
@@ -270,7 +267,7 @@ class PLTCEDisplay(CEDisplayAbstraction):
         :return: list of artists for animation function
         """
 
-        data = self.system.detector.get_data()
+        data = self.system.detector.get_display_data()
         power_data = self.system.high_voltage.get_data()
         ax1, ax2 = self.plot_axes[0:2]
         try:
@@ -373,7 +370,7 @@ class TkCEDisplay(CEDisplayAbstraction):
         :return: list of artists for animation function
         """
 
-        data = self.system.detector.get_data()
+        data = self.system.detector.get_display_data()
         power_data = self.system.high_voltage.get_data()
         ax1, ax2 = self.plot_axes[0:2]
         try:
@@ -6,7 +6,7 @@ It also contains all functions to read in data from the System
 from L3.SystemsBuilder import CESystem
 from L4 import Electropherogram
 
-from scipy.interpolate import interp1d
+from L2.DataStore import align
 import os
 from pathlib import Path
 import numpy as np
@@ -121,30 +121,24 @@ class OutputElectropherogram:
         :return:
         """
         detector_data = system.detector.get_data()
-        power_data = system.high_voltage.get_data()
-        power_time = power_data['time_data']
         detector_time = detector_data['time_data']
-        # We need a power data to be as long as the detector data, so we add in one more time_data pair to be sure
-        # thus replace the start and stop of the power time to match the detector time if the detector time has
-        # more data points
-        if power_time[-1] < detector_time[-1]:
-            power_time[-1] = detector_time[-1]
-        if power_time[0] > detector_time[0]:
-            power_time[0] = detector_time[0]
-
-        # We need to interpolate data values from the power supply (Power supply may not be sampled at the same rate)
-        if len(power_time) > 0:
-            for channel in ['voltage', 'current']:
-                if len(power_data[channel]) > 3:
-                    fx = interp1d(power_time, power_data[channel], kind='cubic')
-                    power_data[channel] = fx(detector_time)
-
-                else:
-                    power_data[channel] = np.pad(power_data[channel],
-                                                 (0, len(detector_time) - len(power_data[channel])),
-                                                 'edge')
-
-        return [detector_time, detector_data['rfu'], power_data['voltage'], power_data['current']]
+
+        # The power aligner resamples the power supply data onto the detector time as it is acquired
+        if system.power_aligner is not None:
+            power_data = system.power_aligner.get_data()
+            if len(power_data['time_data']) == len(detector_time):
+                return [detector_time, detector_data['rfu'], power_data['voltage'], power_data['current']]
+
+        # Otherwise (ie the aligner was not attached for the whole run) align the full record now
+        power_data = system.high_voltage.get_data()
+        columns = ['voltage', 'current']
+        if len(power_data['time_data']) > 0:
+            values = np.column_stack([power_data[channel] for channel in columns])
+            values = align(detector_time, power_data['time_data'], values, mode='linear')
+        else:
+            values = np.full((len(detector_time), len(columns)), np.nan)
+
+        return [detector_time, detector_data['rfu'], values[:, 0], values[:, 1]]
 
 
 class SlideSingleCell:
@@ -11,11 +11,26 @@ import numpy as np
 from scipy.ndimage import gaussian_filter
 from scipy.signal import convolve2d
 from PIL import Image
+from L2.FrameAnalytics import analytics_of
 from L3 import SystemsBuilder
 
 ''' Fill the two functions below with their actual implementations would probably be easiest. '''
 
 
+def with_camera_profile(func):
+    """ Decorator for focus searches, the camera uses the searcher's profile (ie a central ROI) during the search
+    so each image is faster to read out and to score. A profile of None keeps the camera settings.
+    """
+
+    def wrapper(self, *args, **kwargs):
+        if self.profile is None:
+            return func(self, *args, **kwargs)
+        with self.system.camera.use_profile(self.profile):
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
 class Climb:
     """
     Basic focus search class that can move the focal plane, retrieve the position, and get the image.
@@ -26,6 +41,7 @@ class Climb:
         self.current_pos = system.objective.read_z()
         self.score_fnc = score_fnc
         self.wait = 0.1 # how long to wait before taking image
+        self.profile = None  # camera profile used while climbing (ie 'focus'), None keeps the camera settings
 
     def move(self, z):
         """Moves the camera, or file indexer, to the position z"""
@@ -63,6 +79,7 @@ class RefinedStepClimb(Climb):
     def __init__(self, *args):
         super().__init__(*args)
 
+    @with_camera_profile
     def climb(self, initial_step=5, final_step=0.1, refinements=3, log=False):
         """
         Hill climb using smaller and smaller step sizes. When a maximum is found, start the refinement.
@@ -119,6 +136,7 @@ class StepClimb(Climb):
     def __init__(self, *args):
         super().__init__(*args)
 
+    @with_camera_profile
     def climb(self, step_size=2, iterations=10, history=False):
         """
         Searches by scanning from step_size*iterations above and below the current position. Returns the position with the
@@ -262,7 +280,7 @@ class PlaneFocus:
 
     def get_plane_focus(self):
         # If spline is not set up, keep the objective at the same position
-        xy = self.system.xy_stage.read_xy()
+        xy = self.system.xy_stage.get_xy()
         a, b, c, d = self._plane_coefficients
         z = (d - (a * xy[0]) - (b * xy[1])) / c
         logging.info("Focus position is {} ".format(z))
@@ -283,6 +301,7 @@ class FindFocus:
         self.variance = None
         self.power = None
         self.system = system
+        self.profile = None  # camera profile used during the searches (ie 'focus'), None keeps the camera settings
 
     def move_z(self, distance):
         self.system.objective.set_rel_z(distance)
@@ -292,6 +311,7 @@ class FindFocus:
         img = self.system.camera.snap()
         return img
 
+    @with_camera_profile
     def search_fibonacci(self, z_multiplier=0.002):
         """
         Helpful short video on fibonacci search: https://www.youtube.com/watch?v=GAafWFRGP7k
@@ -385,6 +405,7 @@ class FindFocus:
             n += 1
 
 
+    @with_camera_profile
     def search_step_global(self, step_size=7, max_iterations=8, z_multiplier=0.001):
         """
         A total of 'max_iterations' images will be taken with some distance between each image. The camera will initially
@@ -406,15 +427,16 @@ class FindFocus:
         """
 
 
-        self.move_z(step_size * z_multiplier * -(max_iterations // 2))
+        # The sweep positions are known up front, so the images are acquired as one stack
+        steps = np.arange(-(max_iterations // 2), (max_iterations // 2))
+        positions = self.system.objective.read_z() + steps * step_size * z_multiplier
+        self.system.objective.set_z(positions[0])
         time.sleep(0.4)
-        image_array = self.snap_image()
-        c_b, c_r, c_e, c_s, c_v, c_p = get_measures(image_array)
+        stack, _ = self.system.camera.acquire_stack(positions, move=self.system.objective.set_z, settle=0.2)
+        c_b, c_r, c_e, c_s, c_v, c_p = get_measures(stack[0])
 
         differences = []
-        for n in range(-(max_iterations // 2) + 2, (max_iterations // 2) + 1):
-            self.move_z(step_size * z_multiplier)
-            image_array = self.snap_image()
+        for image_array in stack[1:]:
             d_b, d_r, d_e, d_s, d_v, d_p = get_measures(image_array)
 
             measure_difference = is_moving_toward_focus_2(c_b, c_r, c_e, c_s, c_v, c_p,
@@ -725,15 +747,17 @@ def brenner_gradient_santos(image_array) -> float:
         np.sum(np.power(image_array_difference, 2), where=np.abs(image_array_comparison) >= gradient_threshold))
 
 
-def entropy_siavash(image_array) -> float:
+def entropy_siavash(image_array, analytics=None) -> float:
     """
     See (1) pg. 3
     :param image_array:
+    :param analytics: FrameAnalytics of image_array, shared with the other measures of the image
     :return: Entropy measure as float
     """
 
+    analytics = analytics if analytics is not None else analytics_of(image_array)
     num_elements = np.size(image_array)
-    histogram, _ = np.histogram(image_array, 65535)
+    histogram, _ = analytics.histogram(65535)
     probabilities = histogram / num_elements
     return float(-np.sum(np.multiply(probabilities, np.log2(probabilities, where=probabilities > 0))))
 
@@ -923,14 +947,16 @@ def horizontal_sobel_by_three(image_array) -> float:
     return float(np.sum(np.power(convolve2d(image_array, operator_1), 2)))
 
 
-def range_histogram(image_array) -> float:
-    histogram, _ = np.histogram(image_array, 65535)
+def range_histogram(image_array, analytics=None) -> float:
+    analytics = analytics if analytics is not None else analytics_of(image_array)
+    histogram, _ = analytics.histogram(65535)
     return float(max(histogram) - min(histogram))
 
 
-def entropy_histogram(image_array) -> float:
+def entropy_histogram(image_array, analytics=None) -> float:
+    analytics = analytics if analytics is not None else analytics_of(image_array)
     num_elements = np.size(image_array)
-    histogram, _ = np.histogram(image_array, 65535)
+    histogram, _ = analytics.histogram(65535)
     probabilities = histogram / num_elements
     return float(-np.sum(np.multiply(probabilities, np.log2(probabilities, where=probabilities > 0))))
 
@@ -957,9 +983,10 @@ def m_and_g_histogram(image_array) -> float:
     return float(final_value)
 
 
-def m_and_m_histogram(image_array) -> float:
-    threshold = int(np.mean(image_array)) + 1
-    histogram, _ = np.histogram(image_array, 65535)
+def m_and_m_histogram(image_array, analytics=None) -> float:
+    analytics = analytics if analytics is not None else analytics_of(image_array)
+    threshold = int(analytics.mean()) + 1
+    histogram, _ = analytics.histogram(65535)
     final_value = 0.0
 
     for i in range(len(histogram)):
@@ -969,15 +996,14 @@ def m_and_m_histogram(image_array) -> float:
     return float(final_value)
 
 
-def normalized_variance(image_array) -> float:
-    mean = np.mean(image_array)
-    return float(np.sum(np.power(np.subtract(image_array, mean), 2)) \
-                 / (len(image_array) * len(image_array[0]) * mean))
+def normalized_variance(image_array, analytics=None) -> float:
+    analytics = analytics if analytics is not None else analytics_of(image_array)
+    return float(analytics.variance() / analytics.mean())
 
 
-def variance(image_array) -> float:
-    return float(np.sum(np.power(np.subtract(image_array, np.mean(image_array)), 2)) \
-                 / (len(image_array) * len(image_array[0])))
+def variance(image_array, analytics=None) -> float:
+    analytics = analytics if analytics is not None else analytics_of(image_array)
+    return analytics.variance()
 
 
 def threshold_pixel_count(image_array) -> float:
@@ -990,8 +1016,9 @@ def threshold_content(image_array) -> float:
     return float(np.sum([[k if k >= threshold else 0 for k in row] for row in image_array]))
 
 
-def power(image_array) -> float:
-    return float(np.sum(np.power(image_array, 2)))
+def power(image_array, analytics=None) -> float:
+    analytics = analytics if analytics is not None else analytics_of(image_array)
+    return analytics.get('power', lambda image: float(np.sum(np.power(image, 2))))
 
 
 def autocorrelation(image_array) -> float:
@@ -1015,8 +1042,10 @@ def vollaths_f5(image_array) -> float:
 
 
 def get_measures(image_array):
-    return brenner(image_array), range_histogram(image_array), entropy_histogram(image_array), \
-           sobel_by_three(image_array), variance(image_array), power(image_array)
+    # The measures share the histogram and the pixel statistics of the image instead of each computing them again
+    analytics = analytics_of(image_array)
+    return brenner(image_array), range_histogram(image_array, analytics), entropy_histogram(image_array, analytics), \
+           sobel_by_three(image_array), variance(image_array, analytics), power(image_array, analytics)
 
 
 def is_moving_toward_focus_1(b1, r1, e1, s1, v1, p1, b2, r2, e2, s2, v2, p2):
@@ -0,0 +1,170 @@
+"""
+Ledge heights of a template as a grid, so the height along a stage path is an array lookup instead of a test of every
+point against every ledge.
+
+HeightMap : the template ledges rasterized at a set resolution. Cells completely inside or outside each ledge hold
+the exact height. Cells a ledge edge runs through are indexed with the ledges that cross them, points in those cells
+are tested against those ledges only.
+"""
+import logging
+
+import numpy as np
+
+RECTANGLE = 0
+CIRCLE = 1
+
+
+class HeightMap:
+    """
+    Rasterized ledge heights (the sum of the heights of the ledges covering a point, like Template.get_intersection)
+
+    get_heights : height at every point of a path
+    get_upper_heights : highest height in each cell (route planning, see L4.PathPlanner)
+    """
+
+    def __init__(self, ledges, resolution=0.5):
+        """
+        :param ledges: list of AutomatedControl.Ledge (shape, size, xy and height)
+        :param resolution: float, cell size (mm)
+        """
+        self.resolution = resolution
+        ledges = list(ledges)
+        self._shape = np.array([CIRCLE if ledge.shape == 'circle' else RECTANGLE for ledge in ledges], dtype=int)
+        self._center = np.array([ledge.xy for ledge in ledges], dtype=float).reshape(-1, 2)
+        # Rectangle half sizes, or the circle radius in both columns
+        self._half = np.array([[ledge.size / 2, ledge.size / 2] if ledge.shape == 'circle' else
+                               [ledge.size[0] / 2, ledge.size[1] / 2] for ledge in ledges], dtype=float).reshape(-1, 2)
+        self._height = np.array([ledge.height for ledge in ledges], dtype=float)
+        self._radius = np.array([ledge.size if ledge.shape == 'circle' else 0 for ledge in ledges], dtype=float)
+        self._rasterize()
+
+    def _rasterize(self):
+        r = self.resolution
+        extent = np.where(self._shape[:, None] == CIRCLE, self._radius[:, None], self._half)
+        low, high = self._center - extent, self._center + extent
+        if len(self._height) == 0:
+            low, high = np.zeros((1, 2)), np.zeros((1, 2))
+        # Spare cells around the ledges, points outside the grid are not on any ledge
+        self.origin = low.min(axis=0) - 2 * r
+        self.cells = (np.ceil((high.max(axis=0) + 2 * r - self.origin) / r).astype(int) + 1)[::-1]  # rows, columns
+        self.heights = np.zeros(self.cells)
+        edge_cells, edge_ledges = [], []
+        # Cells within this distance of a cell border are treated as crossing it (rounding of the point cell)
+        eps = r * 1e-6
+        for idx in range(len(self._height)):
+            (c0, r0), (c1, r1) = self._get_cell(low[idx] - eps), self._get_cell(high[idx] + eps)
+            c0, r0, c1, r1 = c0 - 1, r0 - 1, c1 + 1, r1 + 1
+            x0 = self.origin[0] + np.arange(c0, c1 + 1) * r
+            y0 = self.origin[1] + np.arange(r0, r1 + 1) * r
+            xa, ya = np.meshgrid(x0, y0)
+            xb, yb = xa + r, ya + r
+            cx, cy = self._center[idx]
+            if self._shape[idx] == CIRCLE:
+                # Every corner of the cell in the circle
+                far_x = np.maximum(np.abs(xa - cx), np.abs(xb - cx)) + eps
+                far_y = np.maximum(np.abs(ya - cy), np.abs(yb - cy)) + eps
+                near_x = np.maximum(0, np.maximum(xa - cx, cx - xb) - eps)
+                near_y = np.maximum(0, np.maximum(ya - cy, cy - yb) - eps)
+                full = far_x ** 2 + far_y ** 2 < self._radius[idx] ** 2
+                touched = near_x ** 2 + near_y ** 2 <= self._radius[idx] ** 2
+            else:
+                hx, hy = self._half[idx]
+                full = (cx - hx < xa - eps) & (xb + eps < cx + hx) & (cy - hy < ya - eps) & (yb + eps < cy + hy)
+                touched = (xa - eps < cx + hx) & (cx - hx < xb + eps) & (ya - eps < cy + hy) & (cy - hy < yb + eps)
+            window = self.heights[r0:r1 + 1, c0:c1 + 1]
+            window[full] += self._height[idx]
+            rows, columns = np.nonzero(touched & ~full)
+            edge_cells.append((rows + r0) * self.cells[1] + columns + c0)
+            edge_ledges.append(np.full(len(rows), idx))
+        # Grid index of the edge cells: cell number (sorted) and the ledge crossing it
+        edge_cells = np.concatenate(edge_cells) if edge_cells else np.zeros(0, int)
+        edge_ledges = np.concatenate(edge_ledges) if edge_ledges else np.zeros(0, int)
+        order = np.argsort(edge_cells, kind='stable')
+        self._edge_cells, self._edge_ledges = edge_cells[order], edge_ledges[order]
+        self.edge = np.zeros(self.cells, dtype=bool)
+        self.edge.flat[self._edge_cells] = True
+        logging.debug(f"Template height map {self.cells} cells, {len(self._edge_cells)} ledge edge cells")
+
+    def get_upper_heights(self):
+        """
+        Returns the highest ledge height anywhere in each cell (cells crossed by a ledge edge count the ledge)
+        :return: np.ndarray (rows, columns)
+        """
+        edges = np.bincount(self._edge_cells, weights=self._height[self._edge_ledges], minlength=self.heights.size)
+        return self.heights + edges.reshape(self.heights.shape)
+
+    def _get_cell(self, xy):
+        """ Column and row of points, xy (..., 2) """
+        return np.floor((np.asarray(xy) - self.origin) / self.resolution).astype(int)
+
+    def get_heights(self, xx, yy):
+        """
+        Returns the ledge height at every point of a path
+        :param xx: np.array, x positions (mm)
+        :param yy: np.array, y positions (mm)
+        :return: np.array of float
+        """
+        xx, yy = np.asarray(xx, dtype=float).reshape(-1), np.asarray(yy, dtype=float).reshape(-1)
+        columns = np.floor((xx - self.origin[0]) / self.resolution).astype(int)
+        rows = np.floor((yy - self.origin[1]) / self.resolution).astype(int)
+        inside = (columns >= 0) & (columns < self.cells[1]) & (rows >= 0) & (rows < self.cells[0])
+        if not inside.all():
+            # Points outside the grid read the spare cell in the corner (no ledge)
+            columns[~inside], rows[~inside] = 0, 0
+        zz = self.heights[rows, columns]
+        points = np.nonzero(self.edge[rows, columns])[0]
+        if len(points) == 0:
+            return zz
+        # Pairs of (point, ledge crossing the point's cell)
+        cells = rows[points] * self.cells[1] + columns[points]
+        left = np.searchsorted(self._edge_cells, cells, side='left')
+        counts = np.searchsorted(self._edge_cells, cells, side='right') - left
+        pair_point = np.repeat(points, counts)
+        pair_index = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(left, counts)
+        ledge = self._edge_ledges[pair_index]
+        zz += np.bincount(pair_point, weights=self._height[ledge] * self._contains(ledge, xx[pair_point],
+                                                                               yy[pair_point]), minlength=len(zz))
+        return zz
+
+    def _contains(self, ledge, xx, yy):
+        """ Exact test of points against ledges, the same comparisons as BasicTemplateShape.get_intersection """
+        cx, cy = self._center[ledge, 0], self._center[ledge, 1]
+        hx, hy = self._half[ledge, 0], self._half[ledge, 1]
+        in_box = (cx - hx < xx) & (xx < cx + hx) & (cy - hy < yy) & (yy < cy + hy)
+        in_circle = (xx - cx) ** 2 + (yy - cy) ** 2 <= self._radius[ledge] ** 2
+        return np.where(self._shape[ledge] == CIRCLE, in_circle, in_box)
+
+
+def test_height_map(trials=50, seed=0):
+    """ Checks the height map against testing every point against every ledge on random templates """
+    rng = np.random.default_rng(seed)
+
+    class _Ledge:
+        def __init__(self):
+            self.shape = 'circle' if rng.random() < 0.4 else 'rectangle'
+            # Some ledges have their edges on the grid lines
+            decimals = int(rng.integers(0, 4))
+            self.size = np.round(rng.uniform(0.5, 20), decimals) if self.shape == 'circle' else \
+                list(np.round(rng.uniform(0.5, 40, 2), decimals))
+            self.xy = list(np.round(rng.uniform(0, 150, 2), decimals))
+            self.height = rng.uniform(0.5, 20)
+
+        def get_heights(self, xx, yy):
+            if self.shape == 'circle':
+                return np.where((xx - self.xy[0]) ** 2 + (yy - self.xy[1]) ** 2 <= self.size ** 2, self.height, 0)
+            minx, maxx = self.xy[0] - self.size[0] / 2, self.xy[0] + self.size[0] / 2
+            miny, maxy = self.xy[1] - self.size[1] / 2, self.xy[1] + self.size[1] / 2
+            return np.where((minx < xx) & (xx < maxx) & (miny < yy) & (yy < maxy), self.height, 0)
+
+    for _ in range(trials):
+        ledges = [_Ledge() for _ in range(rng.integers(0, 12))]
+        height_map = HeightMap(ledges, resolution=rng.choice([0.1, 0.25, 0.5, 1, 3]))
+        xx = np.concatenate((rng.uniform(-20, 180, 5000), np.round(rng.uniform(-20, 180, 5000), 1)))
+        yy = np.concatenate((rng.uniform(-20, 180, 5000), np.round(rng.uniform(-20, 180, 5000), 1)))
+        expected = np.zeros(len(xx))
+        for ledge in ledges:
+            expected += ledge.get_heights(xx, yy)
+        # Only the order the overlapping heights are added in differs
+        assert np.allclose(height_map.get_heights(xx, yy), expected, rtol=0, atol=1e-9), \
+            "Height map differs from the ledges"
+    logging.info(f"Height map matched the ledges on {trials} random templates")
@@ -0,0 +1,135 @@
+"""
+Routes for the XY stage around template ledges that are taller than the inlet travel height.
+
+RouteGrid : the template height map (L4.HeightMap) at the planning resolution. find_route searches the cells lower
+than a travel height with A* and straightens the cell path into the few waypoints the stage moves through.
+
+The motion timing and the check of the real stage path between waypoints are in L4.Trajectory.RoutedMove.
+"""
+import heapq
+
+import numpy as np
+
+# 8 connected neighbours (row, column) and their step lengths in cells
+_NEIGHBOURS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+_STEPS = [np.hypot(dr, dc) for dr, dc in _NEIGHBOURS]
+
+
+class RouteGrid:
+    """
+    Highest ledge height in each planning cell, over an area that includes the template ledges and the move ends
+    """
+
+    def __init__(self, height_map, points, resolution=1.0):
+        """
+        :param height_map: L4.HeightMap.HeightMap of the template
+        :param points: list of [x, y] that must be on the grid (ie the move start and end)
+        :param resolution: float, cell size (mm), at least the height map resolution
+        """
+        upper = height_map.get_upper_heights()
+        factor = max(1, int(round(resolution / height_map.resolution)))
+        self.resolution = height_map.resolution * factor
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        map_low = height_map.origin
+        map_high = height_map.origin + np.array(upper.shape[::-1]) * height_map.resolution
+        low = np.minimum(map_low, points.min(axis=0) - 2 * self.resolution)
+        high = np.maximum(map_high, points.max(axis=0) + 2 * self.resolution)
+        # Planning cells line up with blocks of height map cells
+        shift = np.ceil((map_low - low) / self.resolution)
+        self.origin = map_low - shift * self.resolution
+        columns, rows = np.ceil((high - self.origin) / self.resolution).astype(int) + 1
+        self.heights = np.zeros((rows, columns))
+        map_rows, map_columns = np.indices(upper.shape)
+        offset = shift.astype(int)
+        np.maximum.at(self.heights, (map_rows // factor + offset[1], map_columns // factor + offset[0]), upper)
+
+    def get_cell(self, xy):
+        """ Returns the (row, column) of a point """
+        column, row = np.floor((np.asarray(xy, dtype=float) - self.origin) / self.resolution).astype(int)
+        return int(row), int(column)
+
+    def get_center(self, cell):
+        """ Returns the [x, y] center of a (row, column) cell """
+        row, column = cell
+        return [float(self.origin[0] + (column + 0.5) * self.resolution),
+                float(self.origin[1] + (row + 0.5) * self.resolution)]
+
+    def find_route(self, start, end, height):
+        """
+        Returns a route from start to end that only crosses cells no higher than height
+        :param start: [x, y]
+        :param end: [x, y]
+        :param height: float, travel height (mm)
+        :return: list of [x, y] waypoints from start to end, None if the ledges block every route
+        """
+        free = self.heights <= height
+        first, last = self.get_cell(start), self.get_cell(end)
+        # The move ends are reachable whatever their cells hold, the heights there are checked by the caller
+        free[first], free[last] = True, True
+        cells = self._search(free, first, last)
+        if cells is None:
+            return None
+        return self._straighten(free, [list(start)] + [self.get_center(cell) for cell in cells[1:-1]] + [list(end)])
+
+    @staticmethod
+    def _search(free, first, last):
+        """ A* over the free cells, returns the list of cells from first to last """
+        rows, columns = free.shape
+        cost = {first: 0}
+        parent = {first: None}
+        queue = [(np.hypot(last[0] - first[0], last[1] - first[1]), first)]
+        while queue:
+            _, cell = heapq.heappop(queue)
+            if cell == last:
+                path = []
+                while cell is not None:
+                    path.append(cell)
+                    cell = parent[cell]
+                return path[::-1]
+            for (dr, dc), step in zip(_NEIGHBOURS, _STEPS):
+                neighbour = (cell[0] + dr, cell[1] + dc)
+                if not (0 <= neighbour[0] < rows and 0 <= neighbour[1] < columns) or not free[neighbour]:
+                    continue
+                # No cutting corners between two blocked cells
+                if dr and dc and not (free[cell[0] + dr, cell[1]] or free[cell[0], cell[1] + dc]):
+                    continue
+                new_cost = cost[cell] + step
+                if new_cost < cost.get(neighbour, np.inf):
+                    cost[neighbour] = new_cost
+                    parent[neighbour] = cell
+                    estimate = np.hypot(last[0] - neighbour[0], last[1] - neighbour[1])
+                    heapq.heappush(queue, (new_cost + estimate, neighbour))
+        return None
+
+    def line_clear(self, free, p0, p1):
+        """
+        Returns whether the straight line between two points only crosses free cells
+        :param free: np.ndarray of bool, cells that can be crossed
+        :param p0: [x, y]
+        :param p1: [x, y]
+        :return: bool
+        """
+        samples = int(np.ceil(np.hypot(p1[0] - p0[0], p1[1] - p0[1]) / self.resolution * 4)) + 2
+        tt = np.linspace(0, 1, samples)
+        xy = np.asarray(p0, dtype=float) + (np.asarray(p1, dtype=float) - np.asarray(p0, dtype=float)) * tt[:, None]
+        columns, rows = np.floor((xy - self.origin) / self.resolution).astype(int).T
+        return bool(free[rows, columns].all())
+
+    def _straighten(self, free, points):
+        """ Keeps the waypoints where the route has to turn, each one as far along as the straight line reaches """
+        route = [points[0]]
+        anchor = 0
+        while anchor < len(points) - 1:
+            reach = anchor + 1
+            while reach + 1 < len(points) and self.line_clear(free, points[anchor], points[reach + 1]):
+                reach += 1
+            route.append(points[reach])
+            anchor = reach
+        # Each waypoint stops the stage, drop the ones the neighbouring waypoints can see past
+        idx = 1
+        while idx < len(route) - 1:
+            if self.line_clear(free, route[idx - 1], route[idx + 1]):
+                del route[idx]
+            else:
+                idx += 1
+        return route
@@ -2,10 +2,11 @@ from tkinter import *
 from tkinter import ttk
 from tkinter import filedialog
 
-from skimage.exposure import adjust_gamma, exposure
+from skimage.exposure import adjust_gamma
 from skimage.io import imsave
 from skimage.transform import resize
 
+from L2.FrameRing import FrameRing
 from L3 import SystemsBuilder
 from L4 import SystemQueue, FileIO
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
@@ -159,7 +160,7 @@ class ZExpandable(CollapsiblePane):
         self.z_abs = None  # type: ttk.Spinbox
 
         self.setup()
-        root.system_queue.add_info_callback("system.{}.read_z".format(z_name), self.read_z)
+        root.system_queue.add_info_callback("system.{}.get_z".format(z_name), self.read_z)
         self.root_window = root
 
     def setup(self):
@@ -225,7 +226,7 @@ class XYExpandable(CollapsiblePane):
         self.y_spin = None  # type: ttk.Spinbox
 
         self.setup()
-        root.system_queue.add_info_callback("system.xy_stage.read_xy", self.read_xy)
+        root.system_queue.add_info_callback("system.xy_stage.get_xy", self.read_xy)
         self.root_window = root
 
     def setup(self):
@@ -574,7 +575,7 @@ class EgramWindow(Frame):
         self.setup()
         self.ani = animation.FuncAnimation(self.fig, self.update_graph, interval=2000)
 
-        parent.system_queue.add_info_callback('system.detector.get_data', self.add_data)
+        parent.system_queue.add_info_callback('system.detector.get_display_data', self.add_data)
         parent.system_queue.add_info_callback('system.high_voltage.get_data', self.add_power_data)
 
     def setup(self):
@@ -666,8 +667,17 @@ class CameraWindow(Frame):
         self.gain = 1
 
         self.ani = animation.FuncAnimation(self.fig, self.update_image, interval=2000)
-        parent.system_queue.add_info_callback('system.camera.get_last_image', self.read_image)
+        # The system sends the camera's 8 bit preview (scaled to the display), the full image only for saving
+        parent.system_queue.add_info_callback('system.camera.get_preview', self.read_image)
+        parent.system_queue.add_info_callback('system.camera.get_last_image', self.save_raw_image, update=False)
         parent.system_queue.add_info_callback('system.camera.get_camera_dimensions', self.update_dims)
+        self.lower_var.trace('w', self.adjust_percentiles)
+        self.upper_var.trace('w', self.adjust_percentiles)
+        self.adjust_percentiles()
+        # A camera running in its own process shares its frames in memory, raw images are read from there
+        self.ring = None
+        parent.system_queue.add_info_callback('system.camera.get_ring_name', self.attach_ring, update=False)
+        parent.system_queue.send_command('system.camera.get_ring_name')
 
     def setup(self):
 
@@ -722,47 +732,53 @@ class CameraWindow(Frame):
         self.im_plot = self.ax.imshow(self.img)
 
     def read_image(self, img, *args, **kwargs):
-
-        if img is not None and img != []:
-            self.raw_image = img.copy()
-            # print("LLL:{},{}".format(img, args))
-
-            img = self._pre_plot_image(img)
+        if img is not None:
             self.img = img
             self._update_img = True
 
+    def attach_ring(self, name, *args):
+        """
+        Reads the raw camera images from the camera process frame ring instead of requesting them from the system
+        :param name: str, shared memory name of the ring (None if the camera doesn't run in a process)
+        :return:
+        """
+        if name is not None:
+            self.ring = FrameRing.attach(name)
+
     # noinspection PyUnresolvedReferences
     def update_image(self, *args):
         if self._update_img:
             self.im_plot.set_data(self.img)
-            vmax = np.max(self.img)
-            vmin = np.min(self.img)
-            self.im_plot.set_clim(vmin, vmax)
+            self.im_plot.set_clim(0, 255)
             self._update_img = False
             self.canvas.draw()
         return [self.im_plot]
 
-    def _pre_plot_image(self, image):
-        # image = adjust_gamma(image, gamma=self.gamma, gain=self.gain)
+    def adjust_percentiles(self, *args):
+        """ Sends the display percentiles to the camera preview """
         try:
             self.percentiles = [self.lower_var.get(), self.upper_var.get()]
         except Exception as e:
-            pass
-
-        print(self.percentiles)
-        low, hi = np.percentile(image, self.percentiles)
-        print(low, hi)
-        img_rescale = exposure.rescale_intensity(image, in_range=(low, hi))
-        print(img_rescale)
-        return img_rescale
+            return
+        self.parent.system_queue.send_command('system.camera.set_preview', percentiles=self.percentiles)
 
     def update_dims(self, data, *args):
         self.dims = data
 
     def snap_image(self, *args):
-        img = self.raw_image.copy()
+        """ Saves the last full resolution camera image """
+        if self.ring is not None:
+            frame = self.ring.get(self.ring.latest())
+            if frame is not None:
+                self.save_raw_image(np.array(frame[0]))
+                return
+        self.parent.system_queue.send_command('system.camera.get_last_image')
+
+    def save_raw_image(self, img, *args):
+        if img is None or len(img) == 0:
+            return
         file = filedialog.asksaveasfilename(defaultextension=".tif", filetypes=[("Raw Image Tiffs", "*.tif")])
-        if file is not None:
+        if file:
             imsave(file, img)
 
     def adjust_exposure(self, *args):
@@ -786,8 +802,8 @@ class InjectionData():
         self.add_obj = False
         self.dif_var = DoubleVar()
         self.root_window = root_window
-        root_window.system_queue.add_info_callback('system.objective.read_z', self.obj_callback)
-        root_window.system_queue.add_info_callback('system.inlet_z.read_z', self.inlet_callback)
+        root_window.system_queue.add_info_callback('system.objective.get_z', self.obj_callback)
+        root_window.system_queue.add_info_callback('system.inlet_z.get_z', self.inlet_callback)
 
     def get_difference(self):
         if self.add_obj or self.add_cap:
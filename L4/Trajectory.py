@@ -1,22 +1,225 @@
 """
 More of a Functional Programming style here...
 
-Pathfinder -> Finds the path a motor will take when moving from point A to point B.
+Pathfinder -> Finds the path a motor will take when moving from point A to point B. The S-curve (or trapezoidal without
+jerk) profile is calculated in closed form from the distance, velocity, acceleration and jerk.
 
 Calc_Delay -> User gives lists of
 
+Axis moves -> move_axis starts a stage move on a worker thread and returns a Future, so independent axes move at the
+same time. wait_all and wait_any wait on a group of moves with a deadline.
+
+Plan cache -> SafeMove plans (motor paths, ledge heights and delays) are kept in plan_cache, keyed by the move
+positions, the template and the stage tuning, so a method going back and forth between the same wells only plans
+each move once.
+
 """
 import logging
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import numpy as np
-from scipy import optimize
 from L3.SystemsBuilder import CESystem
 from L4 import AutomatedControl
+from L4.PathPlanner import RouteGrid
 import matplotlib.pyplot as plt
 from abc import ABC, abstractmethod
 
+# Moves waiting on a dependency hold a worker, a step uses at most one worker per axis command
+_axis_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='AxisMove')
+
+
+def move_axis(stage, target, after=(), delay=0, wait_target=True, timeout=None, simulated=False, sent=None,
+              delay_from=None, abort=None):
+    """
+    Starts a stage move on a worker thread and returns a Future for it. The move is sent once every move in after
+    has finished successfully and no earlier than delay seconds after this call (or after the time delay_from
+    resolves to). If a dependency failed the stage is not moved and the result is False.
+    :param stage: XY stage (target is [x, y]) or Z stage (target is z)
+    :param target: [float, float] or float, mm
+    :param after: list of Futures (None entries are ignored) that must finish before the move is sent
+    :param delay: float, earliest start of the move in seconds from now, or from delay_from
+    :param wait_target: bool, if False the future is done once the command is sent, otherwise once the target is
+    reached
+    :param timeout: float, seconds to wait for the target (None uses the stage default)
+    :param simulated: bool, the stage is not moved and the future is already done
+    :param sent: Future set to the time.time() the command is sent (None if the move is skipped), so other moves can
+    be timed from the moment this stage actually starts
+    :param delay_from: Future from another move's sent, the delay starts when that command was sent. The move is
+    skipped if that command was never sent.
+    :param abort: threading.Event, if set before the command is sent the stage is not moved and the result is False
+    :return: concurrent.futures.Future, result is True if the move succeeded
+    """
+    if simulated:
+        if sent is not None:
+            sent.set_result(time.time())
+        future = Future()
+        future.set_result(True)
+        return future
+    return _axis_pool.submit(_run_axis_move, stage, target, [f for f in after if f is not None],
+                             time.time() + delay, wait_target, timeout, sent, delay_from, delay, abort)
+
+
+def _run_axis_move(stage, target, after, start_time, wait_target, timeout, sent=None, delay_from=None, delay=0,
+                   abort=None):
+    try:
+        for dependency in after:
+            if not dependency.result():
+                logging.warning(f"{stage.role} move to {target} was skipped, a previous move failed")
+                return False
+        if delay_from is not None:
+            sent_time = delay_from.result()
+            if sent_time is None:
+                logging.warning(f"{stage.role} move to {target} was skipped, the move it is timed from was not sent")
+                return False
+            start_time = sent_time + delay
+        remaining = start_time - time.time()
+        if remaining > 0:
+            if abort is not None:
+                abort.wait(remaining)
+            else:
+                time.sleep(remaining)
+        # A running future can't be cancelled, the abort is the last chance to keep the command from being sent
+        if abort is not None and abort.is_set():
+            logging.warning(f"{stage.role} move to {target} was aborted before it was sent")
+            return False
+        kwargs = {} if timeout is None else {'timeout': timeout}
+        if sent is not None:
+            sent.set_result(time.time())
+        if hasattr(stage, 'set_xy'):
+            stage.set_xy(target)
+            return stage.wait_for_xy_target(target, **kwargs) if wait_target else True
+        stage.set_z(target)
+        return stage.wait_for_target(target, **kwargs) if wait_target else True
+    finally:
+        # Moves timed from this one must not wait forever for a command that was never sent
+        if sent is not None and not sent.done():
+            sent.set_result(None)
+
+
+def wait_all(futures, timeout=None, abort=None):
+    """
+    Waits for every move to finish. Moves that have not started by the deadline are cancelled, and abort is set so
+    moves already waiting on a dependency or a delay are not sent either.
+    :param futures: list of Futures from move_axis (None entries are ignored)
+    :param timeout: float, seconds (None waits forever)
+    :param abort: threading.Event the moves were started with (see move_axis)
+    :return: bool, True if every move finished in time and succeeded
+    """
+    futures = [f for f in futures if f is not None]
+    done, pending = wait(futures, timeout, return_when=ALL_COMPLETED)
+    for future in pending:
+        future.cancel()
+    if pending:
+        if abort is not None:
+            abort.set()
+        logging.error(f"{len(pending)} axis moves did not finish within {timeout} s")
+        return False
+    state = True
+    for future in done:
+        if future.exception() is not None:
+            logging.error(f"Axis move failed: {future.exception()}")
+            state = False
+        elif not future.result():
+            state = False
+    return state
+
+
+def wait_any(futures, timeout=None):
+    """
+    Waits for the first move to finish
+    :param futures: list of Futures from move_axis (None entries are ignored)
+    :param timeout: float, seconds (None waits forever)
+    :return: the first finished Future or None if none finished in time
+    """
+    futures = [f for f in futures if f is not None]
+    done, _ = wait(futures, timeout, return_when=FIRST_COMPLETED)
+    if len(done) == 0:
+        return None
+    return next(f for f in futures if f in done)
+
+
+class MotionPlanCache:
+    """
+    Least recently used cache of move plans. A plan is keyed by the start and end positions (rounded to the
+    quantum), the template and the velocity, acceleration and jerk of the stages, so retuning a stage makes new plans.
+    Call invalidate when the template or the template offset changes.
+    """
+
+    def __init__(self, max_plans=256, quantum=0.001):
+        """
+        :param max_plans: int, number of plans kept
+        :param quantum: float, position resolution of the keys (mm)
+        """
+        self.max_plans = max_plans
+        self.quantum = quantum
+        self.hits = 0
+        self.misses = 0
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, template, xyz0, xyz1, *stages):
+        """
+        Returns the cache key of a move
+        :param template: AutomatedControl.Template
+        :param xyz0: [x, y, z] start position
+        :param xyz1: [x, y, z] end position
+        :param stages: stages whose motion parameters the plan depends on
+        :return: tuple
+        """
+        positions = tuple(int(round(v / self.quantum)) for v in list(xyz0) + list(xyz1))
+        tuning = tuple((getattr(stage, 'velocity_max', None), getattr(stage, 'acceleration', None),
+                        getattr(stage, 'jerk', None)) for stage in stages)
+        return id(template), positions, tuning
+
+    def get(self, key, func, *args):
+        """
+        Returns the plan for a key, func(*args) makes the plan if it isn't cached
+        :param key: tuple from get_key
+        :param func: function object
+        :return: the plan
+        """
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return self._plans[key]
+            self.misses += 1
+        plan = func(*args)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_plans:
+                self._plans.popitem(last=False)
+        return plan
+
+    def invalidate(self):
+        """
+        Removes every plan (template or offset changed)
+        :return:
+        """
+        with self._lock:
+            self._plans.clear()
+
+    def get_statistics(self):
+        """
+        Returns the number of cached plans, hits and misses
+        :return: dict
+        """
+        with self._lock:
+            return {'plans': len(self._plans), 'hits': self.hits, 'misses': self.misses}
+
+
+plan_cache = MotionPlanCache()
+
 
 class Move(ABC):
+    """
+    A move between two locations of a CE run. move() sends the axis commands as futures (see move_axis) and returns
+    without waiting for them, wait() waits for the commands of the move. Setting abort keeps the commands that have
+    not been sent yet from being sent.
+    """
+
     def __init__(self, system, template, xyz0, xyz1, simulated=False, path_information=[]):
         self.system = system
         self.template = template
@@ -24,6 +227,22 @@ class Move(ABC):
         self.xyz1 = xyz1
         self.simulated = simulated
         self.path_information = path_information
+        self.futures = []
+        self.abort = threading.Event()
+
+    def move_axis(self, stage, target, **kwargs):
+        """ Starts an axis move that belongs to this move, see move_axis """
+        future = move_axis(stage, target, simulated=self.simulated, abort=self.abort, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def wait(self, timeout=None):
+        """
+        Waits for every axis command of the move
+        :param timeout: float, seconds (None waits forever)
+        :return: bool, True if every command succeeded in time
+        """
+        return wait_all(self.futures, timeout, self.abort)
 
     def check_z(self, x0, y0, x1, y1):
         # If xy0 and xy1 are the same location, we don't need to move z
@@ -51,7 +270,7 @@ class StepMove(Move):
         Moves the XY Stage and Inlet Z stage in a systematic way. It caclulates the highest ledge on the template
         and uses that as the safe transfer height
 
-        Move in this order:
+        Move in this order, each move starts once the previous one reached its target:
         Move the Z Stage up
         Move the XY Stage across
         Move the Z Stage Down
@@ -61,25 +280,19 @@ class StepMove(Move):
         x1, y1, z1 = self.xyz1
         transfer_height = self.template.get_max_ledge()
         skip_z = self.check_z(x0, y0, x1, y1)
-        # Move the Z stage, wait for the target height to be reached
-        self.path_information.append(f"Moving capillary Z stage to {transfer_height} mm")
-        if not self.simulated and not skip_z:
-            self.system.inlet_z.set_z(transfer_height)
-            if not self.system.inlet_z.wait_for_target(transfer_height):
-                return False
+        # Move the Z stage, the XY stage waits for the target height to be reached
+        z_up = None
+        if not skip_z:
+            self.path_information.append(f"Moving capillary Z stage to {transfer_height} mm")
+            z_up = self.move_axis(self.system.inlet_z, transfer_height)
 
         # Move the XY Stage
         self.path_information.append(f"Moving Stage to {x1},{y1} mm")
-        if not self.simulated:
-            self.system.xy_stage.set_xy([x1, y1])
-            # Return false if the stage did not move
-            if not self.system.xy_stage.wait_for_xy_target([x1, y1]):
-                return False
+        xy = self.move_axis(self.system.xy_stage, [x1, y1], after=[z_up])
 
         # Move the Z Stage back down
         self.path_information.append(f"Moving capillary Z stage to {z1}")
-        if not self.simulated:
-            self.system.inlet_z.set_z(z1)
+        self.move_axis(self.system.inlet_z, z1, after=[xy])
         return True
 
 
@@ -92,11 +305,22 @@ class SafeMove(Move):
 
 
 
-    def move(self):
+    def plan(self):
         """
-        Moves the XY stage and Inlet Z stage in a way as to prevent any collisions with the template ledges defined
-        by the user.
-        :return:
+        Returns the plan of the move, from plan_cache if the same move was planned before
+        :return: dict
+        """
+        return plan_cache.get(self._get_plan_key(), self._plan)
+
+    def _get_plan_key(self):
+        """ Returns the plan_cache key of the move """
+        key = plan_cache.get_key(self.template, self.xyz0, self.xyz1, self.system.xy_stage, self.system.inlet_z)
+        return key + (type(self).__name__,)
+
+    def _plan(self):
+        """
+        Calculates the XY path, the ledge heights along it, the transfer height and the delays between the stages
+        :return: dict
         """
         # Get information about the move
         x0, y0, z0 = self.xyz0
@@ -113,49 +337,69 @@ class SafeMove(Move):
 
         # Determine the max height over the entire range
         mid_max = max(ledge_z.max(), z0, z1)
-        zz = [0]
+        zz = np.zeros(1)
         # Determine the increase move step (moving from start point to max point)
         xy_stage_delay = 0
         if mid_max > z0:
-            # Move the Z inlet first then the XY stage after delay
-            st = time.time()
-            self.system.inlet_z.set_z(mid_max)
-
             # Calculate the xy delay
             zz = _get_motor_path([z0], [mid_max], self.system.inlet_z)[0]
             xy_stage_delay = self.get_delay(ledge_z, zz, increasing=True)
-            while time.time() - st < xy_stage_delay:
-                time.sleep(0.01)
 
-        # Move the XY stage (only after the capillary has increased its height sufficiently)
-        st = time.time()
-        self.path_information.append(f"Moving xy stage to {x1},{y1} mm")
-        if not self.simulated:
-            self.system.xy_stage.set_xy([x1, y1])
-        zz_decrease = [0]
+        zz_decrease = np.zeros(1)
         # Determine the decrease move step delay (moving down from our max point to final point)
         z_stage_down_delay = 0
+        inlet_targets = []
         if mid_max > z1:
             zz_decrease = _get_motor_path([mid_max], [z1], self.system.inlet_z)[0]
             z_stage_down_delay = self.get_delay(ledge_z, zz_decrease, increasing=False)
-            while time.time() - st < z_stage_down_delay:
-                time.sleep(0.01)
-            self.path_information.append(f"Moving capillary Z stage to {z1}")
-            if not self.simulated:
-                self.system.inlet_z.set_z(z1)
+            inlet_targets.append((z1, z_stage_down_delay))
 
         # We may have to lower the outlet if the user overrode the ledge height for the current location
+        # (inlet target delays are from the moment the XY command is sent)
         if z1 != self.xyz1[2]:
             time_xy = len(xx) / 1000
-            while time.time() - st < time_xy:
-                time.sleep(0.01)
-            self.path_information.append(f"Moving capillary Z stage to {self.xyz1[2]}")
-            if not self.simulated:
-                self.system.inlet_z.set_z(self.xyz1[2])
+            inlet_targets.append((self.xyz1[2], time_xy))
+
+        # Plans are shared between moves
+        for arr in (xx, yy, ledge_z, zz, zz_decrease):
+            arr.flags.writeable = False
+        return {'xx': xx, 'yy': yy, 'ledge_z': ledge_z, 'mid_max': mid_max, 'zz': zz, 'zz_decrease': zz_decrease,
+                'xy_delay': xy_stage_delay, 'z_delay': z_stage_down_delay, 'inlet_targets': inlet_targets}
+
+    def move(self):
+        """
+        Moves the XY stage and Inlet Z stage in a way as to prevent any collisions with the template ledges defined
+        by the user.
+        :return:
+        """
+        plan = self.plan()
+        x1, y1, _ = self.xyz1
+        # The inlet commands are sent in order, only the last one waits for its target. The XY stage and the inlet
+        # move at the same time with the delays calculated from the motor paths.
+        # The delays are measured from the moment the previous stage's command was actually sent, so a slow command
+        # delays the stages that depend on it instead of letting them start early.
+        inlet = inlet_sent = None
+        if plan['mid_max'] > self.xyz0[2]:
+            # Move the Z inlet first then the XY stage after delay
+            inlet_sent = Future()
+            inlet = self.move_axis(self.system.inlet_z, plan['mid_max'], wait_target=False, sent=inlet_sent)
+
+        # Move the XY stage (only after the capillary has increased its height sufficiently)
+        self.path_information.append(f"Moving xy stage to {x1},{y1} mm")
+        xy_sent = Future()
+        self.move_axis(self.system.xy_stage, [x1, y1], after=[inlet], delay=plan['xy_delay'], sent=xy_sent,
+                       delay_from=inlet_sent)
+
+        inlet_targets = plan['inlet_targets']
+        for idx, (z, delay) in enumerate(inlet_targets):
+            self.path_information.append(f"Moving capillary Z stage to {z}")
+            inlet = self.move_axis(self.system.inlet_z, z, after=[inlet], delay=delay, delay_from=xy_sent,
+                                   wait_target=idx == len(inlet_targets) - 1)
 
         # Record data if necessary
         if self.visual:
-            self.visualize(xx, yy, ledge_z, zz, zz_decrease, xy_stage_delay, z_stage_down_delay)
+            self.visualize(plan['xx'], plan['yy'], plan['ledge_z'], plan['zz'], plan['zz_decrease'],
+                           plan['xy_delay'], plan['z_delay'])
 
         return True
 
@@ -182,20 +426,149 @@ class SafeMove(Move):
 
     @staticmethod
     def get_delay(ledge, zz, increasing=True, tolerance=0.5):
+        """
+        Returns the delay between the Z and XY moves so the Z path stays above the ledges (minus the tolerance) at
+        every sample. Increasing moves delay the XY stage until Z is high enough, decreasing moves delay Z until the
+        XY stage has passed the ledges.
+        :param ledge: np.array, ledge height at each XY sample (1 ms apart)
+        :param zz: np.array, monotone Z path (1 ms apart)
+        :param increasing: bool, the Z path goes up (delay the XY stage) or down (delay the Z stage)
+        :param tolerance: float, how far below the ledge height Z can go
+        :return: float, delay (s)
+        """
         ledge = ledge - tolerance
         ledge, zz = _normalize_paths([ledge, zz])
-        # Get the delay time_data needed between the stages
-        delay = 0
-        collision = zz - ledge
-        # Move our zz array forward one (increase delay it will reach the ledge), do the opposite for decreasing
-        while (collision < 0).any():
-            if increasing:
-                zz[:-1] = zz[1:]
-            else:
-                zz[1:] = zz[0:-1]
-            delay += .001
-            collision = zz - ledge
-        return delay
+        samples = np.arange(len(zz))
+        if increasing:
+            # First sample at which Z reaches each ledge height, the XY sample k must come after it
+            first = np.searchsorted(np.maximum.accumulate(zz), ledge, side='left')
+            if (first >= len(zz)).any():
+                raise ValueError("The Z path never clears the ledges")
+            shift = first - samples
+        else:
+            # Last sample at which Z is still above each ledge height, the XY sample k must come before it
+            descending = np.minimum.accumulate(zz)[::-1]
+            last = len(zz) - 1 - np.searchsorted(descending, ledge, side='left')
+            if (last < 0).any():
+                raise ValueError("The Z path never clears the ledges")
+            shift = samples - last
+        return max(int(shift.max()), 0) / 1000
+
+
+class RoutedMove(SafeMove):
+    """
+    SafeMove that can send the XY stage around tall ledges. A straight move lifts the inlet over the tallest ledge on
+    the line, a route through lower parts of the template (found with L4.PathPlanner) only lifts it to the tallest
+    ledge on the route. The route is used when the inlet moves plus the XY moves between its waypoints take less time
+    than the straight move.
+
+    Routed moves run one after the other: inlet up, each XY segment, inlet down. Every XY segment is a separate
+    stage command that is confirmed before the next one is sent, so each costs the stage settle time on top of its
+    path.
+    """
+    segment_overhead = 0.05  # s, time added to every XY segment when the stage has no motion model
+
+    def __init__(self, system, template, xyz0, xyz1, simulated, path_information, visual=False, resolution=1.0,
+                 max_heights=8):
+        """
+        :param resolution: float, planning cell size (mm)
+        :param max_heights: int, number of travel heights (the lowest ones below the straight move height) tried
+        """
+        super().__init__(system, template, xyz0, xyz1, simulated, path_information, visual)
+        self.resolution = resolution
+        self.max_heights = max_heights
+
+    def _plan(self):
+        plan = super()._plan()
+        plan['route'] = None
+        z_up = len(plan['zz']) / 1000 if len(plan['zz']) > 1 else 0
+        z_down = len(plan['zz_decrease']) / 1000 if len(plan['zz_decrease']) > 1 else 0
+        time_xy = len(plan['xx']) / 1000 + self._get_segment_overhead()
+        # The straight move overlaps the inlet and XY moves
+        plan['time'] = max(z_up, plan['xy_delay'] + time_xy, plan['xy_delay'] + plan['z_delay'] + z_down)
+        best = plan['time']
+        for height, route, route_time in self._get_routes(plan['mid_max']):
+            if route_time < best:
+                best = route_time
+                plan['route'], plan['route_height'], plan['time'] = route, height, route_time
+        return plan
+
+    def _get_routes(self, straight_height):
+        """
+        Finds a route for each travel height below the straight move height
+        :return: generator of (height, list of [x, y] waypoints, time (s))
+        """
+        x0, y0, z0 = self.xyz0
+        x1, y1, z1 = self.xyz1
+        if self.template.height_map is None:
+            self.template.compile()
+        ends = self.template.get_intersection([x0, x1], [y0, y1])
+        lowest = max(ends.max(), z0, z1)
+        grid = RouteGrid(self.template.height_map, [[x0, y0], [x1, y1]], self.resolution)
+        heights = np.unique(grid.heights)
+        heights = heights[(heights >= lowest) & (heights < straight_height)]
+        for height in [lowest] + [h for h in heights[:self.max_heights] if h > lowest]:
+            route = grid.find_route([x0, y0], [x1, y1], height)
+            if route is None or len(route) < 3:
+                continue
+            route_time = self._get_route_time(route, height)
+            if route_time is not None:
+                yield height, route, route_time
+
+    def _get_plan_key(self):
+        # The route choice depends on the calibrated segment overhead
+        return super()._get_plan_key() + (round(self._get_segment_overhead(), 2),)
+
+    def _get_segment_overhead(self):
+        """
+        Returns the time (s) an XY segment takes on top of its path: the command round trip and settling measured
+        by the stage's motion model, and the read that confirms the arrival
+        :return: float
+        """
+        stage = self.system.xy_stage
+        motion = getattr(stage, 'motion', None)
+        settle = motion.settle if motion is not None else self.segment_overhead
+        return settle + getattr(stage, 'confirm_period', 0)
+
+    def _get_route_time(self, route, height):
+        """
+        Returns the time of a routed move, checking the real stage path of each segment against the ledges
+        :return: float (s) or None if a segment crosses a ledge higher than the travel height
+        """
+        z0, z1 = self.xyz0[2], self.xyz1[2]
+        overhead = self._get_segment_overhead()
+        total = 0
+        for p0, p1 in zip(route[:-1], route[1:]):
+            xx, yy = _get_motor_path(p0, p1, self.system.xy_stage)
+            if self.template.get_intersection(xx, yy).max() > height:
+                return None
+            total += len(xx) / 1000 + overhead
+        for start, stop in ((z0, height), (height, z1)):
+            if start != stop:
+                total += len(_get_motor_path([start], [stop], self.system.inlet_z)[0]) / 1000
+        return total
+
+    def move(self):
+        """
+        Moves along the planned route, or like SafeMove if the straight move is faster
+        :return:
+        """
+        plan = self.plan()
+        if plan['route'] is None:
+            return super().move()
+        height = plan['route_height']
+        inlet = None
+        if height > self.xyz0[2]:
+            self.path_information.append(f"Moving capillary Z stage to {height}")
+            inlet = self.move_axis(self.system.inlet_z, height)
+        xy = inlet
+        for x, y in plan['route'][1:]:
+            self.path_information.append(f"Moving xy stage to {x},{y} mm")
+            xy = self.move_axis(self.system.xy_stage, [x, y], after=[xy])
+        if self.xyz1[2] != height:
+            self.path_information.append(f"Moving capillary Z stage to {self.xyz1[2]}")
+            self.move_axis(self.system.inlet_z, self.xyz1[2], after=[xy])
+        return True
 
 
 def _get_ledge_heights(template, xx, yy):
@@ -207,10 +580,7 @@ def _get_ledge_heights(template, xx, yy):
     :param yy: np.array # YY path values
     :return zz: np.array # the height of ledges along the path given by xy
     """
-    zz = np.zeros(xx.shape[0])
-    for _, ledge in template.ledges.items():
-        zz += ledge.get_intersection(xx, yy)
-    return zz
+    return template.get_intersection(xx, yy)
 
 
 def _get_motor_path(xy1, xy2, motor):
@@ -233,10 +603,6 @@ def _get_motor_path(xy1, xy2, motor):
             diff = stop - start
             invert = 1
 
-        if j == 0:
-            # For now assume very high J, but should go back and write new function
-            j = a * 500
-
         path_arr = _get_path(diff, v, a, j) * invert
         path_arr += start
         xy_path.append(path_arr)
@@ -256,131 +622,144 @@ def _normalize_paths(xyz):
     return new_xyz
 
 
-def _get_velocity_difference(a_max, j, v_max):
-    return v_max - (a_max * a_max / j)
-
-
-def _derivative_velocity_difference(a_max, j, v_max):
-    return -2 * a_max / j
-
-
-def _get_distance_diff(v_max, xf, a, j, extra=False):
+def _get_acceleration_time(v_peak, a, j):
     """
-    At the given velocity setting, find out how far we will overshoot the distance and return the difference between
-    the desired distance xf, and the calculated distance (integral of the velocity profile)
-
-    You may be able to simplify the acceleration optimization by first assuming constant acceleration, then implementing a
-    ramp later.
-
-
+    Returns the jerk time, constant acceleration time and peak acceleration of a move from rest to v_peak
+    :param v_peak: float, velocity reached (u/s)
+    :param a: float, maximum acceleration (u/s/s)
+    :param j: float, jerk (u/s/s/s), 0 for a trapezoidal profile (instant acceleration changes)
+    :return: (float, float, float) jerk time (s), constant acceleration time (s), peak acceleration (u/s/s)
     """
-    divisions = 1000
-    vm = _get_velocity_difference(a, j, v_max)
-
-    dt = 0
-
-    # If we overshoot our velocity maximum we must adjust our acceleration
-    if vm < 0:
-        a = optimize.newton(_get_velocity_difference, 1, fprime=_derivative_velocity_difference, args=(j, v_max))
-
-    else:
-        dt = vm / a
-
-        q_c = np.linspace(a, a, int(round(dt * divisions)))
-
-    # Get accel profile
-
-    q1 = np.linspace(0, a, int(round(a / j * divisions)))
-    q3 = np.linspace(a, 0, int(round(a / j * divisions)))
-
-    if dt != 0:
-        q1 = np.concatenate((q1, q_c))
+    if j == 0:
+        return 0., v_peak / a, a
+    if v_peak * j >= a * a:
+        return a / j, v_peak / a - a / j, a
+    # The acceleration never reaches its maximum
+    t_jerk = np.sqrt(v_peak / j)
+    return t_jerk, 0., j * t_jerk
 
-    accel_profile = np.concatenate((q1, q3))
 
-    x = np.zeros(len(accel_profile))
-    # x = np.asarray([ np.trapz(accel_profile[:idx]) for idx in range(len(accel_profile))] # This is much slower (100x)
-    step = 1 / (a / j * divisions)
-    dx = 0
-    for ix, y in enumerate(accel_profile):
-        # dx += step*y
-        # x[ix] = dx
-        x[ix] = np.trapz(accel_profile[:ix] / divisions)  # This is Slower (10x) but more accurate
-    xcalc = np.trapz(x / divisions)
-    if extra:
-        return xf - 2 * xcalc, x, step, accel_profile
-    return xf - xcalc * 2
-
-
-def _slow_optimize(f, var, args=None, tol=.01, iterations=50):
-    logging.debug("Optmizing Velocity for Short Distance")
-    initial = f(var, *args)
-    step = var / 20
-    best_initial = np.abs(initial)
-    best_var = var
-    idx = 0
-
-    solutions = [var]
-    errors = [initial]
-    abs_initial = best_initial
-    while abs_initial > tol and idx < iterations:
-        idx += 1
-
-        if abs_initial < best_initial * 0.5 and abs_initial < 8:
-            step *= 0.5
-            best_var = var
-            best_initial = np.abs(initial)
-
-        if initial < 0:
-            if var - step < step:
-                step = 0.1 * step
-            var -= step
-        else:
-            var += step
-
-        initial = f(var, *args)
-        abs_initial = np.abs(initial)
-        solutions.append(var)
-        errors.append(initial)
-
-        logging.debug(f" Velocity: {var}, Displacement in X: {initial}")
-    return var
+def _get_distance_diff(v_max, xf, a, j):
+    """
+    Returns the difference between the desired distance xf and the distance needed to accelerate to v_max and stop
+    again. A negative difference means the move is too short to reach v_max.
+    :param v_max: float, velocity (u/s)
+    :param xf: float, distance (u)
+    :param a: float, maximum acceleration (u/s/s)
+    :param j: float, jerk (u/s/s/s), 0 for a trapezoidal profile
+    :return: float
+    """
+    t_jerk, t_accel, _ = _get_acceleration_time(v_max, a, j)
+    # The acceleration is symmetric so the average velocity while accelerating is v_max / 2
+    return xf - v_max * (2 * t_jerk + t_accel)
 
 
-def _get_path(xf, vmax=10, a=20, j=200, extra=False):
+def _get_peak_velocity(xf, v_max, a, j):
+    """
+    Returns the highest velocity a move of distance xf reaches (v_max unless the move is too short)
+    :param xf: float, distance (u)
+    :param v_max: float, maximum velocity (u/s)
+    :param a: float, maximum acceleration (u/s/s)
+    :param j: float, jerk (u/s/s/s), 0 for a trapezoidal profile
+    :return: float
+    """
+    if _get_distance_diff(v_max, xf, a, j) >= 0:
+        return v_max
+    if j == 0:
+        # xf = v^2 / a
+        return np.sqrt(xf * a)
+    # Reaching maximum acceleration: xf = v (v / a + a / j)
+    v_peak = a / 2 * (-a / j + np.sqrt((a / j) ** 2 + 4 * xf / a))
+    if v_peak * j >= a * a:
+        return v_peak
+    # Jerk limited only: xf = 2 v^(3/2) / sqrt(j)
+    return (xf * np.sqrt(j) / 2) ** (2 / 3)
+
+
+def _get_profile_segments(xf, vmax, a, j):
     """
+    Returns the phases of a move from rest to rest over a distance xf: jerk up, constant acceleration, jerk down,
+    cruise and the mirrored deceleration (an S-curve, or a trapezoid with j=0).
+    :return: (durations, start accelerations, jerks, start velocities, start positions, total time) np.ndarrays
+    """
+    v_peak = _get_peak_velocity(xf, vmax, a, j)
+    t_jerk, t_accel, a_peak = _get_acceleration_time(v_peak, a, j)
+    t_cruise = max(_get_distance_diff(v_peak, xf, a, j), 0) / v_peak
+    durations = np.array([t_jerk, t_accel, t_jerk, t_cruise, t_jerk, t_accel, t_jerk])
+    accels = np.array([0, a_peak, a_peak, 0, 0, -a_peak, -a_peak])
+    jerks = np.array([j, 0, -j, 0, -j, 0, j], dtype=float)
+    # Velocity and position at the start of each phase
+    v_end = accels * durations + jerks * durations ** 2 / 2
+    velocities = np.concatenate(([0], np.cumsum(v_end)[:-1]))
+    x_end = velocities * durations + accels * durations ** 2 / 2 + jerks * durations ** 3 / 6
+    positions = np.concatenate(([0], np.cumsum(x_end)[:-1]))
+    return durations, accels, jerks, velocities, positions, durations.sum()
+
+
+def _get_path(xf, vmax=10, a=20, j=200, extra=False, divisions=1000):
+    """
+    Position of a motor moving a distance xf from rest to rest, sampled divisions times per second. The profile is
+    evaluated in closed form (no integration), the last sample is at xf.
+
     xf = final distance (assume start at 0)
     vmax = maximum velocity (u/s)
     a = maximum acceleration (u/s/s)
-    j = jerk (u/s/s/s)
+    j = jerk (u/s/s/s), 0 for a trapezoidal profile
+    extra = also return the velocity and acceleration profiles
     """
-
-    xcalc, velocity, step, accel = _get_distance_diff(vmax, xf, a, j, extra=True)
-
-    if xcalc < 0:
-        vmax = _slow_optimize(_get_distance_diff, vmax, args=(xf, a, j), tol=0.5)
-        xcalc, velocity, step, accel = _get_distance_diff(vmax, xf, a, j, extra=True)
-        v_profile = velocity.copy()
-        if extra:
-            accel = np.concatenate((accel, -accel))
-
-    else:
-        extra_t = xcalc / vmax
-        extra_v = np.linspace(vmax, vmax, int(round(extra_t * 1000)))
-        v_profile = velocity.copy()
-        v_profile = np.concatenate((v_profile, extra_v))
-        if extra:
-            extra_a = np.zeros(int(round(extra_t * 1000)))
-            accel = np.concatenate((accel, extra_a, -accel))
-
-    v_profile = np.concatenate((v_profile, np.flip(velocity)))
-    x = np.zeros(len(v_profile))
-    for i, v in enumerate(v_profile):
-        x[i] = np.trapz(v_profile[:i])
-
+    if xf <= 0:
+        zero = np.zeros(1)
+        return (zero, zero.copy(), zero.copy()) if extra else zero
+    durations, accels, jerks, velocities, positions, total = _get_profile_segments(xf, vmax, a, j)
+    tt = np.minimum(np.arange(int(np.ceil(total * divisions)) + 1) / divisions, total)
+    starts = np.concatenate(([0], np.cumsum(durations)[:-1]))
+    # Phase of each sample (empty phases are skipped by side='right')
+    phase = np.clip(np.searchsorted(starts, tt, side='right') - 1, 0, len(durations) - 1)
+    dt = tt - starts[phase]
+    a0, jk, v0 = accels[phase], jerks[phase], velocities[phase]
+    x = positions[phase] + v0 * dt + a0 * dt ** 2 / 2 + jk * dt ** 3 / 6
+    x[-1] = xf
     if extra:
-        return x / 1000, v_profile, accel
-    return x / 1000
+        return x, v0 + a0 * dt + jk * dt ** 2 / 2, a0 + jk * dt
+    return x
+
+
+def _search_delay(ledge, zz, increasing=True, tolerance=0.5):
+    """ Shifts the Z path one sample at a time until it clears the ledges (reference for SafeMove.get_delay) """
+    ledge = ledge - tolerance
+    ledge, zz = _normalize_paths([ledge, zz])
+    delay = 0
+    collision = zz - ledge
+    # Move our zz array forward one (increase delay it will reach the ledge), do the opposite for decreasing
+    while (collision < 0).any():
+        if increasing:
+            zz[:-1] = zz[1:]
+        else:
+            zz[1:] = zz[0:-1]
+        delay += 1
+        collision = zz - ledge
+    return delay / 1000
+
+
+def test_get_delay(trials=200, seed=0):
+    """ Checks SafeMove.get_delay against the shifting search on random ledges and Z paths """
+    rng = np.random.default_rng(seed)
+    for _ in range(trials):
+        z0, z1 = np.sort(rng.uniform(0, 20, 2))
+        xx = _get_path(rng.uniform(0.1, 60), 5, 10, 50) if rng.random() < 0.5 else np.zeros(rng.integers(1, 400))
+        # Steps and plateaus of random lengths like the template ledges, never above the top of the Z path
+        levels = rng.uniform(-5, z1 - z0, rng.integers(1, 6)) + z0
+        if rng.random() < 0.3:
+            levels = np.sort(levels)
+        cuts = np.sort(rng.integers(0, len(xx) + 1, len(levels) - 1))
+        lengths = np.diff(np.concatenate([[0], cuts, [len(xx)]]))
+        ledge = np.minimum(np.repeat(levels, lengths), z1 + 0.5)
+        up = _get_path(z1 - z0, 20, 100, 50000) + z0
+        for increasing, zz in ((True, up), (False, up[::-1].copy())):
+            expected = _search_delay(ledge, zz.copy(), increasing)
+            delay = SafeMove.get_delay(ledge, zz.copy(), increasing)
+            assert delay == expected, f"delay {delay} != {expected} (increasing={increasing})"
+    logging.info(f"get_delay matched the search on {trials} random paths")
 
 
 if __name__ == "__main__":
@@ -17,6 +17,7 @@ from skimage.exposure import adjust_gamma, exposure
 from skimage.transform import resize
 import pandas as pd
 
+from L2.FrameAnalytics import analytics_of
 from L3 import SystemsBuilder
 from L4 import FileIO
 
@@ -77,8 +78,9 @@ class ImageSaver:
         self.system.camera.remove_callback(tag='save_img')
 
     def callback(self, img, *args, **kwargs):
+        # Images from the camera frame pool are shared and reused, keep a copy
         with self._lock:
-            self.images.append(img)
+            self.images.append(np.array(img))
             self.times.append(datetime.datetime.now().strftime(self.time_format))
 
     def save_image(self, image_prefix='img', folder_prefix=None, data_folder=None, unique_folder=True, timestamp=False):
@@ -139,10 +141,17 @@ def make_gif(imgs, file_name):
 
 
 def scale_and_size_image(image, scalar, percentile_low, percentile_high):
-    image = img_as_float(image)
-    resize_shape = [int(x * scalar) for x in image.shape]
-    image = resize(image, resize_shape)
-    low, p98 = np.percentile(image, [percentile_low, percentile_high])
+    if np.issubdtype(image.dtype, np.unsignedinteger) or np.issubdtype(image.dtype, np.floating):
+        # The percentiles of the full image are shared with its other consumers, img_as_float only scales them
+        scale = 1 / np.iinfo(image.dtype).max if np.issubdtype(image.dtype, np.unsignedinteger) else 1
+        low, p98 = analytics_of(image).percentile([percentile_low, percentile_high]) * scale
+        image = img_as_float(image)
+        image = resize(image, [int(x * scalar) for x in image.shape])
+    else:
+        image = img_as_float(image)
+        resize_shape = [int(x * scalar) for x in image.shape]
+        image = resize(image, resize_shape)
+        low, p98 = np.percentile(image, [percentile_low, percentile_high])
     img_rescale = exposure.rescale_intensity(image, in_range=(low, p98))
     return img_rescale
 
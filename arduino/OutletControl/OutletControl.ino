@@ -61,6 +61,11 @@ unsigned long switch_time = 0;
 unsigned long switch_hi_time = 0;
 bool first = true;
 float steps_per_mm = (STEPS_PER_REV * outlet_div /MM_PER_REV);
+//STREAMING
+unsigned long stream_period = 0; // ms between pushed position lines, 0 disables streaming
+unsigned long last_stream = 0;
+bool move_pending = false; // a move was commanded and the target reached event has not been sent
+long target_steps = 0;
 #define CHECK_BIT(var,pos) ((var) & (1<<(pos)))
 
 
@@ -266,6 +271,8 @@ void moveMotor(){
   //Serial.println(steps);
   long steps = long(mm_pos*steps_per_mm);
   driver_2.goTo(steps);
+  target_steps = steps;
+  move_pending = true;
   Serial.println("OK");
 }
 
@@ -328,6 +335,39 @@ void motorTalk(){
   else if (inputString[2]=='R'){
     resetDriver();
   }
+  else if (inputString[2]=='T'){
+    setStream();
+  }
+}
+
+void setStream(){
+  // M0T0050 pushes the position every 50 ms, M0T0000 stops the stream
+  stream_period = inputString.substring(3,9).toInt();
+  last_stream = millis();
+  Serial.println("OK");
+}
+
+void streamCheck(){
+  // Pushes Z:<pos>,<busy>,<target> at the stream period and Z!<pos> once when a commanded move is finished
+  if (stream_period == 0){
+    return;
+  }
+  bool busy = driver_2.busyCheck();
+  if (move_pending and !busy){
+    move_pending = false;
+    Serial.print("Z!");
+    Serial.println(float(driver_2.getPos())/steps_per_mm,3);
+  }
+  unsigned long now = millis();
+  if (now - last_stream >= stream_period){
+    last_stream = now;
+    Serial.print("Z:");
+    Serial.print(float(driver_2.getPos())/steps_per_mm,3);
+    Serial.print(",");
+    Serial.print(busy);
+    Serial.print(",");
+    Serial.println(float(target_steps)/steps_per_mm,3);
+  }
 }
 
 void getMotorPos(){
@@ -453,4 +493,5 @@ void loop()
     inputString = "";
     stringComplete = false;
   }
+  streamCheck();
 }
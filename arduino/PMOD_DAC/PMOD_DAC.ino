@@ -41,6 +41,14 @@ byte ALL_DAC = B1111;
 
 byte channel = B00000000;
 
+// Binary stream frame: sync (2), sequence (2), micros (4), voltage[8] (32), current[8] (32), flags (2), checksum (2)
+// All values are little endian, the checksum is the 16 bit sum of the bytes between the sync and checksum fields
+// Flags: bit 0 is the Bertan enable pin, bit 1 is set once the over-current trip has powered down the supply
+const uint16_t FRAME_SYNC = 0x5AA5;
+const int FRAME_SIZE = 76;
+const uint16_t FLAG_ENABLED = 1;
+const uint16_t FLAG_TRIPPED = 2;
+
 // Class definitions
 
 class Channel {
@@ -127,8 +135,17 @@ class Oracle {
     Oracle();
     DAC dc;
     long baud;
+    bool streaming = false;
+    unsigned long stream_period = 0; // microseconds between frames, 0 sends frames as fast as the ADC allows
+    unsigned long last_frame = 0;
+    uint16_t sequence = 0;
+    uint16_t trip_limit[8] = {0, 0, 0, 0, 0, 0, 0, 0}; // Current ADC counts that power down the supply, 0 is off
+    bool tripped = false;
     void interpret();
     void serialCheck();
+    void streamCheck();
+    void send_frame();
+    void trip_check();
     void send_data_array(float *arg, int buffer_size);
     void send_float(float f);
 };
@@ -183,6 +200,41 @@ void Oracle::interpret(){
     }
     break;
 
+    case 'B':
+    {
+      // Begin streaming binary frames ('B0' + period msb + period lsb in microseconds)
+      msb = _rx_msg[2];
+      lsb = _rx_msg[3];
+      stream_period = ((unsigned long)msb << 8) + lsb;
+      sequence = 0;
+      last_frame = micros();
+      streaming = true;
+    }
+    break;
+    case 'H':
+    {
+      // Halt the binary stream
+      streaming = false;
+    }
+    break;
+    case 'P':
+    {
+      // Set the ADC pins for a channel ('P312' -> Channel 3, voltage on ADC pin 1, current on ADC pin 2)
+      // Use 'N' for a pin that is not connected
+      chnl = _rx_msg[1]-'0';
+      dc.chans[chnl].voltage_pin = (_rx_msg[2] == 'N') ? 255 : _rx_msg[2]-'0';
+      dc.chans[chnl].current_pin = (_rx_msg[3] == 'N') ? 255 : _rx_msg[3]-'0';
+    }
+    break;
+    case 'K':
+    {
+      // Set the over-current trip limit for a channel ('K3' + limit msb + limit lsb in ADC counts, 0 turns it off)
+      chnl = _rx_msg[1]-'0';
+      msb = _rx_msg[2];
+      lsb = _rx_msg[3];
+      trip_limit[chnl] = ((uint16_t)msb << 8) + lsb;
+    }
+    break;
     case 'Z':
     {
       Serial.println("Set Ref");
@@ -215,6 +267,7 @@ void Oracle::interpret(){
     // Enable the Betran Controller
     {
       digitalWrite(ENABLE,HIGH);
+      tripped = false;
     }
     break;
     case 'X':
@@ -282,6 +335,63 @@ void Oracle::serialCheck() {
   }
 }
 
+void Oracle::streamCheck(){
+  // Send a frame when streaming and the stream period has elapsed
+  if (streaming && (micros() - last_frame >= stream_period)){
+    last_frame += stream_period;
+    this -> send_frame();
+  }
+}
+
+void Oracle::send_frame(){
+  /*
+   * Reads every channel and sends it as a single fixed size binary frame
+   * so the computer can decode the stream without parsing text
+   */
+  byte frame[FRAME_SIZE];
+  uint16_t checksum = 0;
+  uint16_t flags = 0;
+  unsigned long now = micros();
+  dc.get_data();
+  this -> trip_check();
+  if (digitalRead(ENABLE) == HIGH){
+    flags |= FLAG_ENABLED;
+  }
+  if (tripped){
+    flags |= FLAG_TRIPPED;
+  }
+
+  frame[0] = FRAME_SYNC & 0xFF;
+  frame[1] = FRAME_SYNC >> 8;
+  frame[2] = sequence & 0xFF;
+  frame[3] = sequence >> 8;
+  memcpy(&frame[4], &now, 4);
+  memcpy(&frame[8], dc.voltage_out, 32);
+  memcpy(&frame[40], dc.current_out, 32);
+  memcpy(&frame[72], &flags, 2);
+  for (int i = 2; i < FRAME_SIZE - 2; i++){
+    checksum += frame[i];
+  }
+  frame[FRAME_SIZE - 2] = checksum & 0xFF;
+  frame[FRAME_SIZE - 1] = checksum >> 8;
+  Serial.write(frame, FRAME_SIZE);
+  sequence++;
+}
+
+void Oracle::trip_check(){
+  /*
+   * Powers down the supply as soon as a current reading is over its trip limit. This runs on the same ADC read
+   * that is streamed, so the supply is stopped before the computer sees the frame.
+   */
+  for (int i = 0; i < 8; i++){
+    if (trip_limit[i] > 0 && dc.current_out[i] > trip_limit[i] && digitalRead(ENABLE) == HIGH){
+      digitalWrite(ENABLE,LOW);
+      dc.reset();
+      tripped = true;
+    }
+  }
+}
+
 void Oracle::send_data_array(float *arg, int buffer_size){
   for (int i = 0; i < buffer_size; i++){
     this-> send_float(arg[i]);
@@ -302,7 +412,7 @@ Channel::Channel(){
 
 float Channel::get_voltage(){
   int data = 0;
-  if (voltage_pin != 1024){
+  if (voltage_pin != 255){
     data = analogRead(voltage_pin);
   }
   return data;
@@ -310,7 +420,7 @@ float Channel::get_voltage(){
 
 float Channel::get_current(){
   int data = 0;
-  if (current_pin != 1024){
+  if (current_pin != 255){
     data = analogRead(current_pin);
   }
   return data;
@@ -383,16 +493,21 @@ void setup() {
   SPI.setDataMode(SPI_MODE0);
   SPI.setClockDivider(SPI_CLOCK_DIV16);
   pinMode(CS, OUTPUT);
+  pinMode(ENABLE, OUTPUT);
+  digitalWrite(ENABLE, LOW);
   orc.dc.init_channels();
   // Return the Voltage to Zero
   orc.dc.reset();
   // Set up the internal Reference
   orc.dc.set_ref();
+  // Let the computer know we are ready (ArduinoController waits for this)
+  Serial.println("INIT");
 }
 
 void loop() {
   // put your main code here, to run repeatedly:
   orc.serialCheck();
+  orc.streamCheck();
   //SPI.transfer(int 64);
 //SPI.transfer(0b11110000);
 
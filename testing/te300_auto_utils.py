@@ -87,3 +87,8 @@ def initialize(ce_system):
     ce_system.camera._postsnap_callbacks=[]
     ce_system.camera.add_presnap_callback(te300_presnap,ce_sys=ce_system)
     ce_system.camera.add_postsnap_callback(te300_postsnap, ce_sys=ce_system)
+
+def initialize_gated(ce_system, gate, channels=(light_channel,), intensity=1):
+    """ Gates the Lumencor channels with the exposure (L2.Illumination) instead of the te300 presnap/postsnap """
+    # te300_postsnap leaves the channels at zero intensity, the gate has to turn them back up
+    ce_system.camera.set_illumination(gate, list(channels), intensity)